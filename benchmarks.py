@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the per-tick hot paths of radar_simulation.py.
+
+Runs against fake_carla with synthetic actors and radar buffers and sweeps
+vehicle count, radar points per scan and display resolution. Every case
+reports per-call latency percentiles and the tracemalloc peak of one call,
+results are written as JSON.
+
+    python benchmarks.py --output benchmark_results.json
+    python benchmarks.py --quick
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import weakref
+
+import numpy as np
+
+import fake_carla
+
+VEHICLES = [10, 100, 1000, 5000]
+RADAR_POINTS = [100, 1000, 5000, 20000]
+RESOLUTIONS = [(640, 360), (960, 540), (1920, 1080)]
+
+QUICK_VEHICLES = [10, 100]
+QUICK_RADAR_POINTS = [100, 1000]
+QUICK_RESOLUTIONS = [(960, 540)]
+
+# world frame velocity of the car given to the static gate of the prefilter
+EGO_VELOCITY = np.array([10.0, 0.0, 0.0])
+
+
+def measure(function, repeats, warmup=2):
+    """
+    Returns latency statistics in milliseconds and the peak traced memory in
+    KiB of calling function().
+    """
+
+    for _ in range(warmup):
+        function()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times *= 1000.0
+    return {
+        'calls': repeats,
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'max_ms': float(times.max()),
+        'peak_kib': peak / 1024.0}
+
+
+class Bench(object):
+    """
+    A client of radar_simulation.py set up against a fake_carla world, one
+    instance per scenario size and resolution.
+    """
+
+    def __init__(self, vehicles, radar_points, resolution):
+        self.output_dir = tempfile.mkdtemp(prefix='radar_bench_')
+        fake_carla.install(fake_carla.SyntheticScenario(vehicles=vehicles, walkers=0, radar_points=radar_points))
+        import radar_simulation
+        self.rs = radar_simulation
+        self.display = radar_simulation.pygame.display.set_mode(resolution)
+
+        client = radar_simulation.BasicSynchronousClient(output_dir=self.output_dir, resolution=resolution)
+        client.client = fake_carla.Client()
+        client.world = client.client.get_world()
+        client.setup_car()
+        client.sensors = radar_simulation.SensorManager(client.world)
+        client.setup_camera()
+        client.setup_radar()
+        client.sink = radar_simulation.AnnotationSink(self.output_dir).start()
+        self.client = client
+        self.frame = client.world.tick()
+        bundle = client.synchronizer.get(self.frame, ['camera'] + client.radar_names)
+        self.image = bundle['camera']
+        self.radar_data = bundle[client.radar_names[0]]
+        client.image = self.image
+        # fresh synchronizer so benchmarked callbacks are not dropped as stale
+        client.synchronizer = radar_simulation.SensorSynchronizer()
+        self.vehicles = client.world.get_actors().filter('vehicle.*')
+        self.states = radar_simulation.ActorStateTable.from_snapshot(client.world.get_snapshot())
+        self.grid = radar_simulation.ActorGrid()
+        self.grid.update(self.states)
+        self.bounding_boxes = radar_simulation.ClientSideBoundingBoxes.get_bounding_boxes(
+            self.vehicles, client.camera, states=self.states, geometry=client.geometry)
+        self.prefilter = radar_simulation.RadarPrefilter(static_threshold=0.5, voxel_size=0.5)
+
+    def close(self):
+        self.client.sink.close()
+        self.client.sensors.destroy()
+
+    def cases(self):
+        rs = self.rs
+        client = self.client
+        transform = self.vehicles[0].get_transform()
+        weak_client = weakref.ref(client)
+        return {
+            'get_matrix': lambda: rs.ClientSideBoundingBoxes.get_matrix(transform),
+            'actor_states': lambda: rs.ActorStateTable.from_snapshot(client.world.get_snapshot()),
+            'get_bounding_boxes': lambda: rs.ClientSideBoundingBoxes.get_bounding_boxes(
+                self.vehicles, client.camera, self.frame, client.sink, self.states, client.geometry),
+            'cull_bounding_boxes': lambda: rs.ClientSideBoundingBoxes.get_bounding_boxes(
+                rs.ClientSideBoundingBoxes.cull(
+                    self.vehicles, client.camera, self.states, self.grid, rs.BOX_RANGE, client.geometry),
+                client.camera, states=self.states, geometry=client.geometry),
+            'draw_bounding_boxes': lambda: rs.ClientSideBoundingBoxes.draw_bounding_boxes(
+                self.display, self.bounding_boxes),
+            '_Radar_callback': lambda: rs.BasicSynchronousClient._Radar_callback(
+                weak_client, self.radar_data),
+            'process_radar': lambda: client.process_radar([(0, self.radar_data)]),
+            'prefilter': lambda: self.prefilter.apply(
+                rs.RadarPoints.from_buffer(self.radar_data.raw_data), EGO_VELOCITY,
+                rs.BasicSynchronousClient._transform_tuple(self.radar_data.transform)[3:]),
+            'prefiltered_radar': self.process_radar_prefiltered,
+            'render': lambda: client.render(self.display),
+        }
+
+    def process_radar_prefiltered(self):
+        # same ego velocity as the prefilter case, the benchmark car stands still
+        default = self.client.prefilter
+        self.client.prefilter = self.prefilter
+        self.client.ego_velocity = lambda: EGO_VELOCITY
+        try:
+            self.client.process_radar([(0, self.radar_data)])
+        finally:
+            self.client.prefilter = default
+            del self.client.ego_velocity
+
+
+def sweep(vehicles, radar_points, resolutions, repeats):
+    """
+    Yields one result dict per benchmark case.
+    """
+
+    default_vehicles = vehicles[0]
+    default_points = radar_points[0]
+    default_resolution = resolutions[len(resolutions) // 2]
+    plan = []
+    for count in vehicles:
+        for resolution in resolutions:
+            plan.append((count, default_points, resolution,
+                         ['actor_states', 'get_bounding_boxes', 'cull_bounding_boxes', 'draw_bounding_boxes']))
+    for points in radar_points:
+        plan.append((default_vehicles, points, default_resolution,
+                     ['_Radar_callback', 'process_radar', 'prefilter', 'prefiltered_radar']))
+    for resolution in resolutions:
+        plan.append((default_vehicles, default_points, resolution, ['render']))
+    plan.append((default_vehicles, default_points, default_resolution, ['get_matrix']))
+
+    for count, points, resolution, names in plan:
+        bench = Bench(count, points, resolution)
+        try:
+            cases = bench.cases()
+            for name in names:
+                result = {
+                    'name': name,
+                    'vehicles': count,
+                    'radar_points': points,
+                    'resolution': list(resolution)}
+                result.update(measure(cases[name], repeats))
+                yield result
+        finally:
+            bench.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--output', default='benchmark_results.json', help='result file (default: %(default)s)')
+    argparser.add_argument('--repeats', default=50, type=int, help='timed calls per case (default: %(default)s)')
+    argparser.add_argument('--quick', action='store_true', help='small sweep for a smoke test')
+    args = argparser.parse_args()
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    if args.quick:
+        plan = (QUICK_VEHICLES, QUICK_RADAR_POINTS, QUICK_RESOLUTIONS)
+    else:
+        plan = (VEHICLES, RADAR_POINTS, RESOLUTIONS)
+
+    import pygame
+    pygame.init()
+    results = []
+    try:
+        for result in sweep(plan[0], plan[1], plan[2], args.repeats):
+            print('%-20s vehicles=%-5d points=%-6d %4dx%-4d p50=%8.3f ms p99=%8.3f ms peak=%8.1f KiB' % (
+                result['name'], result['vehicles'], result['radar_points'], result['resolution'][0],
+                result['resolution'][1], result['p50_ms'], result['p99_ms'], result['peak_kib']))
+            results.append(result)
+    finally:
+        pygame.quit()
+
+    with open(args.output, 'w') as fp:
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}, fp, indent=2)
+    print('results written to %s' % args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
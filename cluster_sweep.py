@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+Offline clustering parameter sweep over recorded radar sessions.
+
+A session is read once from either a binary recording (--record of
+radar_simulation.py) or the point.json / box.json annotations of a run, and
+converted to flat world frame arrays in a cache directory: radar points with
+their radial velocity, the ground-truth box every point lies in and a
+per-frame index. A pool of worker processes maps the cache read-only with
+np.memmap, so the session is parsed once and shared by all workers through
+the page cache. Every (eps, min_samples, velocity_weight) configuration of
+the grid is run over the session, split into frame chunks when there are
+more processes than configurations.
+
+Quality is scored per frame against the ground-truth point labels: a
+cluster is a hit if most of its points lie in one box and it is the largest
+such cluster of that box. Boxes with at least --min-box-points radar points
+count as visible.
+
+    precision = hits / clusters
+    recall    = visible boxes hit / visible boxes
+
+    python cluster_sweep.py --recording DIR --eps 1,1.5,2 --min-samples 2,3,4
+    python cluster_sweep.py --annotations output --velocity-weight 0,0.5,1
+
+box.json records hold the world frame corners of every actor's bounding
+box. Records of older runs hold the location only, their boxes are
+axis-aligned with a fixed half size (--box-extent) around the location.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from radar_clustering import NOISE
+from radar_clustering import RadarClustering
+from radar_processing import BoxGrid
+from radar_recording import BOX_JSON_EXTENT
+from radar_recording import FrameReader
+from radar_recording import annotation_frames
+from radar_recording import box_json_corners
+
+# 2: box.json boxes from their recorded corners
+SESSION_VERSION = 2
+
+# one entry per frame, offset and count are in points
+SESSION_INDEX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('offset', '<i8'),
+    ('count', '<i8'),
+    ('boxes', '<i4')])
+
+# ==============================================================================
+# -- SweepSession --------------------------------------------------------------
+# ==============================================================================
+
+
+class SweepSession(object):
+    """
+    Radar points and ground-truth point labels of a session in a cache
+    directory.
+
+    Files:
+        xyz.f4          (N, 3) float32 world frame positions
+        velocity.f4     (N,) float32 radial velocities
+        point_box.i4    (N,) int32 box of every point within its frame, -1
+                        for none
+        index.bin       SESSION_INDEX_DTYPE entries
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = self._map('index.bin', SESSION_INDEX_DTYPE)
+        self.xyz = self._map('xyz.f4', np.dtype('<f4')).reshape(-1, 3)
+        self.velocity = self._map('velocity.f4', np.dtype('<f4'))
+        self.point_box = self._map('point_box.i4', np.dtype('<i4'))
+
+    def _map(self, name, dtype):
+        filename = os.path.join(self.path, name)
+        if os.path.getsize(filename) < dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, entry):
+        """
+        Returns (xyz, velocity, point_box) memmap views of one index entry.
+        """
+
+        rows = slice(entry['offset'], entry['offset'] + entry['count'])
+        return self.xyz[rows], self.velocity[rows], self.point_box[rows]
+
+    @staticmethod
+    def matches(path, source, box_extent=None):
+        """
+        Returns True if path holds a complete session of this version
+        converted from source, with the same box_extent for annotations.
+        """
+
+        try:
+            with open(os.path.join(path, 'session.json')) as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        return meta.get('version') == SESSION_VERSION and meta.get('source') == os.path.abspath(source) and \
+            meta.get('box_extent') == (None if box_extent is None else list(box_extent))
+
+    @staticmethod
+    def from_recording(recording, path):
+        """
+        Converts a FrameRecorder directory. All radar measurements of a
+        frame are fused in world frame and labelled against the recorded box
+        corners of the same frame.
+        """
+
+        with _SessionWriter(path, recording) as writer:
+            for frame_id, points, xyz, _, boxes in FrameReader(recording).world_frames():
+                writer.add(frame_id, xyz, points[:, 0], boxes['corners'])
+        return SweepSession(path)
+
+    @staticmethod
+    def from_annotations(output_dir, path, box_extent=BOX_JSON_EXTENT):
+        """
+        Converts the point.json and box.json of a run, streaming both files
+        in frame order. Boxes are the recorded corners, records without them
+        get axis-aligned boxes of half size box_extent.
+        """
+
+        with _SessionWriter(path, output_dir, box_extent) as writer:
+            for frame_id, records in annotation_frames(output_dir, ['point', 'box']):
+                points = records['point']
+                writer.add(
+                    frame_id,
+                    np.array([record['point'] for record in points], dtype=np.float64).reshape(-1, 3),
+                    np.array([record['velocity'] for record in points], dtype=np.float64),
+                    box_json_corners(records['box'], box_extent))
+        return SweepSession(path)
+
+
+class _SessionWriter(object):
+
+    def __init__(self, path, source, box_extent=None):
+        os.makedirs(path, exist_ok=True)
+        # an interrupted conversion must not look like a complete session
+        if os.path.exists(os.path.join(path, 'session.json')):
+            os.remove(os.path.join(path, 'session.json'))
+        self.path = path
+        self.source = source
+        self.box_extent = None if box_extent is None else [float(value) for value in box_extent]
+        self.frames = 0
+        self.rows = 0
+        self._files = {}
+        for name in ('xyz.f4', 'velocity.f4', 'point_box.i4', 'index.bin'):
+            self._files[name] = open(os.path.join(path, name), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for fp in self._files.values():
+            fp.close()
+        if exc_info[0] is None:
+            with open(os.path.join(self.path, 'session.json'), 'w') as fp:
+                json.dump({
+                    'version': SESSION_VERSION, 'source': os.path.abspath(self.source),
+                    'box_extent': self.box_extent, 'frames': self.frames, 'points': self.rows}, fp)
+
+    def add(self, frame_id, xyz, velocity, corners):
+        point_box = BoxGrid(corners).assign(xyz)
+        entry = np.zeros(1, dtype=SESSION_INDEX_DTYPE)
+        entry['frame_id'] = frame_id
+        entry['offset'] = self.rows
+        entry['count'] = len(xyz)
+        entry['boxes'] = len(corners)
+        self._files['xyz.f4'].write(np.ascontiguousarray(xyz, dtype='<f4').tobytes())
+        self._files['velocity.f4'].write(np.ascontiguousarray(velocity, dtype='<f4').tobytes())
+        self._files['point_box.i4'].write(point_box.astype('<i4').tobytes())
+        self._files['index.bin'].write(entry.tobytes())
+        self.frames += 1
+        self.rows += len(xyz)
+
+
+# ==============================================================================
+# -- Scoring -------------------------------------------------------------------
+# ==============================================================================
+
+
+def frame_quality(labels, point_box, boxes, min_box_points=3):
+    """
+    Scores the cluster labels of one frame against the ground-truth box of
+    every point. Returns (clusters, hits, visible boxes, visible boxes hit).
+    """
+
+    point_box = np.asarray(point_box, dtype=np.int64)
+    visible = np.bincount(point_box[point_box >= 0], minlength=boxes) >= min_box_points
+    clustered = labels != NOISE
+    cluster_count = int(labels[clustered].max()) + 1 if clustered.any() else 0
+    if cluster_count == 0:
+        return 0, 0, int(visible.sum()), 0
+
+    # overlap of every (cluster, box) pair, box -1 collects unlabelled points
+    pairs, overlap = np.unique(
+        labels[clustered] * (boxes + 1) + point_box[clustered] + 1, return_counts=True)
+    clusters, pair_boxes = pairs // (boxes + 1), pairs % (boxes + 1) - 1
+    # majority box of every cluster
+    order = np.lexsort((-overlap, clusters))
+    _, first = np.unique(clusters[order], return_index=True)
+    majority_box = pair_boxes[order][first]
+    # one hit per box, taken by its largest cluster
+    hit_boxes = np.unique(majority_box[majority_box >= 0])
+    return cluster_count, len(hit_boxes), int(visible.sum()), int(visible[hit_boxes].sum())
+
+
+# ==============================================================================
+# -- Sweep ---------------------------------------------------------------------
+# ==============================================================================
+
+_session = None
+
+
+def _init_worker(path):
+    global _session
+    _session = SweepSession(path)
+
+
+def _run_task(task):
+    config, eps, min_samples, velocity_weight, entries, min_box_points = task
+    clustering = RadarClustering(eps, min_samples, velocity_weight)
+    totals = np.zeros(6, dtype=np.int64)  # frames, points, clusters, hits, visible, visible hit
+    start = time.process_time()
+    for entry in _session.index[entries]:
+        xyz, velocity, point_box = _session.frame(entry)
+        labels = clustering.fit(np.asarray(xyz, dtype=np.float64), np.asarray(velocity, dtype=np.float64))
+        totals[0] += 1
+        totals[1] += len(xyz)
+        totals[2:] += frame_quality(labels, point_box, int(entry['boxes']), min_box_points)
+    return config, totals, time.process_time() - start
+
+
+def sweep(session_path, configs, processes=None, frame_step=1, min_box_points=3, progress=None):
+    """
+    Runs every (eps, min_samples, velocity_weight) of configs over a
+    SweepSession in a process pool. Returns one result dict per config, in
+    configs order. cpu_seconds is the clustering and scoring time summed
+    over workers.
+    """
+
+    processes = processes or os.cpu_count() or 1
+    frames = len(SweepSession(session_path))
+    entries = np.arange(0, frames, frame_step)
+    # enough tasks to keep every process busy
+    chunks = max(1, min(len(entries), -(-2 * processes // max(len(configs), 1))))
+    tasks = [
+        (config, eps, min_samples, velocity_weight, chunk, min_box_points)
+        for config, (eps, min_samples, velocity_weight) in enumerate(configs)
+        for chunk in np.array_split(entries, chunks)]
+
+    totals = np.zeros((len(configs), 6), dtype=np.int64)
+    cpu_seconds = np.zeros(len(configs))
+    remaining = [chunks] * len(configs)
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(session_path,))
+    try:
+        for config, task_totals, seconds in pool.imap_unordered(_run_task, tasks):
+            totals[config] += task_totals
+            cpu_seconds[config] += seconds
+            remaining[config] -= 1
+            if remaining[config] == 0 and progress is not None:
+                progress(_result(configs[config], totals[config], cpu_seconds[config]))
+    finally:
+        pool.close()
+        pool.join()
+    return [_result(config, total, seconds) for config, total, seconds in zip(configs, totals, cpu_seconds)]
+
+
+def _result(config, totals, cpu_seconds):
+    frames, points, clusters, hits, visible, visible_hit = totals.tolist()
+    precision = hits / float(clusters) if clusters else 0.0
+    recall = visible_hit / float(visible) if visible else 0.0
+    return {
+        'eps': config[0],
+        'min_samples': config[1],
+        'velocity_weight': config[2],
+        'frames': frames,
+        'points': points,
+        'clusters': clusters,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2.0 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'cpu_seconds': cpu_seconds,
+        'frames_per_second': frames / cpu_seconds if cpu_seconds else 0.0,
+        'points_per_second': points / cpu_seconds if cpu_seconds else 0.0}
+
+
+def _values(text, cast):
+    return [cast(value) for value in text.split(',') if value.strip()]
+
+
+def _format(result):
+    return '  eps %5.2f  min_samples %3d  velocity_weight %5.2f  P %.3f  R %.3f  F1 %.3f  %8.1f frames/s' % (
+        result['eps'], result['min_samples'], result['velocity_weight'],
+        result['precision'], result['recall'], result['f1'], result['frames_per_second'])
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = argparser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--recording', metavar='DIR', help='binary recording (--record of radar_simulation.py)')
+    source.add_argument('--annotations', metavar='DIR', help='directory with point.json and box.json')
+    argparser.add_argument('--eps', default='1.0,1.5,2.0', help='comma separated eps values (default: %(default)s)')
+    argparser.add_argument(
+        '--min-samples', default='2,3,4', help='comma separated min_samples values (default: %(default)s)')
+    argparser.add_argument(
+        '--velocity-weight', default='0.0,0.5,1.0',
+        help='comma separated velocity weights (default: %(default)s)')
+    argparser.add_argument(
+        '--processes', default=0, type=int, help='worker processes (default: one per CPU)')
+    argparser.add_argument('--frame-step', default=1, type=int, help='use every Nth frame (default: %(default)s)')
+    argparser.add_argument(
+        '--min-box-points', default=3, type=int,
+        help='radar points for a box to count as visible (default: %(default)s)')
+    argparser.add_argument(
+        '--box-extent', default=','.join(str(v) for v in BOX_JSON_EXTENT),
+        help='half size x,y,z of box.json boxes recorded without corners (default: %(default)s)')
+    argparser.add_argument(
+        '--cache', metavar='DIR',
+        help='keep the converted session in DIR and reuse it for the same source (default: temporary)')
+    argparser.add_argument('--output', metavar='FILE', help='write results as JSON to FILE')
+    args = argparser.parse_args()
+
+    configs = list(itertools.product(
+        _values(args.eps, float), _values(args.min_samples, int), _values(args.velocity_weight, float)))
+    box_extent = None
+    if args.annotations:
+        box_extent = _values(args.box_extent, float)
+        if len(box_extent) != 3:
+            argparser.error('--box-extent needs three values')
+    cache = args.cache or tempfile.mkdtemp(prefix='cluster_sweep_')
+    try:
+        start = time.time()
+        if args.cache and SweepSession.matches(cache, args.recording or args.annotations, box_extent):
+            session = SweepSession(cache)
+        elif args.recording:
+            session = SweepSession.from_recording(args.recording, cache)
+        else:
+            session = SweepSession.from_annotations(args.annotations, cache, box_extent)
+        print('session: %d frames, %d points, loaded in %.2f s' % (
+            len(session), len(session.xyz), time.time() - start))
+
+        start = time.time()
+        results = sweep(
+            cache, configs, args.processes, args.frame_step, args.min_box_points,
+            progress=lambda result: print(_format(result)))
+        seconds = time.time() - start
+    finally:
+        if not args.cache:
+            shutil.rmtree(cache, ignore_errors=True)
+
+    print('%d configurations in %.2f s, best by F1:' % (len(configs), seconds))
+    for result in sorted(results, key=lambda result: -result['f1'])[:5]:
+        print(_format(result))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'seconds': seconds, 'results': results}, fp, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
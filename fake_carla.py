@@ -0,0 +1,995 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the carla module.
+
+Implements the part of the CARLA 0.9.x client API used by
+radar_simulation.py on top of a deterministic scenario, so the pipeline can
+run without a simulator server. Install it before importing the client:
+
+    import fake_carla
+    fake_carla.install(fake_carla.SyntheticScenario(vehicles=200))
+    import radar_simulation
+
+SyntheticScenario moves NPC vehicles and walkers on circles and fakes radar
+returns from them, and from actors spawned by the client, plus static
+clutter. Batch commands (carla.command, Client.apply_batch_sync) and walker
+AI controllers are supported for scenario_spawner.py. RecordedScenario replays radar frames
+and boxes of a radar_recording.FrameRecorder directory.
+"""
+
+import fnmatch
+import math
+import sys
+import types
+
+import numpy as np
+
+from radar_processing import transform_matrices
+
+# ==============================================================================
+# -- Geometry ------------------------------------------------------------------
+# ==============================================================================
+
+
+class Vector3D(object):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+
+    def __add__(self, other):
+        return type(self)(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return type(self)(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __repr__(self):
+        return '%s(x=%g, y=%g, z=%g)' % (type(self).__name__, self.x, self.y, self.z)
+
+
+class Location(Vector3D):
+    def distance(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+
+class Rotation(object):
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = float(pitch)
+        self.yaw = float(yaw)
+        self.roll = float(roll)
+
+    def __repr__(self):
+        return 'Rotation(pitch=%g, yaw=%g, roll=%g)' % (self.pitch, self.yaw, self.roll)
+
+
+class Transform(object):
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def get_matrix(self):
+        return transform_matrices(
+            [[self.location.x, self.location.y, self.location.z]],
+            [[self.rotation.pitch, self.rotation.yaw, self.rotation.roll]])[0]
+
+    def transform(self, vector):
+        """
+        Transforms vector in place from local to world frame.
+        """
+
+        x, y, z = np.dot(self.get_matrix(), [vector.x, vector.y, vector.z, 1.0])[:3]
+        vector.x, vector.y, vector.z = float(x), float(y), float(z)
+
+    def get_forward_vector(self):
+        return Vector3D(*self.get_matrix()[:3, 0])
+
+    def __repr__(self):
+        return 'Transform(%r, %r)' % (self.location, self.rotation)
+
+
+class BoundingBox(object):
+    def __init__(self, location, extent):
+        self.location = location
+        self.extent = extent
+
+
+class Color(object):
+    def __init__(self, r=0, g=0, b=0, a=255):
+        self.r = r
+        self.g = g
+        self.b = b
+        self.a = a
+
+
+def matrix_to_transform(matrix):
+    """
+    Returns Transform for a (4, 4) matrix built like transform_matrices.
+    """
+
+    pitch = math.degrees(math.asin(max(-1.0, min(1.0, matrix[2, 0]))))
+    yaw = math.degrees(math.atan2(matrix[1, 0], matrix[0, 0]))
+    roll = math.degrees(math.atan2(-matrix[2, 1], matrix[2, 2]))
+    return Transform(Location(*matrix[:3, 3]), Rotation(pitch, yaw, roll))
+
+
+def _transform_arrays(transform):
+    return ([transform.location.x, transform.location.y, transform.location.z],
+            [transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll])
+
+
+# ==============================================================================
+# -- Scenarios -----------------------------------------------------------------
+# ==============================================================================
+
+
+class SyntheticScenario(object):
+    """
+    NPC vehicles and walkers moving on circles around random centers, all
+    state is a function of the frame number so runs are deterministic.
+    """
+
+    def __init__(self, vehicles=50, walkers=10, radar_points=1000, clutter=0.3, area=150.0, seed=0,
+                 spawn_points=20):
+        rng = np.random.RandomState(seed)
+        count = vehicles + walkers
+        self.vehicles = vehicles
+        self.walkers = walkers
+        self.radar_points = radar_points
+        self.clutter = clutter
+        self.area = area
+        self.seed = seed
+        self.centers = np.column_stack([rng.uniform(-area, area, (count, 2)), np.zeros(count)])
+        self.radii = rng.uniform(5.0, 40.0, count)
+        speeds = np.concatenate([rng.uniform(3.0, 15.0, vehicles), rng.uniform(0.5, 2.0, walkers)])
+        self.angular_speeds = speeds / self.radii * rng.choice([-1.0, 1.0], count)
+        self.phases = rng.uniform(0.0, 2.0 * np.pi, count)
+        self.extents = np.concatenate([
+            np.column_stack([rng.uniform(1.8, 2.6, vehicles), rng.uniform(0.8, 1.1, vehicles),
+                             rng.uniform(0.7, 1.0, vehicles)]),
+            np.tile([0.3, 0.3, 0.9], (walkers, 1))]).reshape(-1, 3)
+        self.type_ids = ['vehicle.synthetic.car'] * vehicles + ['walker.pedestrian.%04d' % (i % 50) for i in range(walkers)]
+        self.role_names = ['autopilot'] * vehicles + ['pedestrian'] * walkers
+        self.spawn_points = [Transform(Location(x, y, 0.5), Rotation(yaw=yaw))
+                             for x, y, yaw in zip(rng.uniform(-area, area, spawn_points),
+                                                  rng.uniform(-area, area, spawn_points),
+                                                  rng.uniform(-180, 180, spawn_points))]
+
+    def actor_count(self):
+        return len(self.centers)
+
+    def actor_states(self, elapsed):
+        """
+        Returns (locations, rotations, velocities) arrays at elapsed seconds.
+        """
+
+        angle = self.phases + self.angular_speeds * elapsed
+        locations = self.centers.copy()
+        locations[:, 0] += self.radii * np.cos(angle)
+        locations[:, 1] += self.radii * np.sin(angle)
+        locations[:, 2] = self.extents[:, 2]
+        velocities = np.zeros_like(locations)
+        velocities[:, 0] = -self.radii * self.angular_speeds * np.sin(angle)
+        velocities[:, 1] = self.radii * self.angular_speeds * np.cos(angle)
+        rotations = np.zeros_like(locations)
+        rotations[:, 1] = np.degrees(np.arctan2(velocities[:, 1], velocities[:, 0]))
+        return locations, rotations, velocities
+
+    def radar_frame(self, frame, sensor, sensor_matrix, sensor_velocity, actor_locations, actor_velocities,
+                    actor_extents):
+        """
+        Returns (N, 4) float32 radar detections of a frame for a radar sensor.
+        """
+
+        rng = np.random.RandomState((self.seed * 1000003 + frame * 7919 + sensor.id) % (2 ** 31))
+        horizontal_fov = math.radians(float(sensor.attributes.get('horizontal_fov', 30.0))) / 2.0
+        vertical_fov = math.radians(float(sensor.attributes.get('vertical_fov', 30.0))) / 2.0
+        max_range = float(sensor.attributes.get('range', 100.0))
+        budget = int(float(sensor.attributes.get('points_per_second', 1500)) * sensor.world.settings.delta()) \
+            if self.radar_points is None else self.radar_points
+
+        world_sensor = np.linalg.inv(sensor_matrix)
+        local = np.dot(actor_locations, world_sensor[:3, :3].T) + world_sensor[:3, 3]
+        depth = np.linalg.norm(local, axis=1)
+        azimuth = np.arctan2(local[:, 1], local[:, 0])
+        altitude = np.arcsin(np.clip(local[:, 2] / np.maximum(depth, 1e-6), -1.0, 1.0))
+        visible = np.nonzero((depth < max_range) & (depth > 0.5) &
+                             (np.abs(azimuth) <= horizontal_fov) & (np.abs(altitude) <= vertical_fov))[0]
+
+        clutter_count = budget if len(visible) == 0 else int(budget * self.clutter)
+        per_actor = (budget - clutter_count) // max(1, len(visible))
+        hits = np.repeat(visible, per_actor)
+        offsets = rng.uniform(-1.0, 1.0, (len(hits), 3)) * actor_extents[hits]
+        hit_points = actor_locations[hits] + offsets
+        line_of_sight = hit_points - sensor_matrix[:3, 3]
+        line_of_sight /= np.maximum(np.linalg.norm(line_of_sight, axis=1), 1e-6)[:, np.newaxis]
+        hit_velocity = np.einsum('ij,ij->i', actor_velocities[hits] - sensor_velocity, line_of_sight)
+        hit_local = np.dot(hit_points, world_sensor[:3, :3].T) + world_sensor[:3, 3]
+
+        clutter_count = budget - len(hits)
+        clutter_azimuth = rng.uniform(-horizontal_fov, horizontal_fov, clutter_count)
+        clutter_altitude = rng.uniform(-vertical_fov, vertical_fov, clutter_count)
+        clutter_depth = rng.uniform(1.0, max_range, clutter_count)
+        forward = np.dot(sensor_matrix[:3, :3].T, sensor_velocity)
+        clutter_direction = np.column_stack([
+            np.cos(clutter_altitude) * np.cos(clutter_azimuth),
+            np.cos(clutter_altitude) * np.sin(clutter_azimuth),
+            np.sin(clutter_altitude)])
+        clutter_velocity = -np.dot(clutter_direction, forward)
+
+        points = np.empty((budget, 4), dtype=np.float32)
+        hit_depth = np.linalg.norm(hit_local, axis=1)
+        points[:len(hits), 0] = hit_velocity
+        points[:len(hits), 1] = np.arcsin(np.clip(hit_local[:, 2] / np.maximum(hit_depth, 1e-6), -1.0, 1.0))
+        points[:len(hits), 2] = np.arctan2(hit_local[:, 1], hit_local[:, 0])
+        points[:len(hits), 3] = hit_depth
+        points[len(hits):, 0] = clutter_velocity
+        points[len(hits):, 1] = clutter_altitude
+        points[len(hits):, 2] = clutter_azimuth
+        points[len(hits):, 3] = clutter_depth
+        return points, None
+
+
+class RecordedScenario(object):
+    """
+    Replays a radar_recording.FrameRecorder directory. Actors are rebuilt from
+    the recorded box corners, radar measurements are the recorded buffers
+    with their recorded sensor transforms.
+    """
+
+    def __init__(self, path):
+        from radar_recording import FrameReader
+        self.reader = FrameReader(path)
+        self.frame_ids = self.reader.frame_ids()
+        boxes = self.reader.boxes
+        self.actor_ids = np.unique(boxes['actor_id']) if len(boxes) else np.zeros(0, dtype=np.int64)
+        self.radar_points = None
+        label_of = {}
+        if len(boxes):
+            for actor_id, label_id in zip(boxes['actor_id'].tolist(), boxes['label_id'].tolist()):
+                label_of[actor_id] = label_id
+        self.role_names = [{1: 'autopilot', 2: 'pedestrian'}.get(label_of.get(i), 'npc')
+                           for i in self.actor_ids.tolist()]
+        self.type_ids = ['walker.pedestrian.0001' if name == 'pedestrian' else 'vehicle.recorded.car'
+                         for name in self.role_names]
+        self.extents = np.ones((len(self.actor_ids), 3))
+        self._last = np.zeros((len(self.actor_ids), 2, 3))
+        self.spawn_points = [Transform(Location(0.0, 0.0, 0.5))]
+        self.area = 50.0
+        self.seed = 0
+
+    def actor_count(self):
+        return len(self.actor_ids)
+
+    def recorded_frame(self, frame):
+        if len(self.frame_ids) == 0:
+            return None
+        return int(self.frame_ids[(frame - 1) % len(self.frame_ids)])
+
+    def actor_states(self, elapsed, frame=None):
+        boxes = self.reader.box_frames(self.recorded_frame(frame)) if frame is not None else self.reader.boxes[0:0]
+        rows = np.searchsorted(self.actor_ids, boxes['actor_id'])
+        corners = np.asarray(boxes['corners'], dtype=np.float64)
+        # corner order of ClientSideBoundingBoxes._create_bb_cords
+        forward = corners[:, 0] - corners[:, 1]
+        side = corners[:, 0] - corners[:, 3]
+        up = corners[:, 4] - corners[:, 0]
+        self.extents[rows] = np.column_stack([
+            np.linalg.norm(forward, axis=1), np.linalg.norm(side, axis=1), np.linalg.norm(up, axis=1)]) / 2.0
+        self._last[rows, 0] = corners.mean(axis=1)
+        self._last[rows, 1, 0] = np.degrees(np.arcsin(np.clip(
+            forward[:, 2] / np.maximum(np.linalg.norm(forward, axis=1), 1e-6), -1.0, 1.0)))
+        self._last[rows, 1, 1] = np.degrees(np.arctan2(forward[:, 1], forward[:, 0]))
+        return self._last[:, 0].copy(), self._last[:, 1].copy(), np.zeros((len(self.actor_ids), 3))
+
+    def radar_frame(self, frame, sensor, sensor_matrix, sensor_velocity, actor_locations, actor_velocities,
+                    actor_extents):
+        recorded = self.recorded_frame(frame)
+        entries = self.reader.radar_entries(recorded) if recorded is not None else []
+        for entry in entries:
+            if entry['sensor_id'] == sensor.sensor_index:
+                transform = entry['transform']
+                return np.array(self.reader.radar_points(entry)), Transform(
+                    Location(*transform[:3]), Rotation(*transform[3:]))
+        return np.zeros((0, 4), dtype=np.float32), None
+
+
+# ==============================================================================
+# -- Sensor data ---------------------------------------------------------------
+# ==============================================================================
+
+
+class SensorData(object):
+    def __init__(self, frame, timestamp, transform):
+        self.frame = frame
+        self.frame_number = frame
+        self.timestamp = timestamp
+        self.transform = transform
+
+
+class RadarDetection(object):
+    def __init__(self, velocity, altitude, azimuth, depth):
+        self.velocity = velocity
+        self.altitude = altitude
+        self.azimuth = azimuth
+        self.depth = depth
+
+
+class RadarMeasurement(SensorData):
+    def __init__(self, frame, timestamp, transform, points):
+        super(RadarMeasurement, self).__init__(frame, timestamp, transform)
+        self._points = np.ascontiguousarray(points, dtype=np.float32)
+        self.raw_data = memoryview(self._points.reshape(-1)).cast('B')
+
+    def get_detection_count(self):
+        return len(self._points)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __iter__(self):
+        for velocity, altitude, azimuth, depth in self._points.tolist():
+            yield RadarDetection(velocity, altitude, azimuth, depth)
+
+
+class Image(SensorData):
+    def __init__(self, frame, timestamp, transform, width, height, fov, raw_data):
+        super(Image, self).__init__(frame, timestamp, transform)
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.raw_data = raw_data
+
+
+# ==============================================================================
+# -- Actors --------------------------------------------------------------------
+# ==============================================================================
+
+
+class VehicleControl(object):
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False):
+        self.throttle = throttle
+        self.steer = steer
+        self.brake = brake
+        self.hand_brake = hand_brake
+        self.reverse = reverse
+
+
+class Actor(object):
+    def __init__(self, world, actor_id, type_id, attributes, bounding_box=None, parent=None):
+        self.world = world
+        self.id = actor_id
+        self.type_id = type_id
+        self.attributes = attributes
+        self.bounding_box = bounding_box if bounding_box is not None else \
+            BoundingBox(Location(), Vector3D(0.1, 0.1, 0.1))
+        self.parent = parent
+        self.is_alive = True
+
+    def get_world(self):
+        return self.world
+
+    def get_location(self):
+        return self.get_transform().location
+
+    def get_transform(self):
+        return self.world._actor_transform(self.id)
+
+    def get_velocity(self):
+        return Vector3D(*self.world._actor_velocity(self.id))
+
+    def get_angular_velocity(self):
+        return Vector3D()
+
+    def get_acceleration(self):
+        return Vector3D()
+
+    def set_autopilot(self, enabled=True, *args):
+        self.world._autopilot[self.id] = enabled
+
+    def destroy(self):
+        if not self.is_alive:
+            return False
+        self.is_alive = False
+        self.world._remove_actor(self.id)
+        return True
+
+
+class Vehicle(Actor):
+    def get_control(self):
+        return self.world._controls.setdefault(self.id, VehicleControl())
+
+    def apply_control(self, control):
+        self.world._controls[self.id] = control
+
+
+class Sensor(Actor):
+    def __init__(self, world, actor_id, type_id, attributes, relative_transform, parent):
+        super(Sensor, self).__init__(world, actor_id, type_id, attributes, parent=parent)
+        self.relative_transform = relative_transform
+        self.sensor_index = 0
+        self.callback = None
+
+    @property
+    def is_listening(self):
+        return self.callback is not None
+
+    def listen(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def destroy(self):
+        self.callback = None
+        return super(Sensor, self).destroy()
+
+
+class WalkerAIController(Actor):
+    """
+    Walks its parent walker straight towards the target location.
+    """
+
+    def start(self):
+        self.world._autopilot[self.parent.id] = True
+
+    def stop(self):
+        self.world._autopilot[self.parent.id] = False
+
+    def go_to_location(self, location):
+        walker_location = self.world._ego[self.parent.id][0]
+        self.world._ego[self.parent.id][1][1] = math.degrees(
+            math.atan2(location.y - walker_location[1], location.x - walker_location[0]))
+
+    def set_max_speed(self, speed=1.4):
+        self.world._max_speeds[self.parent.id] = float(speed)
+
+
+class ActorList(object):
+    def __init__(self, actors):
+        self._actors = list(actors)
+
+    def filter(self, wildcard_pattern):
+        return ActorList(a for a in self._actors if fnmatch.fnmatch(a.type_id, wildcard_pattern))
+
+    def find(self, actor_id):
+        for actor in self._actors:
+            if actor.id == actor_id:
+                return actor
+        return None
+
+    def __iter__(self):
+        return iter(self._actors)
+
+    def __len__(self):
+        return len(self._actors)
+
+    def __getitem__(self, index):
+        return self._actors[index]
+
+
+# ==============================================================================
+# -- Blueprints ----------------------------------------------------------------
+# ==============================================================================
+
+
+class ActorBlueprint(object):
+    def __init__(self, blueprint_id, attributes=None):
+        self.id = blueprint_id
+        self.tags = blueprint_id.split('.')
+        self.attributes = dict(attributes or {})
+
+    def has_attribute(self, name):
+        return name in self.attributes
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = str(value)
+
+    def get_attribute(self, name):
+        return self.attributes[name]
+
+
+class BlueprintLibrary(object):
+    IDS = [
+        'vehicle.synthetic.car',
+        'walker.pedestrian.0001',
+        'sensor.camera.rgb',
+        'sensor.other.radar',
+        'controller.ai.walker']
+
+    DEFAULTS = {
+        'sensor.camera.rgb': {'image_size_x': '800', 'image_size_y': '600', 'fov': '90'},
+        'sensor.other.radar': {'horizontal_fov': '30', 'vertical_fov': '30', 'range': '100',
+                               'points_per_second': '1500'}}
+
+    def find(self, blueprint_id):
+        if blueprint_id not in self.IDS:
+            raise IndexError('blueprint %r not found' % blueprint_id)
+        return ActorBlueprint(blueprint_id, self.DEFAULTS.get(blueprint_id))
+
+    def filter(self, wildcard_pattern):
+        return [self.find(i) for i in self.IDS if fnmatch.fnmatch(i, wildcard_pattern)]
+
+    def __iter__(self):
+        return iter(self.filter('*'))
+
+
+# ==============================================================================
+# -- World ---------------------------------------------------------------------
+# ==============================================================================
+
+
+class WorldSettings(object):
+    def __init__(self, synchronous_mode=False, no_rendering_mode=False, fixed_delta_seconds=None):
+        self.synchronous_mode = synchronous_mode
+        self.no_rendering_mode = no_rendering_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+
+    def delta(self):
+        return self.fixed_delta_seconds or 0.05
+
+
+class Timestamp(object):
+    def __init__(self, frame, elapsed_seconds, delta_seconds):
+        self.frame = frame
+        self.frame_count = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = elapsed_seconds
+
+
+class ActorSnapshot(object):
+    def __init__(self, actor_id, transform, velocity):
+        self.id = actor_id
+        self._transform = transform
+        self._velocity = velocity
+
+    def get_transform(self):
+        return self._transform
+
+    def get_velocity(self):
+        return self._velocity
+
+    def get_angular_velocity(self):
+        return Vector3D()
+
+    def get_acceleration(self):
+        return Vector3D()
+
+
+class WorldSnapshot(object):
+    def __init__(self, world):
+        self.id = world.id
+        self.frame = world.frame
+        self.timestamp = Timestamp(world.frame, world.elapsed, world.settings.delta())
+        self._world = world
+        self._ids = list(world._actors)
+
+    def has_actor(self, actor_id):
+        return actor_id in self._ids
+
+    def find(self, actor_id):
+        if actor_id not in self._ids:
+            return None
+        return ActorSnapshot(actor_id, self._world._actor_transform(actor_id),
+                             Vector3D(*self._world._actor_velocity(actor_id)))
+
+    def __iter__(self):
+        for actor_id in self._ids:
+            yield self.find(actor_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class DebugHelper(object):
+    def draw_point(self, location, size=0.1, color=None, life_time=-1.0, persistent_lines=True):
+        pass
+
+    def draw_line(self, begin, end, thickness=0.1, color=None, life_time=-1.0, persistent_lines=True):
+        pass
+
+
+class Map(object):
+    def __init__(self, spawn_points):
+        self.name = 'FakeTown'
+        self._spawn_points = spawn_points
+
+    def get_spawn_points(self):
+        return list(self._spawn_points)
+
+
+class World(object):
+    """
+    Synchronous world driven by a scenario. tick() advances the scenario and
+    delivers sensor data to listening sensors before it returns.
+    """
+
+    def __init__(self, scenario, image_cache=True):
+        self.id = 1
+        self.scenario = scenario
+        self.settings = WorldSettings()
+        self.debug = DebugHelper()
+        self.frame = 0
+        self.elapsed = 0.0
+        self._next_id = 100
+        self._actors = {}
+        self._rows = {}
+        self._ego = {}
+        self._controls = {}
+        self._autopilot = {}
+        self._max_speeds = {}
+        self._navigation = np.random.RandomState(scenario.seed + 1)
+        self._image_cache = {} if image_cache else None
+        self._map = Map(scenario.spawn_points)
+        self._blueprints = BlueprintLibrary()
+        self._locations, self._rotations, self._velocities = self._scenario_states()
+        for row in range(scenario.actor_count()):
+            extent = scenario.extents[row]
+            attributes = {'role_name': scenario.role_names[row]}
+            actor_class = Vehicle if scenario.type_ids[row].startswith('vehicle.') else Actor
+            actor = actor_class(self, self._new_id(), scenario.type_ids[row], attributes,
+                                BoundingBox(Location(), Vector3D(*extent)))
+            self._actors[actor.id] = actor
+            self._rows[actor.id] = row
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _scenario_states(self):
+        if isinstance(self.scenario, RecordedScenario):
+            return self.scenario.actor_states(self.elapsed, self.frame)
+        return self.scenario.actor_states(self.elapsed)
+
+    # -- client API ------------------------------------------------------------
+
+    def get_settings(self):
+        return WorldSettings(self.settings.synchronous_mode, self.settings.no_rendering_mode,
+                             self.settings.fixed_delta_seconds)
+
+    def apply_settings(self, settings):
+        self.settings = WorldSettings(settings.synchronous_mode, settings.no_rendering_mode,
+                                      settings.fixed_delta_seconds)
+        return self.frame
+
+    def get_map(self):
+        return self._map
+
+    def get_blueprint_library(self):
+        return self._blueprints
+
+    def get_snapshot(self):
+        return WorldSnapshot(self)
+
+    def get_actors(self, actor_ids=None):
+        actors = [a for a in self._actors.values() if a.is_alive]
+        if actor_ids is not None:
+            wanted = set(actor_ids)
+            actors = [a for a in actors if a.id in wanted]
+        return ActorList(actors)
+
+    def get_actor(self, actor_id):
+        return self._actors.get(actor_id)
+
+    def get_random_location_from_navigation(self):
+        x, y = self._navigation.uniform(-self.scenario.area, self.scenario.area, 2)
+        return Location(x, y, 0.5)
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        try:
+            return self.spawn_actor(blueprint, transform, attach_to)
+        except RuntimeError:
+            return None
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        attributes = dict(blueprint.attributes)
+        attributes.setdefault('role_name', 'hero' if blueprint.id.startswith('vehicle.') else '')
+        if blueprint.id.startswith('sensor.'):
+            actor = Sensor(self, self._new_id(), blueprint.id, attributes, transform, attach_to)
+            actor.sensor_index = sum(1 for a in self._actors.values()
+                                     if isinstance(a, Sensor) and a.type_id == blueprint.id)
+        elif blueprint.id.startswith('controller.'):
+            if attach_to is None or attach_to.id not in self._ego:
+                raise RuntimeError('a walker controller must be attached to a spawned walker')
+            actor = WalkerAIController(self, self._new_id(), blueprint.id, attributes, parent=attach_to)
+        else:
+            locations, rotations = _transform_arrays(transform)
+            for location, _, _ in self._ego.values():
+                if np.linalg.norm(location[:2] - locations[:2]) < 1.0:
+                    raise RuntimeError('Spawn failed because of collision at spawn position')
+            actor_class = Vehicle if blueprint.id.startswith('vehicle.') else Actor
+            extent = Vector3D(2.4, 1.0, 0.8) if actor_class is Vehicle else Vector3D(0.3, 0.3, 0.9)
+            actor = actor_class(self, self._new_id(), blueprint.id, attributes,
+                                BoundingBox(Location(z=extent.z), extent))
+            self._ego[actor.id] = [np.array(locations), np.array(rotations), np.zeros(3)]
+        self._actors[actor.id] = actor
+        return actor
+
+    def wait_for_tick(self, seconds=10.0):
+        return self.get_snapshot()
+
+    def tick(self, seconds=10.0):
+        delta = self.settings.delta()
+        self.frame += 1
+        self.elapsed += delta
+        self._locations, self._rotations, self._velocities = self._scenario_states()
+        self._move_controlled(delta)
+        self._emit_sensor_data()
+        return self.frame
+
+    # -- internals -------------------------------------------------------------
+
+    def _remove_actor(self, actor_id):
+        self._actors.pop(actor_id, None)
+        self._rows.pop(actor_id, None)
+        self._ego.pop(actor_id, None)
+        self._autopilot.pop(actor_id, None)
+        self._max_speeds.pop(actor_id, None)
+
+    def _move_controlled(self, delta):
+        for actor_id, (location, rotation, velocity) in self._ego.items():
+            control = self._controls.get(actor_id)
+            speed = self._max_speeds.get(actor_id, 10.0) if self._autopilot.get(actor_id) else 0.0
+            if control is not None and control.throttle:
+                speed = 15.0 * control.throttle * (-1.0 if control.reverse else 1.0)
+                rotation[1] += 30.0 * control.steer * delta
+            yaw = math.radians(rotation[1])
+            velocity[:] = (speed * math.cos(yaw), speed * math.sin(yaw), 0.0)
+            location += velocity * delta
+
+    def _actor_matrix(self, actor_id):
+        actor = self._actors[actor_id]
+        if isinstance(actor, WalkerAIController):
+            return self._actor_matrix(actor.parent.id)
+        if isinstance(actor, Sensor):
+            relative = actor.relative_transform.get_matrix()
+            if actor.parent is None:
+                return relative
+            return np.dot(self._actor_matrix(actor.parent.id), relative)
+        if actor_id in self._ego:
+            location, rotation, _ = self._ego[actor_id]
+            return transform_matrices([location], [rotation])[0]
+        row = self._rows[actor_id]
+        return transform_matrices(self._locations[row:row + 1], self._rotations[row:row + 1])[0]
+
+    def _actor_transform(self, actor_id):
+        if actor_id in self._rows:
+            row = self._rows[actor_id]
+            return Transform(Location(*self._locations[row]), Rotation(*self._rotations[row]))
+        if actor_id in self._ego:
+            location, rotation, _ = self._ego[actor_id]
+            return Transform(Location(*location), Rotation(*rotation))
+        return matrix_to_transform(self._actor_matrix(actor_id))
+
+    def _actor_velocity(self, actor_id):
+        if actor_id in self._rows:
+            return self._velocities[self._rows[actor_id]]
+        if actor_id in self._ego:
+            return self._ego[actor_id][2]
+        actor = self._actors[actor_id]
+        if isinstance(actor, (Sensor, WalkerAIController)) and actor.parent is not None:
+            return self._actor_velocity(actor.parent.id)
+        return np.zeros(3)
+
+    def _emit_sensor_data(self):
+        sensors = [a for a in self._actors.values() if isinstance(a, Sensor) and a.is_listening]
+        for sensor in sensors:
+            matrix = self._actor_matrix(sensor.id)
+            transform = matrix_to_transform(matrix)
+            if sensor.type_id == 'sensor.other.radar':
+                locations, velocities, extents = self._radar_targets(sensor)
+                points, recorded_transform = self.scenario.radar_frame(
+                    self.frame, sensor, matrix, np.asarray(self._actor_velocity(sensor.id)),
+                    locations, velocities, extents)
+                data = RadarMeasurement(self.frame, self.elapsed, recorded_transform or transform, points)
+            elif sensor.type_id.startswith('sensor.camera.'):
+                width = int(sensor.attributes.get('image_size_x', 800))
+                height = int(sensor.attributes.get('image_size_y', 600))
+                data = Image(self.frame, self.elapsed, transform, width, height,
+                             float(sensor.attributes.get('fov', 90)), self._image_buffer(width, height))
+            else:
+                continue
+            if sensor.callback is not None:
+                sensor.callback(data)
+
+    def _radar_targets(self, sensor):
+        """
+        Returns box centers, velocities and extents of the scenario actors
+        and of the actors spawned by the client, except the one carrying the
+        sensor.
+        """
+
+        rows = sorted(self._rows.values())
+        carrier = sensor
+        while carrier.parent is not None:
+            carrier = carrier.parent
+        spawned = [self._actors[actor_id] for actor_id in self._ego if actor_id != carrier.id]
+        if not spawned:
+            return self._locations[rows], self._velocities[rows], self.scenario.extents[rows]
+        locations = np.array([self._ego[actor.id][0] for actor in spawned])
+        locations[:, 2] += [actor.bounding_box.location.z for actor in spawned]
+        extents = [[actor.bounding_box.extent.x, actor.bounding_box.extent.y, actor.bounding_box.extent.z]
+                   for actor in spawned]
+        return (np.concatenate([self._locations[rows], locations]),
+                np.concatenate([self._velocities[rows], [self._ego[actor.id][2] for actor in spawned]]),
+                np.concatenate([self.scenario.extents[rows], extents]))
+
+    def _image_buffer(self, width, height):
+        key = (width, height)
+        if self._image_cache is not None and key in self._image_cache:
+            return self._image_cache[key]
+        image = np.empty((height, width, 4), dtype=np.uint8)
+        image[:, :, 0] = np.linspace(64, 192, width, dtype=np.uint8)[np.newaxis, :]
+        image[:, :, 1] = np.linspace(64, 192, height, dtype=np.uint8)[:, np.newaxis]
+        image[:, :, 2] = 96
+        image[:, :, 3] = 255
+        buffer = image.tobytes()
+        if self._image_cache is not None:
+            self._image_cache[key] = buffer
+        return buffer
+
+
+# ==============================================================================
+# -- Commands ------------------------------------------------------------------
+# ==============================================================================
+
+
+class _FutureActor(object):
+    def __repr__(self):
+        return 'FutureActor'
+
+
+class SpawnActor(object):
+    def __init__(self, blueprint, transform, parent=None):
+        # blueprints are taken by value, like in the C++ API
+        self.blueprint = ActorBlueprint(blueprint.id, blueprint.attributes)
+        self.transform = transform
+        self.parent = parent
+        self.commands = []
+
+    def then(self, command):
+        self.commands.append(command)
+        return self
+
+
+class DestroyActor(object):
+    def __init__(self, actor):
+        self.actor_id = getattr(actor, 'id', actor)
+
+
+class SetAutopilot(object):
+    def __init__(self, actor, enabled, tm_port=8000):
+        self.actor_id = getattr(actor, 'id', actor)
+        self.enabled = enabled
+        self.tm_port = tm_port
+
+
+class Response(object):
+    def __init__(self, actor_id=0, error=''):
+        self.actor_id = actor_id
+        self.error = error
+
+    def has_error(self):
+        return bool(self.error)
+
+
+command = types.ModuleType('carla.command')
+command.FutureActor = _FutureActor()
+command.SpawnActor = SpawnActor
+command.DestroyActor = DestroyActor
+command.SetAutopilot = SetAutopilot
+command.Response = Response
+
+
+def _apply_command(world, batch_command, future=0):
+    if isinstance(batch_command, SpawnActor):
+        parent = batch_command.parent
+        if parent is not None and not isinstance(parent, Actor):
+            parent = world.get_actor(parent)
+        try:
+            actor = world.spawn_actor(batch_command.blueprint, batch_command.transform, parent)
+        except RuntimeError as error:
+            return Response(0, str(error))
+        for then in batch_command.commands:
+            response = _apply_command(world, then, actor.id)
+            if response.error:
+                return Response(actor.id, response.error)
+        return Response(actor.id)
+    actor_id = future if batch_command.actor_id is command.FutureActor else batch_command.actor_id
+    actor = world.get_actor(actor_id)
+    if actor is None:
+        return Response(actor_id, 'actor %s not found' % actor_id)
+    if isinstance(batch_command, DestroyActor):
+        if not actor.destroy():
+            return Response(actor_id, 'actor %s already destroyed' % actor_id)
+    elif isinstance(batch_command, SetAutopilot):
+        actor.set_autopilot(batch_command.enabled, batch_command.tm_port)
+    return Response(actor_id)
+
+
+# ==============================================================================
+# -- Client --------------------------------------------------------------------
+# ==============================================================================
+
+
+_scenario = None
+_world = None
+_traffic_managers = {}
+
+
+class TrafficManager(object):
+    def __init__(self, port):
+        self.port = port
+        self.synchronous_mode = False
+
+    def get_port(self):
+        return self.port
+
+    def set_synchronous_mode(self, mode=True):
+        self.synchronous_mode = mode
+
+
+class Client(object):
+    def __init__(self, host='127.0.0.1', port=2000, worker_threads=0):
+        self.host = host
+        self.port = port
+        self.timeout = 2.0
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def get_client_version(self):
+        return '0.9.8-fake'
+
+    def get_server_version(self):
+        return '0.9.8-fake'
+
+    def get_world(self):
+        global _world
+        if _world is None:
+            _world = World(_scenario if _scenario is not None else SyntheticScenario())
+        return _world
+
+    def get_trafficmanager(self, client_connection=8000):
+        if client_connection not in _traffic_managers:
+            _traffic_managers[client_connection] = TrafficManager(client_connection)
+        return _traffic_managers[client_connection]
+
+    def apply_batch(self, commands):
+        self.apply_batch_sync(commands)
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        """
+        Executes the commands in order and returns one Response per command,
+        ticking the world afterwards if do_tick.
+        """
+
+        world = self.get_world()
+        responses = [_apply_command(world, batch_command) for batch_command in commands]
+        if do_tick:
+            world.tick()
+        return responses
+
+
+def load_scenario(scenario):
+    """
+    Sets the scenario served to new clients and drops the current world.
+    """
+
+    global _scenario, _world
+    _scenario = scenario
+    _world = None
+    _traffic_managers.clear()
+
+
+def install(scenario=None):
+    """
+    Registers this module as 'carla' in sys.modules. Must run before the
+    client script imports carla.
+    """
+
+    load_scenario(scenario)
+    sys.modules['carla'] = sys.modules[__name__]
+    sys.modules['carla.command'] = command
+    return sys.modules[__name__]
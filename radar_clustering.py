@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+"""
+Density based clustering of radar detections.
+
+RadarClustering is a DBSCAN over detection position and (weighted) radial
+velocity. Neighbours are looked up in a uniform spatial-hash grid with
+cell size eps, so a frame costs roughly O(N) instead of O(N^2).
+
+ClusterTracker gives clusters stable ids across frames with a constant
+velocity Kalman filter per track.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+from radar_processing import RadarPoints
+from radar_processing import VELOCITY
+
+NOISE = -1
+
+# labels: (N,) cluster index per point, NOISE for unclustered points
+# centroids, extents: (K, 3) mean position and half size per cluster
+# velocities: (K,) mean radial velocity, counts: (K,) points per cluster
+ClusterResult = collections.namedtuple(
+    'ClusterResult', ['labels', 'centroids', 'extents', 'velocities', 'counts'])
+
+# ids, positions, velocities: (M,) and (M, 3) of the confirmed tracks
+# cluster_track_ids: (K,) track id of every cluster of the frame, -1 if none
+TrackResult = collections.namedtuple(
+    'TrackResult', ['ids', 'positions', 'velocities', 'cluster_track_ids'])
+
+# the 27 cells around and including a cell
+_NEIGHBOUR_OFFSETS = np.array(
+    [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)], dtype=np.int64)
+
+# ==============================================================================
+# -- RadarClustering -----------------------------------------------------------
+# ==============================================================================
+
+
+class RadarClustering(object):
+    """
+    Grid accelerated DBSCAN for one radar frame.
+
+    Two detections are neighbours if
+        |p_i - p_j|^2 + (velocity_weight * (v_i - v_j))^2 <= eps^2
+    and a detection is a core point if it has at least min_samples
+    neighbours, itself included.
+    """
+
+    def __init__(self, eps=1.5, min_samples=3, velocity_weight=0.5):
+        self.eps = float(eps)
+        self.min_samples = int(min_samples)
+        self.velocity_weight = float(velocity_weight)
+
+    def cluster(self, points, xyz=None, mask=None):
+        """
+        Clusters (N, 4) radar points. xyz are (N, 3) cartesian positions of
+        the points in any frame, sensor frame positions are computed if not
+        given. If mask is given only those points are clustered, the others
+        are labelled NOISE. Returns ClusterResult with statistics in the
+        frame of xyz.
+        """
+
+        points = np.asarray(points)
+        if xyz is None:
+            xyz = RadarPoints.to_sensor(points)
+        xyz = np.asarray(xyz, dtype=np.float64)
+        velocity = points[:, VELOCITY].astype(np.float64)
+        if mask is None:
+            labels = self.fit(xyz, velocity)
+        else:
+            labels = np.full(len(xyz), NOISE, dtype=np.int64)
+            labels[mask] = self.fit(xyz[mask], velocity[mask])
+        return self.summarize(labels, xyz, velocity)
+
+    def fit(self, xyz, velocity):
+        """
+        Returns (N,) cluster labels for positions and radial velocities.
+        """
+
+        count = len(xyz)
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+        features = np.column_stack([xyz, self.velocity_weight * velocity])
+
+        first, second = self.neighbour_pairs(xyz, self.eps)
+        delta = features[first] - features[second]
+        close = np.einsum('ij,ij->i', delta, delta) <= self.eps * self.eps
+        first, second = first[close], second[close]
+
+        core = np.bincount(first, minlength=count) >= self.min_samples
+        core_pair = core[first] & core[second]
+        labels = self._connected_components(count, first[core_pair], second[core_pair])
+        labels[~core] = NOISE
+
+        # border points join the cluster of one of their core neighbours
+        border_pair = ~core[first] & core[second]
+        labels[first[border_pair]] = labels[second[border_pair]]
+
+        clustered = labels != NOISE
+        labels[clustered] = np.unique(labels[clustered], return_inverse=True)[1]
+        return labels
+
+    @staticmethod
+    def neighbour_pairs(xyz, cell_size, others=None):
+        """
+        Returns index arrays (first, second) of all point pairs, self pairs
+        included, that share a grid cell or lie in adjacent cells. If others
+        is given, first indexes xyz and second others instead; others are
+        entered in all 27 cells around them, so every point of xyz needs a
+        single lookup, which pays off when others is the smaller set.
+        """
+
+        cells = np.floor(xyz / cell_size).astype(np.int64)
+        other_cells = cells if others is None else np.floor(others / cell_size).astype(np.int64)
+        origin = np.minimum(cells.min(axis=0), other_cells.min(axis=0))
+        # +1 border on each side so neighbour offsets never wrap
+        dims = np.maximum(cells.max(axis=0), other_cells.max(axis=0)) - origin + 3
+        strides = np.array([dims[1] * dims[2], dims[2], 1], dtype=np.int64)
+        keys = np.dot(cells - origin + 1, strides)
+        offsets = np.dot(_NEIGHBOUR_OFFSETS, strides)
+
+        if others is not None:
+            other_keys = (np.dot(other_cells - origin + 1, strides)[:, np.newaxis] + offsets).ravel()
+            order = np.argsort(other_keys, kind='stable')
+            other_keys = other_keys[order]
+            starts = np.searchsorted(other_keys, keys, side='left')
+            counts = np.searchsorted(other_keys, keys, side='right') - starts
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            return np.repeat(np.arange(len(keys)), counts), \
+                order[np.repeat(starts, counts) + within] // len(offsets)
+
+        order = np.argsort(keys, kind='stable')
+        cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+        first, second = [], []
+        for offset in offsets:
+            neighbour_keys = keys + offset
+            pos = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+            found = np.nonzero(cell_keys[pos] == neighbour_keys)[0]
+            if len(found) == 0:
+                continue
+            starts = cell_starts[pos[found]]
+            counts = cell_counts[pos[found]]
+            total = counts.sum()
+            # position inside the neighbour cell for every generated pair
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            first.append(np.repeat(found, counts))
+            second.append(order[np.repeat(starts, counts) + within])
+        return np.concatenate(first), np.concatenate(second)
+
+    @staticmethod
+    def _connected_components(count, first, second):
+        """
+        Labels every node with the smallest node index of its component, edges
+        must be symmetric.
+        """
+
+        labels = np.arange(count)
+        while True:
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, first, labels[second])
+            new_labels = new_labels[new_labels]
+            if np.array_equal(new_labels, labels):
+                return labels
+            labels = new_labels
+
+    @staticmethod
+    def summarize(labels, xyz, velocity):
+        """
+        Returns ClusterResult with per-cluster centroid, extent, mean
+        velocity and point count.
+        """
+
+        clustered = labels != NOISE
+        members = labels[clustered]
+        cluster_count = int(members.max()) + 1 if len(members) else 0
+        counts = np.bincount(members, minlength=cluster_count)
+        if cluster_count == 0:
+            return ClusterResult(labels, np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0), counts)
+        member_xyz = xyz[clustered]
+        centroids = np.column_stack(
+            [np.bincount(members, weights=member_xyz[:, axis], minlength=cluster_count) for axis in range(3)])
+        centroids /= counts[:, np.newaxis]
+        mins = np.full((cluster_count, 3), np.inf)
+        maxs = np.full((cluster_count, 3), -np.inf)
+        np.minimum.at(mins, members, member_xyz)
+        np.maximum.at(maxs, members, member_xyz)
+        velocities = np.bincount(members, weights=velocity[clustered], minlength=cluster_count) / counts
+        return ClusterResult(labels, centroids, (maxs - mins) / 2.0, velocities, counts)
+
+
+# ==============================================================================
+# -- ClusterTracker ------------------------------------------------------------
+# ==============================================================================
+
+
+class ClusterTracker(object):
+    """
+    Multi-frame tracker of radar clusters.
+
+    Track state (position, velocity) and covariance live in contiguous
+    (M, 6) and (M, 6, 6) arrays. Every frame all tracks are predicted at once,
+    clusters are associated with a gated Mahalanobis cost matrix and a greedy
+    assignment, and tracks missed more than max_misses frames are retired.
+
+    step() also warm-starts clustering: between full frames (every
+    full_every frames, or when there are no tracks) only points within
+    seed_radius of a predicted track position are clustered.
+    """
+
+    # chi-square 99% quantile for 3 degrees of freedom
+    GATE = 11.34
+
+    def __init__(self, clustering=None, max_misses=3, min_hits=2, gate=GATE,
+                 process_noise=2.0, measurement_noise=0.5, seed_radius=4.0, full_every=5):
+        self.clustering = clustering if clustering is not None else RadarClustering()
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.gate = gate
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.seed_radius = seed_radius
+        self.full_every = max(1, full_every)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.state = np.zeros((0, 6))
+        self.covariance = np.zeros((0, 6, 6))
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        self.last_timestamp = None
+        self.frames = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def step(self, points, xyz, timestamp):
+        """
+        Clusters one frame, seeded by the predicted tracks, and updates the
+        tracks. Returns (ClusterResult, TrackResult).
+        """
+
+        with self._lock:
+            mask = None
+            if len(self.ids) and self.frames % self.full_every:
+                mask = self.near_predictions(xyz, timestamp)
+            clusters = self.clustering.cluster(points, xyz, mask)
+            return clusters, self._update(clusters, timestamp)
+
+    def update(self, clusters, timestamp):
+        """
+        Updates the tracks with the clusters of one frame, timestamp is in
+        seconds. Returns TrackResult.
+        """
+
+        with self._lock:
+            return self._update(clusters, timestamp)
+
+    def near_predictions(self, xyz, timestamp):
+        """
+        Returns (N,) mask of points within seed_radius of a predicted track.
+        Predictions are hashed into a grid of seed_radius cells, so only
+        points and tracks of adjacent cells are compared.
+        """
+
+        dt = 0.0 if self.last_timestamp is None else max(0.0, timestamp - self.last_timestamp)
+        predicted = self.state[:, :3] + dt * self.state[:, 3:]
+        xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        mask = np.zeros(len(xyz), dtype=bool)
+        if len(xyz) == 0 or len(predicted) == 0:
+            return mask
+        points, tracks = RadarClustering.neighbour_pairs(xyz, self.seed_radius, predicted)
+        delta = xyz[points] - predicted[tracks]
+        mask[points[np.einsum('ij,ij->i', delta, delta) <= self.seed_radius ** 2]] = True
+        return mask
+
+    def _update(self, clusters, timestamp):
+        dt = 0.0 if self.last_timestamp is None else max(0.0, timestamp - self.last_timestamp)
+        self.last_timestamp = timestamp
+        self.frames += 1
+        self._predict(dt)
+
+        measurements = clusters.centroids
+        track_rows, cluster_rows = self._associate(measurements)
+        if len(track_rows):
+            self._correct(track_rows, measurements[cluster_rows])
+
+        missed = np.ones(len(self.ids), dtype=bool)
+        missed[track_rows] = False
+        self.misses[missed] += 1
+        self.misses[track_rows] = 0
+        self.hits[track_rows] += 1
+
+        cluster_track_ids = np.full(len(measurements), -1, dtype=np.int64)
+        cluster_track_ids[cluster_rows] = self.ids[track_rows]
+        new = np.ones(len(measurements), dtype=bool)
+        new[cluster_rows] = False
+        cluster_track_ids[new] = self._spawn(measurements[new])
+
+        self._retire()
+        confirmed = self.hits >= self.min_hits
+        cluster_track_ids[~np.isin(cluster_track_ids, self.ids[confirmed])] = -1
+        return TrackResult(
+            self.ids[confirmed].copy(), self.state[confirmed, :3].copy(),
+            self.state[confirmed, 3:].copy(), cluster_track_ids)
+
+    def _predict(self, dt):
+        if len(self.ids) == 0 or dt == 0.0:
+            return
+        transition = np.identity(6)
+        transition[:3, 3:] = dt * np.identity(3)
+        noise = np.zeros((6, 6))
+        noise[:3, :3] = dt ** 3 / 3.0 * np.identity(3)
+        noise[:3, 3:] = noise[3:, :3] = dt ** 2 / 2.0 * np.identity(3)
+        noise[3:, 3:] = dt * np.identity(3)
+        self.state = np.dot(self.state, transition.T)
+        self.covariance = np.matmul(np.matmul(transition, self.covariance), transition.T) + \
+            self.process_noise * noise
+
+    def _innovation_inverse(self):
+        innovation = self.covariance[:, :3, :3] + self.measurement_noise * np.identity(3)
+        return np.linalg.inv(innovation)
+
+    def _associate(self, measurements):
+        """
+        Returns matched (track_rows, cluster_rows) index arrays.
+        """
+
+        empty = np.zeros(0, dtype=np.int64)
+        if len(self.ids) == 0 or len(measurements) == 0:
+            return empty, empty
+        inverse = self._innovation_inverse()
+        residual = measurements[np.newaxis, :, :] - self.state[:, np.newaxis, :3]
+        cost = np.einsum('tki,tij,tkj->tk', residual, inverse, residual)
+        tracks, candidates = np.nonzero(cost <= self.gate)
+        return greedy_assignment(tracks, candidates, cost[tracks, candidates], len(self.ids), len(measurements))
+
+    def _correct(self, rows, measurements):
+        covariance = self.covariance[rows]
+        inverse = self._innovation_inverse()[rows]
+        gain = np.matmul(covariance[:, :, :3], inverse)
+        residual = measurements - self.state[rows, :3]
+        self.state[rows] += np.einsum('tij,tj->ti', gain, residual)
+        self.covariance[rows] = covariance - np.matmul(gain, covariance[:, :3, :])
+
+    def _spawn(self, measurements):
+        count = len(measurements)
+        ids = np.arange(self._next_id, self._next_id + count, dtype=np.int64)
+        self._next_id += count
+        state = np.zeros((count, 6))
+        state[:, :3] = measurements
+        covariance = np.zeros((count, 6, 6))
+        covariance[:, :3, :3] = self.measurement_noise * np.identity(3)
+        covariance[:, 3:, 3:] = 25.0 * np.identity(3)
+        self.ids = np.concatenate([self.ids, ids])
+        self.state = np.concatenate([self.state, state])
+        self.covariance = np.concatenate([self.covariance, covariance])
+        self.hits = np.concatenate([self.hits, np.ones(count, dtype=np.int64)])
+        self.misses = np.concatenate([self.misses, np.zeros(count, dtype=np.int64)])
+        return ids
+
+    def _retire(self):
+        alive = self.misses <= self.max_misses
+        if np.all(alive):
+            return
+        self.ids = self.ids[alive]
+        self.state = self.state[alive]
+        self.covariance = self.covariance[alive]
+        self.hits = self.hits[alive]
+        self.misses = self.misses[alive]
+
+
+def greedy_assignment(rows, cols, costs, row_count, col_count):
+    """
+    Greedy assignment over gated (row, col) pairs in increasing cost: a
+    pair is taken if neither its row nor its col is taken yet. Rows are in
+    range(row_count) and cols in range(col_count). Returns matched
+    (rows, cols) index arrays.
+    """
+
+    order = np.argsort(costs, kind='stable')
+    used_rows = np.zeros(row_count, dtype=bool)
+    used_cols = np.zeros(col_count, dtype=bool)
+    matched_rows, matched_cols = [], []
+    for row, col in zip(np.asarray(rows)[order].tolist(), np.asarray(cols)[order].tolist()):
+        if used_rows[row] or used_cols[col]:
+            continue
+        used_rows[row] = used_cols[col] = True
+        matched_rows.append(row)
+        matched_cols.append(col)
+    return np.array(matched_rows, dtype=np.int64), np.array(matched_cols, dtype=np.int64)
+
+
+def track_recording(reader, tracker, frame_period=0.05, start=None, stop=None):
+    """
+    Runs a ClusterTracker over a radar_recording.FrameReader. All radar
+    measurements of a frame are fused in world frame before clustering.
+    Yields (frame_id, ClusterResult, TrackResult) per frame.
+    """
+
+    for frame_id, points, xyz, _, _ in reader.world_frames(start, stop):
+        clusters, tracks = tracker.step(points, xyz, frame_id * frame_period)
+        yield frame_id, clusters, tracks
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+"""
+Streaming evaluation of radar clustering against ground-truth boxes.
+
+ClusterEvaluator takes one frame at a time: the fused radar cloud, its
+clusters and the ground-truth boxes of the frame (the corners of
+ClientSideBoundingBoxes._create_bb_cords in world frame). Clusters are
+matched to boxes with a gated cost matrix of centroid distance and
+bird's-eye-view IoU, cut to the max_candidates cheapest boxes per cluster,
+and a greedy assignment. Metrics are accumulated in fixed-size histograms,
+so memory does not grow with the length of the session.
+
+    precision         matched clusters / clusters
+    recall            visible boxes matched / visible boxes, a box is
+                      visible with at least min_box_points radar points
+    centroid error    BEV distance of matched cluster centroid and box center
+    velocity error    matched cluster radial velocity against the radial
+                      velocity of the box relative to the sensor, box and
+                      sensor velocities come from consecutive frames
+    latency           per-frame processing time given to update
+
+Run over a binary recording (clusters are recomputed, latency is the
+clustering time) or the annotations of a run:
+
+    python radar_evaluation.py --recording DIR --eps 1.5 --min-samples 3
+    python radar_evaluation.py --annotations output --recorded-clusters
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+
+from radar_clustering import ClusterResult
+from radar_clustering import RadarClustering
+from radar_clustering import greedy_assignment
+from radar_processing import BoxGrid
+from radar_recording import FrameReader
+from radar_recording import annotation_frames
+from radar_recording import box_json_corners
+
+# counts of one frame, errors are (matches,) arrays, nan for no ground truth
+FrameMetrics = collections.namedtuple('FrameMetrics', [
+    'frame_id', 'clusters', 'boxes', 'visible', 'matches', 'visible_matches',
+    'centroid_errors', 'velocity_errors', 'latency'])
+
+# ==============================================================================
+# -- StreamingStats ------------------------------------------------------------
+# ==============================================================================
+
+
+class StreamingStats(object):
+    """
+    Count, mean, RMS, extremes and a log-spaced histogram of a stream of
+    non-negative values. Percentiles are read from the histogram and are
+    exact to one bin, about 6% with the default bins.
+    """
+
+    def __init__(self, low=1e-4, high=1e4, bins=320):
+        self.edges = np.geomspace(low, high, bins + 1)
+        self.histogram = np.zeros(bins + 2, dtype=np.int64)  # under- and overflow bins
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += values.sum()
+        self.total_sq += np.dot(values, values)
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self.histogram += np.bincount(np.searchsorted(self.edges, values), minlength=len(self.histogram))
+
+    def percentile(self, q):
+        """
+        Returns the upper edge of the bin holding the q-th percentile.
+        """
+
+        if self.count == 0:
+            return None
+        rank = np.searchsorted(np.cumsum(self.histogram), q / 100.0 * self.count)
+        if rank == 0:
+            return min(self.edges[0], self.maximum)
+        if rank > len(self.edges) - 1:
+            return self.maximum
+        return min(self.edges[rank], self.maximum)
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'rms': (self.total_sq / self.count) ** 0.5,
+            'min': self.minimum,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.maximum}
+
+
+# ==============================================================================
+# -- ClusterEvaluator ----------------------------------------------------------
+# ==============================================================================
+
+
+class ClusterEvaluator(object):
+    """
+    Accumulates clustering metrics over a stream of frames, see the module
+    docstring. Frames must come in increasing frame_id order for the
+    velocity ground truth; frame_period is the simulation step in seconds.
+    """
+
+    def __init__(self, max_distance=2.5, min_iou=0.1, max_candidates=8, min_box_points=3,
+                 frame_period=0.05, max_cells=1 << 20):
+        self.max_distance = max_distance
+        self.min_iou = min_iou
+        self.max_candidates = max_candidates
+        self.min_box_points = min_box_points
+        self.frame_period = frame_period
+        self.max_cells = max_cells
+        self.frames = 0
+        self.clusters = 0
+        self.boxes = 0
+        self.visible = 0
+        self.matches = 0
+        self.visible_matches = 0
+        self.centroid_error = StreamingStats()
+        self.velocity_error = StreamingStats()
+        self.latency = StreamingStats()  # milliseconds
+        # (frame_id, sorted actor ids, their box centers, sensor location)
+        self._previous = None
+
+    def match(self, centroids, extents, box_centers, box_mins, box_maxs):
+        """
+        Returns matched (cluster_rows, box_rows). Clusters are (K, 3)
+        centroids and half sizes, boxes (M, 3) centers and world frame
+        bounds. The (K, M) cost matrix is built in blocks of at most
+        max_cells entries.
+        """
+
+        empty = np.zeros(0, dtype=np.int64)
+        if len(centroids) == 0 or len(box_centers) == 0:
+            return empty, empty
+        cluster_mins = centroids[:, :2] - extents[:, :2]
+        cluster_maxs = centroids[:, :2] + extents[:, :2]
+        cluster_areas = np.prod(cluster_maxs - cluster_mins, axis=1)
+        box_areas = np.prod(box_maxs[:, :2] - box_mins[:, :2], axis=1)
+        candidates = min(self.max_candidates, len(box_centers))
+
+        rows, cols, costs = [], [], []
+        block = max(1, self.max_cells // len(box_centers))
+        for begin in range(0, len(centroids), block):
+            end = begin + block
+            delta = centroids[begin:end, np.newaxis, :2] - box_centers[np.newaxis, :, :2]
+            distance = np.sqrt(np.einsum('kmi,kmi->km', delta, delta))
+            low = np.maximum(cluster_mins[begin:end, np.newaxis, :], box_mins[np.newaxis, :, :2])
+            high = np.minimum(cluster_maxs[begin:end, np.newaxis, :], box_maxs[np.newaxis, :, :2])
+            intersection = np.prod(np.clip(high - low, 0.0, None), axis=2)
+            union = cluster_areas[begin:end, np.newaxis] + box_areas[np.newaxis, :] - intersection
+            iou = intersection / np.maximum(union, 1e-9)
+            cost = distance / self.max_distance + (1.0 - iou)
+            cost[(distance > self.max_distance) & (iou < self.min_iou)] = np.inf
+            # only the cheapest boxes of every cluster enter the assignment
+            keep = np.argpartition(cost, candidates - 1, axis=1)[:, :candidates]
+            kept = np.take_along_axis(cost, keep, axis=1)
+            block_rows, block_keep = np.nonzero(np.isfinite(kept))
+            rows.append(block_rows + begin)
+            cols.append(keep[block_rows, block_keep])
+            costs.append(kept[block_rows, block_keep])
+        return greedy_assignment(
+            np.concatenate(rows), np.concatenate(cols), np.concatenate(costs), len(centroids), len(box_centers))
+
+    def update(self, frame_id, xyz, clusters, corners, actor_ids=None, sensor_location=None, latency=None):
+        """
+        Scores one frame. xyz are the (N, 3) world frame radar points,
+        clusters a ClusterResult in world frame, corners the (M, 8, 3) boxes
+        and actor_ids their actors. latency is in seconds. Returns
+        FrameMetrics.
+        """
+
+        corners = np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3)
+        box_centers = corners.mean(axis=1)
+        point_box = BoxGrid(corners).assign(xyz)
+        visible = np.bincount(point_box[point_box >= 0], minlength=len(corners)) >= self.min_box_points
+
+        centroids = np.asarray(clusters.centroids, dtype=np.float64).reshape(-1, 3)
+        cluster_rows, box_rows = self.match(
+            centroids, np.asarray(clusters.extents, dtype=np.float64).reshape(-1, 3),
+            box_centers, corners.min(axis=1), corners.max(axis=1))
+        delta = centroids[cluster_rows, :2] - box_centers[box_rows, :2]
+        centroid_errors = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+
+        radial = self._radial_velocities(frame_id, box_centers, actor_ids, sensor_location)[box_rows]
+        velocity_errors = np.abs(np.asarray(clusters.velocities, dtype=np.float64)[cluster_rows] - radial)
+
+        metrics = FrameMetrics(
+            frame_id, len(centroids), len(corners), int(visible.sum()), len(cluster_rows),
+            int(visible[box_rows].sum()), centroid_errors, velocity_errors, latency)
+        self.frames += 1
+        self.clusters += metrics.clusters
+        self.boxes += metrics.boxes
+        self.visible += metrics.visible
+        self.matches += metrics.matches
+        self.visible_matches += metrics.visible_matches
+        self.centroid_error.add(centroid_errors)
+        self.velocity_error.add(velocity_errors)
+        if latency is not None:
+            self.latency.add([latency * 1000.0])
+        return metrics
+
+    def _radial_velocities(self, frame_id, box_centers, actor_ids, sensor_location):
+        """
+        Returns (M,) radial velocity of every box relative to the sensor,
+        nan where the box or the sensor was not seen in the previous frame.
+        """
+
+        radial = np.full(len(box_centers), np.nan)
+        if actor_ids is None or sensor_location is None:
+            self._previous = None
+            return radial
+        actor_ids = np.asarray(actor_ids, dtype=np.int64)
+        sensor_location = np.asarray(sensor_location, dtype=np.float64)
+        order = np.argsort(actor_ids, kind='stable')
+        previous = self._previous
+        self._previous = (frame_id, actor_ids[order], box_centers[order], sensor_location)
+        if previous is None or previous[0] >= frame_id or len(actor_ids) == 0:
+            return radial
+
+        previous_frame, previous_ids, previous_centers, previous_sensor = previous
+        dt = (frame_id - previous_frame) * self.frame_period
+        rows = np.minimum(np.searchsorted(previous_ids, actor_ids), max(len(previous_ids) - 1, 0))
+        seen = previous_ids[rows] == actor_ids if len(previous_ids) else np.zeros(len(actor_ids), dtype=bool)
+        relative = (box_centers[seen] - previous_centers[rows[seen]]) / dt - \
+            (sensor_location - previous_sensor) / dt
+        line_of_sight = box_centers[seen] - sensor_location
+        line_of_sight /= np.maximum(np.linalg.norm(line_of_sight, axis=1), 1e-9)[:, np.newaxis]
+        radial[seen] = np.einsum('ij,ij->i', relative, line_of_sight)
+        return radial
+
+    def summary(self):
+        """
+        Returns the accumulated metrics as a dict.
+        """
+
+        precision = self.matches / float(self.clusters) if self.clusters else 0.0
+        recall = self.visible_matches / float(self.visible) if self.visible else 0.0
+        return {
+            'frames': self.frames,
+            'clusters': self.clusters,
+            'boxes': self.boxes,
+            'visible_boxes': self.visible,
+            'matches': self.matches,
+            'precision': precision,
+            'recall': recall,
+            'f1': 2.0 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            'centroid_error_m': self.centroid_error.summary(),
+            'velocity_error_mps': self.velocity_error.summary(),
+            'latency_ms': self.latency.summary()}
+
+
+# ==============================================================================
+# -- Sources -------------------------------------------------------------------
+# ==============================================================================
+
+
+def recording_updates(path, clustering):
+    """
+    Yields update arguments for every frame of a binary recording, the
+    frame is clustered here and latency is the clustering time.
+    """
+
+    for frame_id, points, xyz, transforms, boxes in FrameReader(path).world_frames():
+        start = time.perf_counter()
+        clusters = clustering.cluster(points, xyz)
+        latency = time.perf_counter() - start
+        yield frame_id, xyz, clusters, boxes['corners'], boxes['actor_id'], transforms[0, :3], latency
+
+
+def annotation_updates(output_dir, clustering=None):
+    """
+    Yields update arguments for every frame of point.json. Boxes come from
+    box.json, see radar_recording.box_json_corners. Without clustering the
+    clusters of cluster.json are scored and latency is None.
+    """
+
+    streams = ['point', 'box'] if clustering is not None else ['point', 'box', 'cluster']
+    for frame_id, records in annotation_frames(output_dir, streams):
+        points = records['point']
+        xyz = np.array([record['point'] for record in points], dtype=np.float64).reshape(-1, 3)
+        velocity = np.array([record['velocity'] for record in points], dtype=np.float64)
+        boxes = records['box']
+        actor_ids = None
+        if all('actor_id' in record for record in boxes):
+            actor_ids = [record['actor_id'] for record in boxes]
+        latency = None
+        if clustering is not None:
+            start = time.perf_counter()
+            labels = clustering.fit(xyz, velocity)
+            clusters = clustering.summarize(labels, xyz, velocity)
+            latency = time.perf_counter() - start
+        else:
+            cluster = records['cluster']
+            clusters = ClusterResult(
+                None,
+                np.array([record['centroid'] for record in cluster], dtype=np.float64).reshape(-1, 3),
+                np.array([record['extent'] for record in cluster], dtype=np.float64).reshape(-1, 3),
+                np.array([record['velocity'] for record in cluster], dtype=np.float64),
+                np.array([record['count'] for record in cluster], dtype=np.int64))
+        yield frame_id, xyz, clusters, box_json_corners(boxes), actor_ids, points[0]['loc_arr'], latency
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = argparser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--recording', metavar='DIR', help='binary recording (--record of radar_simulation.py)')
+    source.add_argument('--annotations', metavar='DIR', help='directory with point.json and box.json')
+    argparser.add_argument(
+        '--recorded-clusters', action='store_true', help='with --annotations, score cluster.json as recorded')
+    argparser.add_argument('--eps', default=1.5, type=float, help='DBSCAN radius (default: %(default)s)')
+    argparser.add_argument('--min-samples', default=3, type=int, help='DBSCAN core points (default: %(default)s)')
+    argparser.add_argument(
+        '--velocity-weight', default=0.5, type=float, help='velocity weight (default: %(default)s)')
+    argparser.add_argument(
+        '--max-distance', default=2.5, type=float,
+        help='match gate on centroid distance in meters (default: %(default)s)')
+    argparser.add_argument(
+        '--min-iou', default=0.1, type=float, help='match gate on BEV IoU (default: %(default)s)')
+    argparser.add_argument(
+        '--max-candidates', default=8, type=int,
+        help='boxes per cluster entering the assignment (default: %(default)s)')
+    argparser.add_argument(
+        '--min-box-points', default=3, type=int,
+        help='radar points for a box to count as visible (default: %(default)s)')
+    argparser.add_argument(
+        '--frame-period', default=0.05, type=float, help='seconds between frames (default: %(default)s)')
+    argparser.add_argument('--frames-output', metavar='FILE', help='write per-frame metrics as JSON lines')
+    argparser.add_argument('--output', metavar='FILE', help='write the summary as JSON to FILE')
+    args = argparser.parse_args()
+
+    clustering = RadarClustering(args.eps, args.min_samples, args.velocity_weight)
+    if args.recording:
+        frames = recording_updates(args.recording, clustering)
+    else:
+        frames = annotation_updates(args.annotations, None if args.recorded_clusters else clustering)
+    evaluator = ClusterEvaluator(
+        args.max_distance, args.min_iou, args.max_candidates, args.min_box_points, args.frame_period)
+
+    frames_output = open(args.frames_output, 'w') if args.frames_output else None
+    try:
+        for frame in frames:
+            metrics = evaluator.update(*frame)
+            if frames_output is not None:
+                record = metrics._asdict()
+                record['centroid_errors'] = metrics.centroid_errors.tolist()
+                record['velocity_errors'] = [None if np.isnan(v) else v for v in metrics.velocity_errors.tolist()]
+                frames_output.write(json.dumps(record) + '\n')
+    finally:
+        if frames_output is not None:
+            frames_output.close()
+
+    summary = evaluator.summary()
+    print('%d frames: precision %.3f, recall %.3f, F1 %.3f (%d clusters, %d visible boxes)' % (
+        summary['frames'], summary['precision'], summary['recall'], summary['f1'],
+        summary['clusters'], summary['visible_boxes']))
+    for name in ('centroid_error_m', 'velocity_error_mps', 'latency_ms'):
+        stats = summary[name]
+        if stats['count']:
+            print('  %-18s mean %.3f  p50 %.3f  p95 %.3f  max %.3f' % (
+                name, stats['mean'], stats['p50'], stats['p95'], stats['max']))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
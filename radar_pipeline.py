@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+
+"""
+Multi-process radar pipeline.
+
+The radar callbacks only copy raw_data and the sensor transform into a slot
+of a shared-memory ring buffer, the measurements of all radars of a rig for
+one frame share a slot. A pool of worker processes, each with its own job
+queue, prefilters the measurements of each frame, fuses them to world frame,
+labels the points with the ground-truth boxes handed over with put_boxes,
+clusters them and serializes the point.json records; world frame positions
+and labels go back into the slot. The client collects the results in frame
+order, runs the tracker, records and releases the slot, so a frame holds its
+slot until it is fully consumed and a slow consumer shows up as
+back-pressure on the callbacks.
+
+    pipeline = RadarPipeline(RadarClustering(), RadarRig(), workers=4).start()
+    pipeline.put(radar_data, sensor_id, sensors)   # sensor callback threads
+    pipeline.put_boxes(frame, corners, actor_ids, label_ids)   # simulation loop
+    for result in pipeline.poll():      # simulation loop
+        ...
+        pipeline.release(result)
+    pipeline.close()
+"""
+
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from radar_processing import BoxGrid
+from radar_processing import RadarPoints
+from radar_recording import point_records
+from radar_recording import serialize_records
+from radar_rig import FusedCloud
+
+# segments are (sensor_id, offset, count, transform) of every measurement in
+# the slot, transform being (x, y, z, pitch, yaw, roll) of the sensor in world
+# frame. point_text holds the point.json lines of the frame, filtered the
+# (points_in, points_out, static_skipped) counts of the prefilter and error a
+# worker traceback
+RadarResult = collections.namedtuple('RadarResult', [
+    'seq', 'slot', 'frame', 'timestamp', 'segments', 'count', 'clusters', 'point_text', 'filtered', 'error'])
+
+# ==============================================================================
+# -- RadarRingBuffer -----------------------------------------------------------
+# ==============================================================================
+
+
+class RadarRingBuffer(object):
+    """
+    Fixed number of slots of max_points radar rows in shared memory, with
+    the world frame position and ground-truth labels of every row next to
+    them. Slots are claimed and released in the client process, worker
+    processes only touch the slots they are handed: they read the radar rows
+    and write positions and labels.
+    """
+
+    def __init__(self, slots=16, max_points=8192):
+        self.shape = (slots, max_points, 4)
+        self.buffers = (
+            multiprocessing.RawArray('f', slots * max_points * 4),
+            multiprocessing.RawArray('d', slots * max_points * 3),
+            multiprocessing.RawArray('q', slots * max_points * 2))
+        self.frames, self.world_xyz, self.labels = RadarRingBuffer.views(self.buffers, self.shape)
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+
+    @staticmethod
+    def views(buffers, shape):
+        """
+        Returns the (slots, max_points, 4) float32 radar rows, the
+        (slots, max_points, 3) float64 world frame positions and the
+        (slots, max_points, 2) int64 actor and label ids on shared buffers.
+        """
+
+        slots, max_points, _ = shape
+        return (
+            np.frombuffer(buffers[0], dtype=np.float32).reshape(slots, max_points, 4),
+            np.frombuffer(buffers[1], dtype=np.float64).reshape(slots, max_points, 3),
+            np.frombuffer(buffers[2], dtype=np.int64).reshape(slots, max_points, 2))
+
+    def claim(self, timeout=0.0):
+        """
+        Returns a free slot, or None if none got free within timeout seconds.
+        """
+
+        try:
+            if timeout > 0:
+                return self._free.get(timeout=timeout)
+            return self._free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def write(self, slot, offset, points):
+        """
+        Copies (N, 4) radar rows into a slot starting at row offset,
+        truncated to max_points. Returns the number of rows written.
+        """
+
+        count = max(0, min(len(points), self.shape[1] - offset))
+        self.frames[slot, offset:offset + count] = points[:count]
+        return count
+
+    def release(self, slot):
+        self._free.put(slot)
+
+    def free_slots(self):
+        return self._free.qsize()
+
+
+# ==============================================================================
+# -- RadarPipeline -------------------------------------------------------------
+# ==============================================================================
+
+
+class RadarPipeline(object):
+    """
+    Ring buffer plus a pool of worker processes, see the module docstring.
+
+    Counters:
+        submitted      - measurements passed to put
+        back_pressured - frames that found every slot in use
+        dropped        - measurements dropped because no slot got free
+                         within block_timeout seconds
+        truncated      - measurements cut to max_points rows per frame
+        processed      - frames handed out by poll
+        failed         - frames a worker raised on or lost by exiting
+        lost_workers   - worker processes that exited before close
+
+    Every frame is handed to the job queue of the live worker with the
+    fewest frames outstanding. If a worker process dies, the frames handed
+    to it and not returned yet come back from poll as error results, so
+    their slots are released as usual, while the other workers go on; with
+    no worker left this repeats for every frame.
+
+    With ground_truth a frame whose measurements are complete waits for its
+    boxes from put_boxes before it is handed to the workers, it goes without
+    them once a measurement of a later frame arrives or on flush.
+
+    A prefilter runs in the workers on the raw rows of the slot, so
+    max_points applies before filtering. Its counters are kept by the
+    worker copies and added to prefilter as results are polled.
+    """
+
+    def __init__(self, clustering, rig, workers=2, slots=16, max_points=8192, block_timeout=0.0, prefilter=None,
+                 ground_truth=False):
+        self.clustering = clustering
+        self.rig = rig
+        self.prefilter = prefilter
+        self.ground_truth = ground_truth
+        self.workers = workers
+        self.block_timeout = block_timeout
+        self.ring = RadarRingBuffer(slots, max_points)
+        self.submitted = 0
+        self.back_pressured = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.processed = 0
+        self.failed = 0
+        self.lost_workers = 0
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._next = 0
+        self._results = {}
+        # seq -> (worker index, job) of frames queued for the workers and not returned yet
+        self._queued = {}
+        # indices of the workers that did not exit
+        self._live = list(range(workers))
+        # frames waiting for a slot outside the lock
+        self._claiming = set()
+        self._closing = False
+        # frame -> [slot, timestamp, segments, rows, expected measurements, boxes, ego velocity per segment]
+        self._open = collections.OrderedDict()
+        # frame -> boxes that came before the first measurement of the frame
+        self._boxes = collections.OrderedDict()
+        self._dropped_frame = None
+        self._jobs = [multiprocessing.Queue() for _ in range(workers)]
+        self._done = multiprocessing.Queue()
+        # worker index -> process
+        self._processes = {}
+
+    def start(self):
+        """
+        Starts the worker processes.
+        """
+
+        for index in range(self.workers):
+            process = multiprocessing.Process(
+                target=_worker, name='RadarWorker-%d' % index,
+                args=(self.ring.buffers, self.ring.shape, self.clustering, self.rig, self.prefilter,
+                      self._jobs[index], self._done))
+            process.daemon = True
+            process.start()
+            self._processes[index] = process
+        return self
+
+    def put(self, radar_data, sensor_id=0, sensors=1, ego_velocity=None):
+        """
+        Copies one radar measurement into the ring buffer slot of its frame,
+        called from the sensor callback threads. sensor_id is the rig index
+        of the radar and sensors the number of measurements expected for the
+        frame; the frame is queued for the workers once all of them arrived,
+        or once a measurement of a later frame arrives. The raw rows are
+        copied, ego_velocity goes with the measurement to the prefilter of
+        the workers. If every slot is in use it waits up to block_timeout seconds for one,
+        without holding the lock poll needs to release slots. Returns False
+        if the measurement was dropped.
+        """
+
+        points = RadarPoints.from_buffer(radar_data.raw_data)
+        location = radar_data.transform.location
+        rotation = radar_data.transform.rotation
+        transform = (location.x, location.y, location.z, rotation.pitch, rotation.yaw, rotation.roll)
+        frame = radar_data.frame
+        with self._lock:
+            self.submitted += 1
+            entry = self._open.get(frame)
+            if entry is None:
+                if frame == self._dropped_frame:
+                    self.dropped += 1
+                    return False
+                # measurements of older frames will not come any more
+                for older in [older for older in self._open if older < frame]:
+                    self._queue_frame(older)
+                slot = self.ring.claim()
+                if slot is not None:
+                    entry = self._open_frame(frame, slot, radar_data.timestamp, sensors)
+                elif frame not in self._claiming:
+                    self.back_pressured += 1
+                    self._claiming.add(frame)
+            if entry is not None:
+                self._write(frame, entry, sensor_id, points, transform, ego_velocity)
+                return True
+
+        # wait for a slot without the lock, poll takes it to collect the results that free slots
+        slot = self.ring.claim(self.block_timeout)
+        with self._lock:
+            self._claiming.discard(frame)
+            entry = self._open.get(frame)
+            if entry is None and slot is not None and frame != self._dropped_frame:
+                entry = self._open_frame(frame, slot, radar_data.timestamp, sensors)
+            elif slot is not None:
+                # another measurement of the frame opened or dropped it meanwhile
+                self.ring.release(slot)
+            if entry is None:
+                self.dropped += 1
+                self._dropped_frame = frame
+                return False
+            self._write(frame, entry, sensor_id, points, transform, ego_velocity)
+        return True
+
+    def _open_frame(self, frame, slot, timestamp, sensors):
+        entry = [slot, timestamp, [], 0, sensors, self._boxes.pop(frame, None), []]
+        self._open[frame] = entry
+        return entry
+
+    def _write(self, frame, entry, sensor_id, points, transform, ego_velocity):
+        slot, _, segments, rows, _, _, ego_velocities = entry
+        count = self.ring.write(slot, rows, points)
+        if count < len(points):
+            self.truncated += 1
+        segments.append((sensor_id, rows, count, transform))
+        ego_velocities.append(ego_velocity)
+        entry[3] = rows + count
+        self._queue_if_ready(frame)
+
+    def put_boxes(self, frame, corners, actor_ids, label_ids):
+        """
+        Hands the ground-truth boxes of a frame to the workers, which label
+        every radar point with the actor id and label id of the box it lies
+        in. corners is (M, 8, 3) in world frame. Called from the simulation
+        loop once per frame.
+        """
+
+        boxes = (np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3),
+                 np.asarray(actor_ids, dtype=np.int64), np.asarray(label_ids, dtype=np.int64))
+        with self._lock:
+            if frame in self._open:
+                self._open[frame][5] = boxes
+                self._queue_if_ready(frame)
+                return
+            self._boxes[frame] = boxes
+            # boxes of frames whose measurements never come
+            while len(self._boxes) > self.ring.shape[0]:
+                self._boxes.popitem(last=False)
+
+    def _queue_if_ready(self, frame):
+        _, _, segments, _, expected, boxes, _ = self._open[frame]
+        if len(segments) >= expected and (boxes is not None or not self.ground_truth):
+            self._queue_frame(frame)
+
+    def flush(self):
+        """
+        Queues frames still waiting for measurements.
+        """
+
+        with self._lock:
+            for frame in list(self._open):
+                self._queue_frame(frame)
+
+    def _queue_frame(self, frame):
+        slot, timestamp, segments, rows, _, boxes, ego_velocities = self._open.pop(frame)
+        job = (self._seq, slot, frame, timestamp, segments, rows, boxes, ego_velocities)
+        if self._live:
+            outstanding = collections.Counter(index for index, _ in self._queued.values())
+            index = min(self._live, key=lambda live: outstanding[live])
+            self._jobs[index].put(job)
+        else:
+            # failed by the next poll
+            index = None
+        self._queued[self._seq] = (index, job)
+        self._seq += 1
+
+    def poll(self, timeout=0.0):
+        """
+        Returns the results that are ready, in the order the measurements
+        were put. Waits up to timeout seconds for the next one.
+        """
+
+        deadline = time.time() + timeout
+        # results that arrived before a worker died are kept
+        self._receive(0.0)
+        self._check_workers()
+        self._receive(deadline)
+        self._check_workers()
+
+        results = []
+        while self._next in self._results:
+            result = self._results.pop(self._next)
+            results.append(result)
+            self._next += 1
+        with self._lock:
+            self.processed += len(results)
+            self.failed += sum(1 for result in results if result.error is not None)
+        if self.prefilter is not None:
+            for result in results:
+                if result.filtered is not None:
+                    self.prefilter.add_counts(*result.filtered)
+        return results
+
+    def _receive(self, deadline):
+        """
+        Collects finished jobs, waiting until deadline for the next one.
+        """
+
+        while True:
+            wait = deadline - time.time()
+            try:
+                if self._next in self._results or wait <= 0:
+                    result = self._done.get_nowait()
+                else:
+                    result = self._done.get(timeout=wait)
+            except queue.Empty:
+                return
+            with self._lock:
+                if self._queued.pop(result.seq, None) is None:
+                    # already failed after a worker died, its slot is released
+                    continue
+            self._results[result.seq] = result
+
+    def _check_workers(self):
+        """
+        Turns the frames queued for a worker process that exited since the
+        last check into error results, and every queued frame if no worker
+        is left.
+        """
+
+        if self._closing:
+            return
+        dead = [index for index, process in self._processes.items() if not process.is_alive()]
+        if not dead and (self._live or not self.lost_workers):
+            return
+        errors = {}
+        for index in dead:
+            process = self._processes.pop(index)
+            errors[index] = 'radar worker exited: %s with code %s' % (process.name, process.exitcode)
+            # nobody reads the queue any more, do not wait for it to flush on exit
+            self._jobs[index].cancel_join_thread()
+        with self._lock:
+            self.lost_workers += len(dead)
+            self._live = [index for index in self._live if index not in errors]
+            if self._live:
+                failed = [seq for seq, (index, _) in self._queued.items() if index in errors]
+            else:
+                failed = list(self._queued)
+            jobs = [self._queued.pop(seq) for seq in failed]
+        for index, (seq, slot, frame, timestamp, segments, count, _, _) in jobs:
+            error = errors.get(index, 'no radar worker left')
+            self._results[seq] = RadarResult(seq, slot, frame, timestamp, segments, count, None, None, None, error)
+
+    def drain(self, timeout=5.0):
+        """
+        Returns the results of every measurement put so far, waiting up to
+        timeout seconds in total.
+        """
+
+        self.flush()
+        deadline = time.time() + timeout
+        results = []
+        while self._next < self._seq and time.time() < deadline:
+            results.extend(self.poll(deadline - time.time()))
+        return results
+
+    def release(self, result):
+        """
+        Hands the ring buffer slot of a result back to the producer.
+        """
+
+        self.ring.release(result.slot)
+
+    def points(self, result):
+        """
+        Returns the (N, 4) radar rows of a result, valid until release.
+        """
+
+        return self.ring.frames[result.slot, :result.count]
+
+    def cloud(self, result):
+        """
+        Returns the FusedCloud of a result as the worker computed it, on
+        views valid until release. vehicle_xyz is not kept and is None.
+        """
+
+        segments = result.segments
+        sensor_ids = np.repeat(
+            np.array([sensor_id for sensor_id, _, _, _ in segments], dtype=np.int64),
+            [count for _, _, count, _ in segments])
+        if segments:
+            vehicle_matrix = self.rig.vehicle_matrix(segments[0][0], segments[0][3])
+        else:
+            vehicle_matrix = np.identity(4)
+        return FusedCloud(
+            self.points(result), sensor_ids, None, self.ring.world_xyz[result.slot, :result.count], vehicle_matrix)
+
+    def labels(self, result):
+        """
+        Returns (N,) actor ids and (N,) label ids of the points of a result,
+        -1 for points in no box or frames without boxes. Valid until release.
+        """
+
+        labels = self.ring.labels[result.slot, :result.count]
+        return labels[:, 0], labels[:, 1]
+
+    def close(self, timeout=5.0):
+        """
+        Stops the worker processes. Results not collected yet are discarded.
+        """
+
+        self._closing = True
+        for index in self._processes:
+            self._jobs[index].put(None)
+        deadline = time.time() + timeout
+        for process in self._processes.values():
+            # workers only exit once their queued results are read
+            while process.is_alive() and time.time() < deadline:
+                self.poll(0.05)
+                process.join(0.01)
+            if process.is_alive():
+                process.terminate()
+        self._processes = {}
+
+    def stats(self):
+        """
+        Returns counters as a dict.
+        """
+
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'back_pressured': self.back_pressured,
+                'dropped': self.dropped,
+                'truncated': self.truncated,
+                'processed': self.processed,
+                'failed': self.failed,
+                'lost_workers': self.lost_workers,
+                'in_flight': self._seq - self._next,
+                'free_slots': self.ring.free_slots()}
+
+
+def _prefilter_slot(rows, segments, prefilter, ego_velocities):
+    """
+    Filters every measurement of a slot with the ego velocity it was put
+    with, and moves the rows that pass to the front of the slot, back to
+    back. Returns the segments of the kept rows and their count.
+    """
+
+    kept_segments, offset = [], 0
+    for (sensor_id, start, count, transform), ego_velocity in zip(segments, ego_velocities):
+        kept = prefilter.apply(rows[start:start + count], ego_velocity, transform[3:])
+        rows[offset:offset + len(kept)] = kept
+        kept_segments.append((sensor_id, offset, len(kept), transform))
+        offset += len(kept)
+    return kept_segments, offset
+
+
+def _worker(buffers, shape, clustering, rig, prefilter, jobs, done):
+    frames, world_xyz, labels = RadarRingBuffer.views(buffers, shape)
+    if prefilter is not None and not prefilter.enabled:
+        prefilter = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        seq, slot, frame, timestamp, segments, count, boxes, ego_velocities = job
+        clusters = point_text = filtered = error = None
+        try:
+            if prefilter is not None:
+                before = prefilter.stats()
+                segments, count = _prefilter_slot(frames[slot], segments, prefilter, ego_velocities)
+                after = prefilter.stats()
+                filtered = tuple(after[name] - before[name] for name in ('points_in', 'points_out', 'static_skipped'))
+            cloud = rig.fuse_segments(frames[slot, :count], segments)
+            world_xyz[slot, :count] = cloud.world_xyz
+            point_labels = labels[slot, :count]
+            point_labels[:] = -1
+            if boxes is not None and len(boxes[0]):
+                rows = BoxGrid(boxes[0]).assign(cloud.world_xyz)
+                hit = rows >= 0
+                point_labels[hit, 0] = boxes[1][rows[hit]]
+                point_labels[hit, 1] = boxes[2][rows[hit]]
+            clusters = clustering.cluster(cloud.points, cloud.world_xyz)
+            point_text = ''.join(
+                serialize_records(point_records(
+                    frame, list(transform[:3]), cloud.world_xyz[offset:offset + rows],
+                    cloud.points[offset:offset + rows, 0]))
+                for _, offset, rows, transform in segments)
+        except Exception:
+            error = traceback.format_exc()
+        done.put(RadarResult(seq, slot, frame, timestamp, segments, count, clusters, point_text, filtered, error))
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+NumPy stages for CARLA radar measurements.
+
+Radar measurements are handled as (N, 4) float arrays of
+[velocity, altitude, azimuth, depth] rows, the layout of
+radar_data.raw_data. Nothing in this module needs the carla package, so it
+can be used by offline tools as well as from the radar callback.
+"""
+
+import threading
+
+import numpy as np
+
+VELOCITY, ALTITUDE, AZIMUTH, DEPTH = range(4)
+
+# ==============================================================================
+# -- Geometry ------------------------------------------------------------------
+# ==============================================================================
+
+
+def transform_matrices(locations, rotations):
+    """
+    Creates (N, 4, 4) matrix stack from (N, 3) locations and (N, 3)
+    rotations given as pitch, yaw, roll in degrees.
+    Same convention as ClientSideBoundingBoxes.get_matrix.
+    """
+
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+    rotations = np.radians(np.asarray(rotations, dtype=np.float64).reshape(-1, 3))
+    c_p, c_y, c_r = np.cos(rotations).T
+    s_p, s_y, s_r = np.sin(rotations).T
+    matrix = np.zeros((len(locations), 4, 4))
+    matrix[:, 3, 3] = 1.0
+    matrix[:, :3, 3] = locations
+    matrix[:, 0, 0] = c_p * c_y
+    matrix[:, 0, 1] = c_y * s_p * s_r - s_y * c_r
+    matrix[:, 0, 2] = -c_y * s_p * c_r - s_y * s_r
+    matrix[:, 1, 0] = s_y * c_p
+    matrix[:, 1, 1] = s_y * s_p * s_r + c_y * c_r
+    matrix[:, 1, 2] = -s_y * s_p * c_r + c_y * s_r
+    matrix[:, 2, 0] = s_p
+    matrix[:, 2, 1] = -c_p * s_r
+    matrix[:, 2, 2] = c_p * c_r
+    return matrix
+
+
+def box_corners(centers, extents):
+    """
+    Returns (N, 8, 3) corners of axis-aligned boxes with (N, 3) centers and
+    half sizes: the bottom face counter-clockwise from (+x, +y), then the top
+    face in the same order. ClientSideBoundingBoxes builds its boxes from it.
+    """
+
+    signs = np.array([
+        [1, 1, -1],
+        [-1, 1, -1],
+        [-1, -1, -1],
+        [1, -1, -1],
+        [1, 1, 1],
+        [-1, 1, 1],
+        [-1, -1, 1],
+        [1, -1, 1]], dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 3)
+    return centers[:, np.newaxis, :] + signs[np.newaxis, :, :] * extents[:, np.newaxis, :]
+
+
+# ==============================================================================
+# -- RadarPoints ---------------------------------------------------------------
+# ==============================================================================
+
+
+class RadarPoints(object):
+    """
+    Vectorized conversion of radar detections to cartesian coordinates and
+    debug colours.
+    """
+
+    @staticmethod
+    def from_buffer(raw_data):
+        """
+        Returns (N, 4) float32 view on a radar raw_data buffer.
+        """
+
+        return np.frombuffer(raw_data, dtype=np.dtype('f4')).reshape(-1, 4)
+
+    @staticmethod
+    def to_sensor(points, depth_offset=0.0):
+        """
+        Returns (N, 3) sensor frame XYZ of radar detections.
+        depth_offset is subtracted from every depth, the debug drawing uses it
+        so the dots can be properly seen.
+        """
+
+        points = np.asarray(points)
+        depth = points[:, DEPTH].astype(np.float64) - depth_offset
+        altitude = points[:, ALTITUDE].astype(np.float64)
+        azimuth = points[:, AZIMUTH].astype(np.float64)
+        cos_alt = np.cos(altitude)
+        xyz = np.empty((len(points), 3))
+        xyz[:, 0] = depth * cos_alt * np.cos(azimuth)
+        xyz[:, 1] = depth * cos_alt * np.sin(azimuth)
+        xyz[:, 2] = depth * np.sin(altitude)
+        return xyz
+
+    @staticmethod
+    def sensor_to_world(xyz, sensor_matrix):
+        """
+        Applies (4, 4) sensor-to-world matrix to (N, 3) points.
+        """
+
+        sensor_matrix = np.asarray(sensor_matrix)
+        return np.dot(xyz, sensor_matrix[:3, :3].T) + sensor_matrix[:3, 3]
+
+    @staticmethod
+    def to_world(points, sensor_matrix, depth_offset=0.0):
+        """
+        Returns (N, 3) sensor frame and (N, 3) world frame XYZ of radar
+        detections in one pass.
+        """
+
+        sensor_xyz = RadarPoints.to_sensor(points, depth_offset)
+        return sensor_xyz, RadarPoints.sensor_to_world(sensor_xyz, sensor_matrix)
+
+    @staticmethod
+    def velocity_colors(velocity, velocity_range):
+        """
+        Returns (N, 3) uint8 RGB colours for radial velocities, red for
+        approaching, white for static and blue for receding detections.
+        """
+
+        norm_velocity = np.asarray(velocity, dtype=np.float64) / velocity_range  # range [-1, 1]
+        colors = np.empty((len(norm_velocity), 3))
+        colors[:, 0] = np.clip(1.0 - norm_velocity, 0.0, 1.0)
+        colors[:, 1] = np.clip(1.0 - np.abs(norm_velocity), 0.0, 1.0)
+        colors[:, 2] = np.abs(np.clip(-1.0 - norm_velocity, -1.0, 0.0))
+        return (colors * 255.0).astype(np.uint8)
+
+
+# ==============================================================================
+# -- RadarPrefilter ------------------------------------------------------------
+# ==============================================================================
+
+
+class RadarPrefilter(object):
+    """
+    Drops radar detections before fusion, clustering, drawing and recording.
+
+    Stages, each off by default:
+        depth, azimuth, altitude  (min, max) region of interest, depth in
+                                  meters and angles in degrees
+        static_threshold          drops detections whose radial velocity is
+                                  within this many m/s of the one a static
+                                  target would show, given the ego velocity
+        voxel_size                keeps the first detection of every cubic
+                                  voxel of this size in sensor frame
+
+    The static gate takes the ego velocity in world frame and the sensor
+    rotation; the rotation of the car itself is not compensated.
+    Measurements that reach an enabled static gate without them are passed
+    ungated and counted as static_skipped.
+    """
+
+    def __init__(self, depth=None, azimuth=None, altitude=None, static_threshold=None, voxel_size=None):
+        self.depth = depth
+        self.azimuth = None if azimuth is None else np.radians(azimuth)
+        self.altitude = None if altitude is None else np.radians(altitude)
+        self.static_threshold = static_threshold
+        self.voxel_size = voxel_size
+        self.points_in = 0
+        self.points_out = 0
+        self.static_skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(stage is not None for stage in (
+            self.depth, self.azimuth, self.altitude, self.static_threshold, self.voxel_size))
+
+    def apply(self, points, ego_velocity=None, sensor_rotation=None):
+        """
+        Returns the (M, 4) rows of (N, 4) radar points that pass. The static
+        gate needs ego_velocity (x, y, z) in world frame and sensor_rotation
+        (pitch, yaw, roll) in degrees, it is skipped and counted without them.
+        """
+
+        if not self.enabled:
+            return points
+        points = np.asarray(points)
+        keep = np.ones(len(points), dtype=bool)
+        for column, bounds in ((DEPTH, self.depth), (AZIMUTH, self.azimuth), (ALTITUDE, self.altitude)):
+            if bounds is not None:
+                keep &= (points[:, column] >= bounds[0]) & (points[:, column] <= bounds[1])
+        skipped = False
+        if self.static_threshold is not None:
+            if ego_velocity is None or sensor_rotation is None:
+                skipped = True
+            else:
+                keep &= self.moving(points, ego_velocity, sensor_rotation)
+        kept = points[keep]
+        if self.voxel_size is not None and len(kept):
+            voxels = np.floor(RadarPoints.to_sensor(kept) / self.voxel_size).astype(np.int64)
+            _, first = np.unique(voxels, axis=0, return_index=True)
+            kept = kept[np.sort(first)]
+        self.add_counts(len(points), len(kept), int(skipped))
+        return kept
+
+    def add_counts(self, points_in, points_out, static_skipped):
+        """
+        Adds to the counters, for points filtered by a copy of this
+        prefilter in another process.
+        """
+
+        with self._lock:
+            self.points_in += points_in
+            self.points_out += points_out
+            self.static_skipped += static_skipped
+
+    def moving(self, points, ego_velocity, sensor_rotation):
+        """
+        Returns (N,) mask of detections that are not static targets.
+        """
+
+        rotation = transform_matrices([(0.0, 0.0, 0.0)], [sensor_rotation])[0, :3, :3]
+        sensor_velocity = np.dot(rotation.T, np.asarray(ego_velocity, dtype=np.float64))
+        direction = RadarPoints.to_sensor(np.column_stack([points[:, :DEPTH], np.ones(len(points))]))
+        # a static target closes in at the ego speed along the line of sight
+        static_velocity = -np.dot(direction, sensor_velocity)
+        return np.abs(points[:, VELOCITY] - static_velocity) > self.static_threshold
+
+    def stats(self):
+        with self._lock:
+            return {
+                'points_in': self.points_in,
+                'points_out': self.points_out,
+                'static_skipped': self.static_skipped,
+                'ratio': self.points_in / float(self.points_out) if self.points_out else None}
+
+
+# ==============================================================================
+# -- BoxGrid -------------------------------------------------------------------
+# ==============================================================================
+
+
+class BoxGrid(object):
+    """
+    Oriented 3D boxes given by their (N, 8, 3) world frame corners, in the
+    corner order of ClientSideBoundingBoxes, indexed by a uniform XY grid.
+
+    Boxes are grown by margin meters on every side. The grid holds one
+    (cell, box) pair per cell a grown box footprint touches, so finding the
+    boxes that contain a point cloud costs a sorted lookup per point plus an
+    exact test per candidate pair, instead of points x boxes.
+    """
+
+    def __init__(self, corners, cell_size=4.0, margin=0.25):
+        corners = np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3)
+        self.cell_size = cell_size
+        self.margin = margin
+        self.centers = corners.mean(axis=1)
+        # box axes from corner 0 (+x +y -z) to corners 1, 3 and 4
+        edges = np.stack([
+            corners[:, 0] - corners[:, 1],
+            corners[:, 0] - corners[:, 3],
+            corners[:, 4] - corners[:, 0]], axis=1)
+        lengths = np.linalg.norm(edges, axis=2)
+        self.axes = edges / np.maximum(lengths, 1e-9)[:, :, np.newaxis]
+        self.extents = lengths / 2.0
+
+        cells_min = np.floor((corners[:, :, :2].min(axis=1) - margin) / cell_size).astype(np.int64)
+        cells_max = np.floor((corners[:, :, :2].max(axis=1) + margin) / cell_size).astype(np.int64)
+        spans = cells_max - cells_min + 1
+        counts = spans[:, 0] * spans[:, 1]
+        boxes = np.repeat(np.arange(len(corners)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = cells_min[boxes] + np.column_stack([local // spans[boxes, 1], local % spans[boxes, 1]])
+        keys = BoxGrid._keys(cells)
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._boxes = boxes[order]
+
+    def __len__(self):
+        return len(self.centers)
+
+    @staticmethod
+    def _keys(cells):
+        return (cells[:, 0] << 32) + (cells[:, 1] & 0xffffffff)
+
+    def candidates(self, xyz):
+        """
+        Returns (point rows, box rows) of every point and box sharing a cell.
+        """
+
+        xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        keys = BoxGrid._keys(np.floor(xyz[:, :2] / self.cell_size).astype(np.int64))
+        first = np.searchsorted(self._keys, keys, side='left')
+        counts = np.searchsorted(self._keys, keys, side='right') - first
+        rows = np.repeat(np.arange(len(xyz)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, self._boxes[np.repeat(first, counts) + offsets]
+
+    def assign(self, xyz):
+        """
+        Returns (N,) row of the box containing each point, -1 for points in
+        no box. A point in several boxes goes to the one with the nearest
+        center.
+        """
+
+        xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        assigned = np.full(len(xyz), -1, dtype=np.int64)
+        if len(self) == 0 or len(xyz) == 0:
+            return assigned
+        rows, boxes = self.candidates(xyz)
+        offset = xyz[rows] - self.centers[boxes]
+        local = np.einsum('nij,nj->ni', self.axes[boxes], offset)
+        inside = np.all(np.abs(local) <= self.extents[boxes] + self.margin, axis=1)
+        rows, boxes = rows[inside], boxes[inside]
+        distance = np.einsum('ij,ij->i', offset[inside], offset[inside])
+        order = np.lexsort((distance, rows))
+        rows, first = np.unique(rows[order], return_index=True)
+        assigned[rows] = boxes[order][first]
+        return assigned
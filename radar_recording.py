@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+"""
+Recording of radar detections and ground-truth boxes.
+
+AnnotationSink moves JSON-lines writing of box.json / point.json off the
+simulator callback thread. FrameRecorder and FrameReader store radar buffers
+and box corners in append-only binary files with a per-frame index, so any
+frame range can be read back as np.memmap views without parsing.
+"""
+
+import itertools
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+from radar_processing import RadarPoints
+from radar_processing import box_corners
+from radar_processing import transform_matrices
+
+RECORDING_VERSION = 1
+
+# rows of radar_data.raw_data: velocity, altitude, azimuth, depth
+RADAR_DTYPE = np.dtype('<f4')
+
+# one entry per radar measurement, offset and count are in radar rows
+RADAR_INDEX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('sensor_id', '<i4'),
+    ('offset', '<i8'),
+    ('count', '<i8'),
+    ('transform', '<f8', (6,))])  # x, y, z, pitch, yaw, roll
+
+BOX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('actor_id', '<i8'),
+    ('label_id', '<i4'),
+    ('corners', '<f4', (8, 3))])  # world frame
+
+# one entry per recorded frame, offset and count are in boxes
+BOX_INDEX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('offset', '<i8'),
+    ('count', '<i8')])
+
+# half size of the boxes given to box.json records without corners, written
+# before box.json held them; covers a car at any yaw
+BOX_JSON_EXTENT = (2.5, 2.5, 1.0)
+
+# ==============================================================================
+# -- AnnotationSink ------------------------------------------------------------
+# ==============================================================================
+
+
+class AnnotationSink(object):
+    """
+    Bounded queue of annotation batches drained by a background writer thread.
+
+    Producers call put(stream, records) once per frame with a list of JSON
+    serializable records, the writer appends them to <output_dir>/<stream>.json
+    one record per line. Records already serialized elsewhere, e.g. by a
+    worker process, are queued with put_serialized. If the queue is full put
+    waits up to block_timeout seconds (counted as back-pressure) and then
+    drops the batch (counted as dropped records).
+    """
+
+    def __init__(self, output_dir, max_batches=256, block_timeout=0.0):
+        self.output_dir = output_dir
+        self.block_timeout = block_timeout
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.back_pressured = 0
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._lock = threading.Lock()
+        self._closed = False
+        # producers past the closed check, close waits for them
+        self._producers = 0
+        self._idle = threading.Condition(self._lock)
+        self._files = {}
+        self._thread = threading.Thread(target=self._run, name='AnnotationSink')
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Creates output directory and starts the writer thread.
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def put(self, stream, records):
+        """
+        Queues one batch of records for <stream>.json. Returns False if the
+        batch was dropped.
+        """
+
+        return self._enqueue((stream, records, len(records)))
+
+    def put_serialized(self, stream, text, count):
+        """
+        Queues count records already serialized as JSON lines, see
+        serialize_records. Returns False if the batch was dropped.
+        """
+
+        return self._enqueue((stream, text, count))
+
+    def _enqueue(self, batch):
+        count = batch[2]
+        if not count:
+            return True
+        with self._lock:
+            self.submitted += count
+            if self._closed:
+                self.dropped += count
+                return False
+            self._producers += 1
+        try:
+            return self._put(batch, count)
+        finally:
+            with self._lock:
+                self._producers -= 1
+                if not self._producers:
+                    self._idle.notify_all()
+
+    def _put(self, batch, count):
+        try:
+            self._queue.put_nowait(batch)
+            return True
+        except queue.Full:
+            pass
+        with self._lock:
+            self.back_pressured += 1
+        try:
+            if self.block_timeout > 0:
+                self._queue.put(batch, timeout=self.block_timeout)
+                return True
+        except queue.Full:
+            pass
+        with self._lock:
+            self.dropped += count
+        return False
+
+    def close(self, timeout=None):
+        """
+        Flushes queued batches, stops the writer thread and closes files.
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            # batches that passed the closed check go in before the sentinel
+            while self._producers:
+                self._idle.wait()
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Returns record counters as a dict.
+        """
+
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'back_pressured': self.back_pressured,
+                'queued_batches': self._queue.qsize()}
+
+    def _run(self):
+        try:
+            running = True
+            while running:
+                batches = [self._queue.get()]
+                # drain whatever else is ready so each file is written once
+                while True:
+                    try:
+                        batches.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batches:
+                    running = False
+                    batches = [batch for batch in batches if batch is not None]
+                self._write(batches)
+        finally:
+            for fp in self._files.values():
+                fp.close()
+            self._files.clear()
+
+    def _write(self, batches):
+        lines = {}
+        count = 0
+        for stream, records, records_count in batches:
+            if isinstance(records, str):
+                lines.setdefault(stream, []).append(records)
+            else:
+                lines.setdefault(stream, []).append(serialize_records(records))
+            count += records_count
+        for stream, stream_lines in lines.items():
+            fp = self._files.get(stream)
+            if fp is None:
+                fp = open(os.path.join(self.output_dir, stream + '.json'), 'a+', newline='')
+                self._files[stream] = fp
+            fp.writelines(stream_lines)
+            fp.flush()
+        with self._lock:
+            self.written += count
+
+
+def serialize_records(records):
+    """
+    Returns records as JSON lines, the format of the <stream>.json files.
+    """
+
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+def point_records(frame_id, loc_arr, world_xyz, velocity):
+    """
+    Returns point.json records of one radar measurement, loc_arr is the
+    sensor location.
+    """
+
+    return [
+        {"loc_arr": loc_arr, "point": point, "velocity": point_velocity, "frame_id": frame_id}
+        for point, point_velocity in zip(np.asarray(world_xyz).tolist(), np.asarray(velocity).tolist())]
+
+
+def labelled_cloud_records(frame_id, loc_arr, world_xyz, velocity, sensor_ids, actor_ids, label_ids):
+    """
+    Returns the labelled_cloud.json record of the fused radar cloud of one
+    frame: world frame points, radial velocities and per point the rig index
+    of its radar and the actor id and label id of the ground-truth box the
+    point lies in, -1 for none. loc_arr is the vehicle location.
+    """
+
+    return [{
+        "loc_arr": loc_arr, "points": np.asarray(world_xyz).tolist(), "velocity": np.asarray(velocity).tolist(),
+        "sensor_id": np.asarray(sensor_ids).tolist(), "actor_id": np.asarray(actor_ids).tolist(),
+        "label_id": np.asarray(label_ids).tolist(), "frame_id": frame_id}]
+
+
+def cluster_records(frame_id, clusters, track_ids):
+    """
+    Returns cluster.json records of a ClusterResult and the track id of
+    every cluster.
+    """
+
+    return [
+        {"centroid": centroid, "extent": extent, "velocity": velocity, "count": count,
+         "track_id": track_id, "frame_id": frame_id}
+        for centroid, extent, velocity, count, track_id in zip(
+            clusters.centroids.tolist(), clusters.extents.tolist(),
+            clusters.velocities.tolist(), clusters.counts.tolist(),
+            np.asarray(track_ids).tolist())]
+
+
+def box_json_corners(records, box_extent=BOX_JSON_EXTENT):
+    """
+    Returns (N, 8, 3) world frame corners of box.json records. Records of
+    older runs hold the actor location only, their boxes are axis-aligned
+    with half size box_extent and stand on the location.
+    """
+
+    corners = np.zeros((len(records), 8, 3))
+    located = [row for row, record in enumerate(records) if 'corners' not in record]
+    if len(located) < len(records):
+        recorded = [row for row, record in enumerate(records) if 'corners' in record]
+        corners[recorded] = np.array([records[row]['corners'] for row in recorded], dtype=np.float64)
+    if located:
+        centers = np.array([records[row]['boxloc'] for row in located], dtype=np.float64).reshape(-1, 3)
+        centers[:, 2] += box_extent[2]
+        corners[located] = box_corners(centers, np.tile(box_extent, (len(centers), 1)))
+    return corners
+
+
+def json_frames(filename):
+    """
+    Yields (frame_id, records) of a <stream>.json file, one frame at a time.
+    The records of a frame must be consecutive, as the sink writes them.
+    """
+
+    if not os.path.exists(filename):
+        return
+    with open(filename) as fp:
+        records = (json.loads(line) for line in fp if line.strip())
+        for frame_id, frame_records in itertools.groupby(records, key=lambda record: record['frame_id']):
+            yield frame_id, list(frame_records)
+
+
+def annotation_frames(output_dir, streams):
+    """
+    Yields (frame_id, records) for every frame of the first of streams,
+    records being a dict of stream name to the records of that frame, empty
+    if the stream has none. All files are read in step, so only one frame of
+    each is held in memory; frame ids must increase within each file.
+    """
+
+    readers = [json_frames(os.path.join(output_dir, stream + '.json')) for stream in streams[1:]]
+    pending = [next(reader, None) for reader in readers]
+    for frame_id, records in json_frames(os.path.join(output_dir, streams[0] + '.json')):
+        frame = {streams[0]: records}
+        for index, stream in enumerate(streams[1:]):
+            while pending[index] is not None and pending[index][0] < frame_id:
+                pending[index] = next(readers[index], None)
+            matched = pending[index] is not None and pending[index][0] == frame_id
+            frame[stream] = pending[index][1] if matched else []
+        yield frame_id, frame
+
+
+# ==============================================================================
+# -- FrameRecorder -------------------------------------------------------------
+# ==============================================================================
+
+
+class FrameRecorder(object):
+    """
+    Appends radar measurements and ground-truth boxes to a recording
+    directory. Frames must be added in increasing frame_id order per stream,
+    also when appending to an existing recording; add_radar and add_boxes
+    raise ValueError for a frame older than the last one recorded. A partly
+    written last record of an interrupted recording is cut on opening.
+
+    Files:
+        radar.f4        (N, 4) float32 rows, radar_data.raw_data layout
+        radar_index.bin RADAR_INDEX_DTYPE entries
+        boxes.bin       BOX_DTYPE entries
+        boxes_index.bin BOX_INDEX_DTYPE entries
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump({'version': RECORDING_VERSION}, fp)
+        self._radar_lock = threading.Lock()
+        self._box_lock = threading.Lock()
+        self._radar = FrameRecorder._open_append(os.path.join(path, 'radar.f4'), 4 * RADAR_DTYPE.itemsize)
+        self._radar_index = FrameRecorder._open_append(
+            os.path.join(path, 'radar_index.bin'), RADAR_INDEX_DTYPE.itemsize)
+        self._boxes = FrameRecorder._open_append(os.path.join(path, 'boxes.bin'), BOX_DTYPE.itemsize)
+        self._boxes_index = FrameRecorder._open_append(
+            os.path.join(path, 'boxes_index.bin'), BOX_INDEX_DTYPE.itemsize)
+        self._radar_rows = self._radar.tell() // (4 * RADAR_DTYPE.itemsize)
+        self._box_rows = self._boxes.tell() // BOX_DTYPE.itemsize
+        self._radar_frame = FrameRecorder._last_frame(os.path.join(path, 'radar_index.bin'), RADAR_INDEX_DTYPE)
+        self._box_frame = FrameRecorder._last_frame(os.path.join(path, 'boxes_index.bin'), BOX_INDEX_DTYPE)
+
+    @staticmethod
+    def _open_append(filename, record_size):
+        fp = open(filename, 'ab')
+        size = fp.tell()
+        if size % record_size:
+            fp.truncate(size - size % record_size)
+            fp.seek(0, os.SEEK_END)
+        return fp
+
+    @staticmethod
+    def _last_frame(filename, dtype):
+        size = os.path.getsize(filename)
+        if size < dtype.itemsize:
+            return None
+        return int(np.fromfile(filename, dtype=dtype, count=1, offset=size - dtype.itemsize)['frame_id'][0])
+
+    @staticmethod
+    def _check_order(stream, frame_id, last_frame):
+        if last_frame is not None and frame_id < last_frame:
+            raise ValueError('%s frame %d is older than the last recorded frame %d' % (stream, frame_id, last_frame))
+
+    def add_radar(self, frame_id, raw_data, transform, sensor_id=0):
+        """
+        Appends one radar measurement. raw_data is the measurement buffer or
+        an (N, 4) array, transform is (x, y, z, pitch, yaw, roll) of the
+        sensor in world frame.
+        """
+
+        points = np.frombuffer(raw_data, dtype=RADAR_DTYPE) if not isinstance(raw_data, np.ndarray) \
+            else np.ascontiguousarray(raw_data, dtype=RADAR_DTYPE)
+        entry = np.zeros(1, dtype=RADAR_INDEX_DTYPE)
+        entry['frame_id'] = frame_id
+        entry['sensor_id'] = sensor_id
+        entry['transform'] = transform
+        with self._radar_lock:
+            FrameRecorder._check_order('radar', frame_id, self._radar_frame)
+            self._radar_frame = frame_id
+            entry['offset'] = self._radar_rows
+            entry['count'] = points.size // 4
+            self._radar.write(points.tobytes())
+            self._radar_index.write(entry.tobytes())
+            self._radar_rows += points.size // 4
+
+    def add_boxes(self, frame_id, corners, actor_ids, label_ids):
+        """
+        Appends the ground-truth boxes of one frame, corners is (N, 8, 3) in
+        world frame.
+        """
+
+        boxes = np.zeros(len(corners), dtype=BOX_DTYPE)
+        boxes['frame_id'] = frame_id
+        boxes['actor_id'] = actor_ids
+        boxes['label_id'] = label_ids
+        boxes['corners'] = np.asarray(corners).reshape(-1, 8, 3)
+        entry = np.zeros(1, dtype=BOX_INDEX_DTYPE)
+        entry['frame_id'] = frame_id
+        entry['count'] = len(boxes)
+        with self._box_lock:
+            FrameRecorder._check_order('box', frame_id, self._box_frame)
+            self._box_frame = frame_id
+            entry['offset'] = self._box_rows
+            self._boxes.write(boxes.tobytes())
+            self._boxes_index.write(entry.tobytes())
+            self._box_rows += len(boxes)
+
+    def flush(self):
+        with self._radar_lock:
+            self._radar.flush()
+            self._radar_index.flush()
+        with self._box_lock:
+            self._boxes.flush()
+            self._boxes_index.flush()
+
+    def close(self):
+        with self._radar_lock:
+            self._radar.close()
+            self._radar_index.close()
+        with self._box_lock:
+            self._boxes.close()
+            self._boxes_index.close()
+
+
+# ==============================================================================
+# -- FrameReader ---------------------------------------------------------------
+# ==============================================================================
+
+
+class FrameReader(object):
+    """
+    Read-only np.memmap access to a FrameRecorder directory. Frames are looked
+    up with a binary search on the index, data is never copied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.radar_index = self._map(os.path.join(path, 'radar_index.bin'), RADAR_INDEX_DTYPE)
+        self.box_index = self._map(os.path.join(path, 'boxes_index.bin'), BOX_INDEX_DTYPE)
+        radar = self._map(os.path.join(path, 'radar.f4'), RADAR_DTYPE)
+        # whole rows only, the last one may be partly written
+        self.radar = radar[:len(radar) // 4 * 4].reshape(-1, 4)
+        self.boxes = self._map(os.path.join(path, 'boxes.bin'), BOX_DTYPE)
+
+    @staticmethod
+    def _map(filename, dtype):
+        if not os.path.exists(filename) or os.path.getsize(filename) < dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        count = os.path.getsize(filename) // dtype.itemsize
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
+
+    def frame_ids(self):
+        """
+        Returns sorted unique frame ids having radar data or boxes.
+        """
+
+        return np.union1d(self.radar_index['frame_id'], self.box_index['frame_id'])
+
+    def world_frames(self, start=None, stop=None):
+        """
+        Yields (frame_id, points, xyz, transforms, boxes) for every frame with
+        radar data: the (N, 4) radar rows of all measurements of the frame,
+        their (N, 3) world frame positions, the (M, 6) sensor transforms of
+        the measurements and the BOX_DTYPE boxes of the frame.
+        """
+
+        entries = self.radar_index
+        if start is not None or stop is not None:
+            first = entries['frame_id'][0] if start is None else start
+            last = entries['frame_id'][-1] + 1 if stop is None else stop
+            entries = self.radar_entries(first, last)
+        frame_ids, starts = np.unique(entries['frame_id'], return_index=True)
+        ends = np.append(starts[1:], len(entries))
+        for frame_id, begin, end in zip(frame_ids.tolist(), starts.tolist(), ends.tolist()):
+            frame_entries = entries[begin:end]
+            transforms = np.array(frame_entries['transform'])
+            matrices = transform_matrices(transforms[:, :3], transforms[:, 3:])
+            points, xyz = [], []
+            for entry, matrix in zip(frame_entries, matrices):
+                sensor_points = self.radar_points(entry)
+                points.append(sensor_points)
+                xyz.append(RadarPoints.to_world(sensor_points, matrix)[1])
+            yield frame_id, np.concatenate(points), np.concatenate(xyz), transforms, self.box_frames(frame_id)
+
+    def radar_entries(self, start, stop=None):
+        """
+        Returns RADAR_INDEX_DTYPE entries for frames start <= frame_id < stop.
+        """
+
+        return self._slice(self.radar_index, start, stop)
+
+    def radar_points(self, entry):
+        """
+        Returns (N, 4) memmap view on the points of one radar index entry.
+        """
+
+        return self.radar[entry['offset']:entry['offset'] + entry['count']]
+
+    def radar_frames(self, start, stop=None):
+        """
+        Returns index entries and one (N, 4) memmap view covering all radar
+        points of frames start <= frame_id < stop.
+        """
+
+        entries = self.radar_entries(start, stop)
+        if len(entries) == 0:
+            return entries, self.radar[0:0]
+        begin = entries['offset'][0]
+        end = entries['offset'][-1] + entries['count'][-1]
+        return entries, self.radar[begin:end]
+
+    def box_frames(self, start, stop=None):
+        """
+        Returns BOX_DTYPE memmap view of boxes of frames start <= frame_id < stop.
+        """
+
+        entries = self._slice(self.box_index, start, stop)
+        if len(entries) == 0:
+            return self.boxes[0:0]
+        begin = entries['offset'][0]
+        end = entries['offset'][-1] + entries['count'][-1]
+        return self.boxes[begin:end]
+
+    @staticmethod
+    def _slice(index, start, stop):
+        if stop is None:
+            stop = start + 1
+        frame_ids = index['frame_id']
+        first = np.searchsorted(frame_ids, start, side='left')
+        last = np.searchsorted(frame_ids, stop, side='left')
+        return index[first:last]
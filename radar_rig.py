@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Radar rigs: several radars mounted on one vehicle.
+
+A rig is read from a JSON file listing the radars with their mount pose in
+vehicle frame and their sensor attributes:
+
+    {"radars": [
+        {"name": "front", "location": [2.8, 0.0, 1.0], "rotation": [5.0, 0.0, 0.0],
+         "horizontal_fov": 35, "vertical_fov": 20, "range": 100, "points_per_second": 1500},
+        ...]}
+
+rotation is pitch, yaw, roll in degrees. RadarRig.fuse merges the
+measurements of all radars of a frame into one vehicle frame point cloud.
+"""
+
+import collections
+import json
+
+import numpy as np
+
+from radar_processing import RadarPoints
+from radar_processing import transform_matrices
+
+RadarMount = collections.namedtuple('RadarMount', [
+    'name', 'location', 'rotation', 'horizontal_fov', 'vertical_fov', 'range', 'points_per_second'])
+
+# the single front radar of radar_simulation.py
+DEFAULT_MOUNTS = [
+    RadarMount('front', (2.8, 0.0, 1.0), (5.0, 0.0, 0.0), 35.0, 20.0, 100.0, 1500.0)]
+
+# fused radar cloud of one frame. points are the (N, 4) raw detections,
+# sensor_ids the rig index of the radar each point came from. vehicle_xyz is
+# None for clouds fused by the radar pipeline workers
+FusedCloud = collections.namedtuple('FusedCloud', [
+    'points', 'sensor_ids', 'vehicle_xyz', 'world_xyz', 'vehicle_matrix'])
+
+# ==============================================================================
+# -- RadarRig ------------------------------------------------------------------
+# ==============================================================================
+
+
+class RadarRig(object):
+    """
+    Mount poses and sensor attributes of the radars of one vehicle.
+    """
+
+    def __init__(self, mounts=None):
+        self.mounts = list(mounts if mounts is not None else DEFAULT_MOUNTS)
+        if not self.mounts:
+            raise ValueError('a radar rig needs at least one radar')
+        names = [mount.name for mount in self.mounts]
+        if len(set(names)) != len(names):
+            raise ValueError('radar names of a rig must be unique: %s' % names)
+        self.mount_matrices = transform_matrices(
+            [mount.location for mount in self.mounts], [mount.rotation for mount in self.mounts])
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a rig from a JSON file, see the module docstring.
+        """
+
+        with open(path) as fp:
+            config = json.load(fp)
+        mounts = []
+        for index, radar in enumerate(config.get('radars', [])):
+            try:
+                mounts.append(RadarMount(
+                    str(radar.get('name', 'radar%d' % index)),
+                    tuple(float(v) for v in radar.get('location', (0.0, 0.0, 0.0))),
+                    tuple(float(v) for v in radar.get('rotation', (0.0, 0.0, 0.0))),
+                    float(radar.get('horizontal_fov', 30.0)),
+                    float(radar.get('vertical_fov', 30.0)),
+                    float(radar.get('range', 100.0)),
+                    float(radar.get('points_per_second', 1500.0))))
+            except (TypeError, ValueError) as error:
+                raise ValueError('%s: radar %d: %s' % (path, index, error))
+            if len(mounts[-1].location) != 3 or len(mounts[-1].rotation) != 3:
+                raise ValueError('%s: radar %d: location and rotation need three values' % (path, index))
+        return RadarRig(mounts)
+
+    def __len__(self):
+        return len(self.mounts)
+
+    def names(self):
+        return [mount.name for mount in self.mounts]
+
+    def fuse(self, points, sensor_ids, sensor_transforms, depth_offset=0.0):
+        """
+        Merges the measurements of one frame. points is a list of (N_i, 4)
+        radar arrays, sensor_ids their rig indices and sensor_transforms
+        their (x, y, z, pitch, yaw, roll) in world frame. All detections go
+        through the mount matrices to vehicle frame in one pass, the
+        vehicle-to-world matrix comes from the first measurement.
+        Returns FusedCloud.
+        """
+
+        counts = [len(p) for p in points]
+        fused = np.concatenate(points) if points else np.zeros((0, 4), dtype=np.float32)
+        point_sensors = np.repeat(np.asarray(sensor_ids, dtype=np.int64), counts)
+        sensor_xyz = RadarPoints.to_sensor(fused, depth_offset)
+        mounts = self.mount_matrices[point_sensors]
+        vehicle_xyz = np.einsum('nij,nj->ni', mounts[:, :3, :3], sensor_xyz) + mounts[:, :3, 3]
+        if len(sensor_ids):
+            vehicle_matrix = self.vehicle_matrix(sensor_ids[0], sensor_transforms[0])
+        else:
+            vehicle_matrix = np.identity(4)
+        world_xyz = RadarPoints.sensor_to_world(vehicle_xyz, vehicle_matrix)
+        return FusedCloud(fused, point_sensors, vehicle_xyz, world_xyz, vehicle_matrix)
+
+    def fuse_segments(self, points, segments, depth_offset=0.0):
+        """
+        Fuses measurements stored back to back in one (N, 4) array, segments
+        are (sensor_id, offset, count, transform) per measurement.
+        """
+
+        return self.fuse(
+            [points[offset:offset + count] for _, offset, count, _ in segments],
+            [sensor_id for sensor_id, _, _, _ in segments],
+            [transform for _, _, _, transform in segments],
+            depth_offset)
+
+    def vehicle_matrix(self, sensor_id, sensor_transform):
+        """
+        Returns the (4, 4) vehicle-to-world matrix given the world frame
+        (x, y, z, pitch, yaw, roll) of the radar with rig index sensor_id.
+        """
+
+        transform = np.asarray(sensor_transform, dtype=np.float64)
+        sensor_matrix = transform_matrices([transform[:3]], [transform[3:]])[0]
+        return np.dot(sensor_matrix, np.linalg.inv(self.mount_matrices[sensor_id]))
+
+    def offset_depth(self, cloud, depth_offset):
+        """
+        Returns (N, 3) world frame points of a FusedCloud moved depth_offset
+        meters along the line of sight towards their radar, the same as
+        fusing with depth_offset without converting the detections again.
+        """
+
+        origins = RadarPoints.sensor_to_world(self.mount_matrices[cloud.sensor_ids, :3, 3], cloud.vehicle_matrix)
+        line = cloud.world_xyz - origins
+        depth = np.sqrt(np.einsum('ij,ij->i', line, line))
+        return origins + line * ((depth - depth_offset) / np.maximum(depth, 1e-9))[:, np.newaxis]
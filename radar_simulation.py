@@ -12,6 +12,8 @@ Controls:
     S            : brake
     AD           : steer
     Space        : hand-brake
+    G            : toggle radar
+    I            : toggle stage timing overlay
     ESC          : quit
 """
 
@@ -23,8 +25,7 @@ Controls:
 import glob
 import os
 import sys
-import math
-import json
+import argparse
 try:
     sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
         sys.version_info.major,
@@ -40,6 +41,9 @@ except IndexError:
 
 import carla
 
+import collections
+import threading
+import time
 import weakref
 import random
 
@@ -56,6 +60,8 @@ try:
     from pygame.locals import K_UP
     from pygame.locals import K_DOWN
     from pygame.locals import K_g
+    from pygame.locals import K_i
+    from pygame.locals import KMOD_CTRL
 
     from pygame.locals import K_q
 except ImportError:
@@ -66,12 +72,305 @@ try:
 except ImportError:
     raise RuntimeError('cannot import numpy, make sure numpy package is installed')
 
+from radar_clustering import ClusterTracker
+from radar_clustering import RadarClustering
+from radar_pipeline import RadarPipeline
+from radar_processing import BoxGrid
+from radar_processing import RadarPoints
+from radar_processing import RadarPrefilter
+from radar_processing import box_corners
+from radar_recording import AnnotationSink
+from radar_recording import FrameRecorder
+from radar_recording import cluster_records
+from radar_recording import labelled_cloud_records
+from radar_recording import point_records
+from tick_profiler import TickProfiler
+from radar_processing import transform_matrices
+from radar_rig import RadarRig
+from scenario_spawner import ScenarioSpawner
+from scenario_spawner import get_traffic_manager
+
 VIEW_WIDTH = 1920//2
 VIEW_HEIGHT = 1080//2
 VIEW_FOV = 90
 
 BB_COLOR = (248, 64, 24)
 
+# corner order walking all 12 box edges in one polyline, three edges are
+# traced twice: base 0-1-2-3-0, top 4-5-6-7-4 and the verticals in between
+BB_EDGE_PATH = [0, 1, 2, 3, 0, 4, 5, 1, 5, 6, 2, 6, 7, 3, 7, 4]
+
+OUTPUT_DIR = 'output'
+
+# bounding boxes of actors farther from the camera are not drawn
+BOX_RANGE = 150.0
+
+# frames of ground-truth boxes kept for radar measurements still in flight
+GROUND_TRUTH_FRAMES = 256
+
+# ActorGrid cell indices are packed as two int32 into one int64 key
+GRID_CELL_MIN = -2 ** 31
+GRID_CELL_MAX = 2 ** 31 - 1
+
+# ==============================================================================
+# -- ActorStateTable -----------------------------------------------------------
+# ==============================================================================
+
+
+class ActorStateTable(object):
+    """
+    Dynamic state of every actor of one world snapshot as arrays sorted by
+    actor id: locations, rotations (pitch, yaw, roll in degrees) and
+    velocities. Built once per tick from world.get_snapshot(), which is a
+    single round-trip, instead of calling the getters of each actor.
+    """
+
+    def __init__(self, frame, ids, locations, rotations, velocities):
+        order = np.argsort(ids, kind='stable')
+        self.frame = frame
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)[order]
+        self.rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3)[order]
+        self.velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 3)[order]
+        self._matrices = None
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        """
+        Creates the table from a carla.WorldSnapshot.
+        """
+
+        actors = list(snapshot)
+        ids = np.empty(len(actors), dtype=np.int64)
+        values = np.empty((len(actors), 9))
+        for i, actor in enumerate(actors):
+            transform = actor.get_transform()
+            location = transform.location
+            rotation = transform.rotation
+            velocity = actor.get_velocity()
+            ids[i] = actor.id
+            values[i] = (location.x, location.y, location.z,
+                         rotation.pitch, rotation.yaw, rotation.roll,
+                         velocity.x, velocity.y, velocity.z)
+        return ActorStateTable(snapshot.frame, ids, values[:, 0:3], values[:, 3:6], values[:, 6:9])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, actor_id):
+        return self.has_actor(actor_id)
+
+    def has_actor(self, actor_id):
+        row = np.searchsorted(self.ids, actor_id)
+        return row < len(self.ids) and self.ids[row] == actor_id
+
+    def present(self, actors):
+        """
+        Returns the actors that are part of the snapshot.
+        """
+
+        actors = list(actors)
+        if not actors:
+            return []
+        keep = np.isin(np.array([actor.id for actor in actors], dtype=np.int64), self.ids)
+        return [actor for actor, present in zip(actors, keep.tolist()) if present]
+
+    def rows(self, actor_ids):
+        """
+        Returns table rows of actor ids, raises KeyError for unknown ids.
+        """
+
+        actor_ids = np.asarray(actor_ids, dtype=np.int64).reshape(-1)
+        rows = np.minimum(np.searchsorted(self.ids, actor_ids), max(len(self.ids) - 1, 0))
+        if len(actor_ids) and (len(self.ids) == 0 or np.any(self.ids[rows] != actor_ids)):
+            raise KeyError('actors not in snapshot %d' % self.frame)
+        return rows
+
+    def matrices(self, actor_ids):
+        """
+        Returns (N, 4, 4) actor-to-world matrices of actor ids. Matrices of
+        the whole table are computed on first use.
+        """
+
+        if self._matrices is None:
+            self._matrices = transform_matrices(self.locations, self.rotations)
+        return self._matrices[self.rows(actor_ids)]
+
+
+# ==============================================================================
+# -- ActorGrid -----------------------------------------------------------------
+# ==============================================================================
+
+
+class ActorGrid(object):
+    """
+    Uniform XY grid of actor ids by location. update() takes the
+    ActorStateTable of each tick and only moves the actors that changed cell,
+    joined or left since the previous tick.
+    """
+
+    def __init__(self, cell_size=25.0):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _keys(ix, iy):
+        return (np.asarray(ix, dtype=np.int64) << 32) + (np.asarray(iy, dtype=np.int64) & 0xffffffff)
+
+    def update(self, states):
+        ids = states.ids
+        cells = np.floor(states.locations[:, :2] / self.cell_size).astype(np.int64)
+        keys = ActorGrid._keys(cells[:, 0], cells[:, 1])
+        if len(self.ids):
+            rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+            known = self.ids[rows] == ids
+            old_keys = self.keys[rows]
+            left = ~np.isin(self.ids, ids, assume_unique=True)
+        else:
+            known = np.zeros(len(ids), dtype=bool)
+            old_keys = keys
+            left = np.zeros(0, dtype=bool)
+        moved = known & (old_keys != keys)
+        for actor_id, key in zip(self.ids[left].tolist(), self.keys[left].tolist()):
+            self._remove(actor_id, key)
+        for actor_id, old_key, key in zip(ids[moved].tolist(), old_keys[moved].tolist(), keys[moved].tolist()):
+            self._remove(actor_id, old_key)
+            self.cells.setdefault(key, set()).add(actor_id)
+        for actor_id, key in zip(ids[~known].tolist(), keys[~known].tolist()):
+            self.cells.setdefault(key, set()).add(actor_id)
+        self.ids = ids.copy()
+        self.keys = keys
+
+    def _remove(self, actor_id, key):
+        cell = self.cells.get(key)
+        if cell is not None:
+            cell.discard(actor_id)
+            if not cell:
+                del self.cells[key]
+
+    def query(self, x, y, radius):
+        """
+        Returns the set of actor ids in the cells overlapping the square of
+        half size radius around (x, y). If the square covers more cells than
+        are occupied, the occupied cells are filtered instead.
+        """
+
+        center = np.array([x, y], dtype=np.float64)
+        low = np.clip(np.floor((center - radius) / self.cell_size), GRID_CELL_MIN, GRID_CELL_MAX)
+        high = np.clip(np.floor((center + radius) / self.cell_size), GRID_CELL_MIN, GRID_CELL_MAX)
+        (ix0, iy0), (ix1, iy1) = low.astype(np.int64).tolist(), high.astype(np.int64).tolist()
+        cells = self.cells
+        if (ix1 - ix0 + 1) * (iy1 - iy0 + 1) > len(cells):
+            keys = np.fromiter(cells, dtype=np.int64, count=len(cells))
+            ix = keys >> 32
+            iy = ((keys & 0xffffffff) ^ 0x80000000) - 0x80000000
+            keys = keys[(ix >= ix0) & (ix <= ix1) & (iy >= iy0) & (iy <= iy1)]
+        else:
+            ix, iy = np.meshgrid(np.arange(ix0, ix1 + 1), np.arange(iy0, iy1 + 1))
+            keys = ActorGrid._keys(ix.ravel(), iy.ravel())
+        found = set()
+        for key in keys.tolist():
+            cell = cells.get(key)
+            if cell is not None:
+                found.update(cell)
+        return found
+
+
+# ==============================================================================
+# -- ActorGeometryCache --------------------------------------------------------
+# ==============================================================================
+
+
+class ActorGeometryCache(object):
+    """
+    Static bounding box geometry per actor id: the eight box corners in
+    vehicle frame and the radius enclosing them. Entries are filled lazily from
+    actor.bounding_box and live in contiguous arrays, rows of evicted actors
+    are reused.
+    """
+
+    def __init__(self, capacity=64):
+        self.rows = {}
+        self.cords = np.zeros((capacity, 8, 4))
+        self.radii = np.zeros(capacity)
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, actor_id):
+        return actor_id in self.rows
+
+    def get_cords(self, actors):
+        """
+        Returns (N, 8, 4) corners in vehicle frame of actors, computing them
+        only for actors seen for the first time.
+        """
+
+        rows = self._actor_rows(actors)
+        return self.cords[rows]
+
+    def get_radii(self, actors):
+        """
+        Returns (N,) radii of spheres around the actor origins enclosing the
+        bounding boxes.
+        """
+
+        rows = self._actor_rows(actors)
+        return self.radii[rows]
+
+    def _actor_rows(self, actors):
+        rows = self.rows
+        missing = [actor for actor in actors if actor.id not in rows]
+        if missing:
+            self._fill(missing)
+        return [rows[actor.id] for actor in actors]
+
+    def evict(self, actor_id):
+        row = self.rows.pop(actor_id, None)
+        if row is not None:
+            self._free.append(row)
+
+    def evict_missing(self, snapshot):
+        """
+        Evicts actors that are no longer part of the world snapshot, an
+        ActorStateTable.
+        """
+
+        if not self.rows:
+            return
+        actor_ids = np.fromiter(self.rows, dtype=np.int64, count=len(self.rows))
+        for actor_id in actor_ids[~np.isin(actor_ids, snapshot.ids)].tolist():
+            self.evict(actor_id)
+
+    def _fill(self, actors):
+        while len(self._free) < len(actors):
+            self._grow()
+        extents = np.array([[a.bounding_box.extent.x, a.bounding_box.extent.y, a.bounding_box.extent.z]
+                            for a in actors]).reshape(-1, 3)
+        offsets = np.array([[a.bounding_box.location.x, a.bounding_box.location.y, a.bounding_box.location.z]
+                            for a in actors]).reshape(-1, 3)
+        bb_vehicle_matrices = transform_matrices(offsets, np.zeros_like(offsets))
+        box_cords = ClientSideBoundingBoxes._extents_to_cords(extents)
+        cords = np.matmul(box_cords, np.transpose(bb_vehicle_matrices, (0, 2, 1)))
+        rows = [self._free.pop() for _ in actors]
+        self.cords[rows] = cords
+        self.radii[rows] = np.linalg.norm(cords[:, :, :3], axis=2).max(axis=1)
+        for actor, row in zip(actors, rows):
+            self.rows[actor.id] = row
+
+    def _grow(self):
+        capacity = len(self.cords)
+        self.cords = np.concatenate([self.cords, np.zeros((capacity, 8, 4))])
+        self.radii = np.concatenate([self.radii, np.zeros(capacity)])
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+
 # ==============================================================================
 # -- ClientSideBoundingBoxes ---------------------------------------------------
 # ==============================================================================
@@ -83,180 +382,383 @@ class ClientSideBoundingBoxes(object):
     client-side on pygame surface.
     """
 
+    # persistent overlay of draw_bounding_boxes and the rects drawn on it
+    _bb_surface = None
+    _bb_dirty = []
+
     @staticmethod
-    def get_bounding_boxes(vehicles, camera, timestamp):
+    def get_bounding_boxes(vehicles, camera, frame=None, sink=None, states=None, geometry=None):
         """
         Creates 3D bounding boxes based on carla vehicle list and camera.
+        All vehicles are projected at once, see project_bounding_boxes.
+        If sink and frame id are given, box records are queued to box.json.
+        Transforms are taken from states, an ActorStateTable, and box corners
+        from geometry, an ActorGeometryCache, if given.
         """
 
+        vehicles = list(vehicles)
+        if sink is not None and frame is not None:
+            sink.put('box', ClientSideBoundingBoxes.get_bb_records(vehicles, frame, states, geometry))
+        if not vehicles:
+            return np.zeros((0, 8, 3))
 
-
-
-        bounding_boxes = [ClientSideBoundingBoxes.get_bounding_box(vehicle, camera, timestamp) for vehicle in vehicles]
+        vehicle_matrices = ClientSideBoundingBoxes.get_actor_matrices(vehicles, states)
+        bb_cords = ClientSideBoundingBoxes._create_bb_cords(vehicles, geometry)
+        world_sensor_matrix = np.linalg.inv(ClientSideBoundingBoxes.get_actor_matrices([camera], states)[0])
+        bounding_boxes, in_front = ClientSideBoundingBoxes.project_bounding_boxes(
+            vehicle_matrices, bb_cords, world_sensor_matrix, camera.calibration)
 
         # filter objects behind camera
-        bounding_boxes = [bb for bb in bounding_boxes if all(bb[:, 2] > 0)]
-        return bounding_boxes
+        return bounding_boxes[in_front]
 
     @staticmethod
-    def draw_bounding_boxes( display, bounding_boxes):
+    def cull(actors, camera, states, grid=None, max_range=None, geometry=None):
         """
-        Draws bounding boxes on pygame display.
+        Returns the actors whose bounding sphere intersects the camera view
+        frustum, and lies within max_range meters of the camera if given.
+        With an ActorGrid only actors of grid cells in range are tested.
+        Radii come from geometry, an ActorGeometryCache, if given.
         """
 
-
-        bb_surface = pygame.Surface((VIEW_WIDTH, VIEW_HEIGHT))
-        bb_surface.set_colorkey((0, 0, 0))
-        for bbox in bounding_boxes:
-            points = [(int(bbox[i, 0]), int(bbox[i, 1])) for i in range(8)]
-            # draw lines
-            # base
-            pygame.draw.line(bb_surface, BB_COLOR, points[0], points[1])
-            pygame.draw.line(bb_surface, BB_COLOR, points[0], points[1])
-            pygame.draw.line(bb_surface, BB_COLOR, points[1], points[2])
-            pygame.draw.line(bb_surface, BB_COLOR, points[2], points[3])
-            pygame.draw.line(bb_surface, BB_COLOR, points[3], points[0])
-            # top
-            pygame.draw.line(bb_surface, BB_COLOR, points[4], points[5])
-            pygame.draw.line(bb_surface, BB_COLOR, points[5], points[6])
-            pygame.draw.line(bb_surface, BB_COLOR, points[6], points[7])
-            pygame.draw.line(bb_surface, BB_COLOR, points[7], points[4])
-            # base-top
-            pygame.draw.line(bb_surface, BB_COLOR, points[0], points[4])
-            pygame.draw.line(bb_surface, BB_COLOR, points[1], points[5])
-            pygame.draw.line(bb_surface, BB_COLOR, points[2], points[6])
-            pygame.draw.line(bb_surface, BB_COLOR, points[3], points[7])
-        display.blit(bb_surface, (0, 0))
+        camera_matrix = ClientSideBoundingBoxes.get_actor_matrices([camera], states)[0]
+        if grid is not None and max_range is not None:
+            # actor spheres are smaller than a cell, one cell of slack is enough
+            near = grid.query(camera_matrix[0, 3], camera_matrix[1, 3], max_range + grid.cell_size)
+            actors = [actor for actor in actors if actor.id in near]
+        else:
+            actors = list(actors)
+        if not actors:
+            return []
+
+        if geometry is None:
+            geometry = ActorGeometryCache(len(actors))
+        radii = geometry.get_radii(actors)
+        centers = states.locations[states.rows([actor.id for actor in actors])]
+        # camera frame, x forward, y right, z up
+        local = np.dot(centers - camera_matrix[:3, 3], camera_matrix[:3, :3])
+        calibration = np.asarray(camera.calibration)
+        tan_h = calibration[0, 2] / calibration[0, 0]
+        tan_v = calibration[1, 2] / calibration[1, 1]
+        x, y, z = local[:, 0], local[:, 1], local[:, 2]
+        visible = (x > -radii) & \
+            (np.abs(y) <= x * tan_h + radii * np.sqrt(1.0 + tan_h ** 2)) & \
+            (np.abs(z) <= x * tan_v + radii * np.sqrt(1.0 + tan_v ** 2))
+        if max_range is not None:
+            visible &= np.einsum('ij,ij->i', local, local) <= (max_range + radii) ** 2
+        return [actor for actor, keep in zip(actors, visible.tolist()) if keep]
 
     @staticmethod
-    def get_bounding_box(vehicle, camera, timestamp):
+    def project_bounding_boxes(vehicle_matrices, bb_cords, world_sensor_matrix, calibration):
         """
-        Returns 3D bounding box for a vehicle based on camera view.
+        Projects N bounding boxes to camera view in one pass.
+        vehicle_matrices is (N, 4, 4) vehicle-to-world, bb_cords is (N, 8, 4)
+        homogeneous corners in vehicle frame and world_sensor_matrix is the
+        already inverted camera matrix. Returns (N, 8, 3) array of pixel x,
+        pixel y and depth, and (N,) mask of boxes fully in front of camera.
         """
 
+        world_cords = np.matmul(bb_cords, np.transpose(vehicle_matrices, (0, 2, 1)))
+        sensor_cords = np.matmul(world_cords, np.transpose(world_sensor_matrix))
+        # sensor (x, y, z) to camera (y, -z, x)
+        cords_y_minus_z_x = sensor_cords[:, :, [1, 2, 0]] * np.array([1.0, -1.0, 1.0])
+        bbox = np.matmul(cords_y_minus_z_x, np.transpose(np.asarray(calibration)))
+        depth = bbox[:, :, 2]
+        in_front = np.all(depth > 0, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            camera_bbox = np.stack([bbox[:, :, 0] / depth, bbox[:, :, 1] / depth, depth], axis=2)
+        return camera_bbox, in_front
 
+    @staticmethod
+    def draw_bounding_boxes(display, bounding_boxes):
+        """
+        Draws bounding boxes on pygame display.
+        All boxes go to one persistent overlay surface; only the areas drawn
+        last time are cleared and only the area drawn now is blitted.
+        """
 
-        bb_cords = ClientSideBoundingBoxes._create_bb_points(vehicle, timestamp)
-        cords_x_y_z = ClientSideBoundingBoxes._vehicle_to_sensor(bb_cords, vehicle, camera)[:3, :]
-        cords_y_minus_z_x = np.concatenate([cords_x_y_z[1, :], -cords_x_y_z[2, :], cords_x_y_z[0, :]])
-        bbox = np.transpose(np.dot(camera.calibration, cords_y_minus_z_x))
-        camera_bbox = np.concatenate([bbox[:, 0] / bbox[:, 2], bbox[:, 1] / bbox[:, 2], bbox[:, 2]], axis=1)
-        return camera_bbox
+        size = display.get_size()
+        surface = ClientSideBoundingBoxes._bb_surface
+        if surface is None or surface.get_size() != size:
+            surface = pygame.Surface(size)
+            surface.set_colorkey((0, 0, 0))
+            ClientSideBoundingBoxes._bb_surface = surface
+            ClientSideBoundingBoxes._bb_dirty = []
+        for rect in ClientSideBoundingBoxes._bb_dirty:
+            surface.fill((0, 0, 0), rect)
+        ClientSideBoundingBoxes._bb_dirty = []
+        if len(bounding_boxes) == 0:
+            return
+
+        # all 12 edges of every box as one polyline, clipped to a safe int range
+        paths = np.clip(np.asarray(bounding_boxes)[:, BB_EDGE_PATH, :2], -2 ** 30, 2 ** 30).astype(np.int64)
+        dirty = [pygame.draw.lines(surface, BB_COLOR, False, path) for path in paths.tolist()]
+        ClientSideBoundingBoxes._bb_dirty = dirty
+        area = dirty[0].unionall(dirty[1:])
+        display.blit(surface, area.topleft, area)
 
+    @staticmethod
     def get_id(label_name):
         if label_name == "autopilot":
             label_id = 1
-        if label_name == "pedestrian":
+        elif label_name == "pedestrian":
             label_id = 2
         else:
             label_id = 0
         return label_id
 
     @staticmethod
-    def _create_bb_points(vehicle, timestamp):
-        """
-        Returns 3D bounding box for a vehicle.
-        """
-        """get_vehicle = vehicle.get_world()
-        world_snapshot = get_vehicle.get_snapshot()
-        timestamp = world_snapshot.timestamp"""
-        arr = {}
-        cords = np.zeros((8, 4))
-        location = vehicle.get_transform().location
-        extent = vehicle.bounding_box.extent
-        data = [location.x, location.y, location.z]
-        #print(data, timestamp.frame, "+++++++++++")
-        arr["boxloc"] = data
-        label_name = vehicle.attributes["role_name"]
-        label_id = ClientSideBoundingBoxes.get_id(label_name)
-        arr["label_id"] = label_id
-        arr["frame_id"] = timestamp.frame
-        with open('C:\\Users\\NIU2KOR\\Desktop\\CARLA_0.9.8\\WindowsNoEditor\\PythonAPI\\examples\\box.json', 'a+', newline='') as fp:
-            json.dump(arr, fp)
-            fp.write('\n')
-        cords[0, :] = np.array([extent.x, extent.y, -extent.z, 1])
-        cords[1, :] = np.array([-extent.x, extent.y, -extent.z, 1])
-        cords[2, :] = np.array([-extent.x, -extent.y, -extent.z, 1])
-        cords[3, :] = np.array([extent.x, -extent.y, -extent.z, 1])
-        cords[4, :] = np.array([extent.x, extent.y, extent.z, 1])
-        cords[5, :] = np.array([-extent.x, extent.y, extent.z, 1])
-        cords[6, :] = np.array([-extent.x, -extent.y, extent.z, 1])
-        cords[7, :] = np.array([extent.x, -extent.y, extent.z, 1])
-
-
-        return cords
-
+    def get_bb_records(vehicles, frame, states=None, geometry=None):
+        """
+        Returns box.json records (location, world frame box corners, label
+        and actor id) for a list of vehicles.
+        """
 
+        vehicles = list(vehicles)
+        if states is not None:
+            locations = states.locations[states.rows([vehicle.id for vehicle in vehicles])].tolist()
+        else:
+            locations = [ClientSideBoundingBoxes._location_list(vehicle.get_transform()) for vehicle in vehicles]
+        corners = ClientSideBoundingBoxes.get_world_cords(vehicles, states, geometry).tolist()
+        records = []
+        for vehicle, data, box in zip(vehicles, locations, corners):
+            arr = {}
+            arr["boxloc"] = data
+            arr["corners"] = box
+            label_name = vehicle.attributes["role_name"]
+            label_id = ClientSideBoundingBoxes.get_id(label_name)
+            arr["label_id"] = label_id
+            arr["actor_id"] = vehicle.id
+            arr["frame_id"] = frame
+            records.append(arr)
+        return records
 
     @staticmethod
-    def _vehicle_to_sensor(cords, vehicle, sensor):
+    def get_world_cords(vehicles, states=None, geometry=None):
         """
-        Transforms coordinates of a vehicle bounding box to sensor.
+        Returns (N, 8, 3) bounding box corners of vehicles in world frame.
         """
 
-        world_cord = ClientSideBoundingBoxes._vehicle_to_world(cords, vehicle)
-        sensor_cord = ClientSideBoundingBoxes._world_to_sensor(world_cord, sensor)
-        return sensor_cord
+        vehicles = list(vehicles)
+        if not vehicles:
+            return np.zeros((0, 8, 3))
+        vehicle_matrices = ClientSideBoundingBoxes.get_actor_matrices(vehicles, states)
+        bb_cords = ClientSideBoundingBoxes._create_bb_cords(vehicles, geometry)
+        return np.matmul(bb_cords, np.transpose(vehicle_matrices, (0, 2, 1)))[:, :, :3]
 
     @staticmethod
-    def _vehicle_to_world(cords, vehicle):
+    def get_label_ids(vehicles):
         """
-        Transforms coordinates of a vehicle bounding box to world.
+        Returns label ids of a list of vehicles, see get_id.
         """
 
-        bb_transform = carla.Transform(vehicle.bounding_box.location)
+        return [ClientSideBoundingBoxes.get_id(vehicle.attributes["role_name"]) for vehicle in vehicles]
 
-        bb_vehicle_matrix = ClientSideBoundingBoxes.get_matrix(bb_transform)
+    @staticmethod
+    def _create_bb_cords(vehicles, geometry=None):
+        """
+        Returns (N, 8, 4) bounding box corners of vehicles in vehicle frame,
+        including the bounding box offset from the vehicle origin.
+        Corners come from geometry, an ActorGeometryCache, if given and are
+        computed for this call only otherwise.
+        """
 
-        vehicle_world_matrix = ClientSideBoundingBoxes.get_matrix(vehicle.get_transform())
+        if geometry is None:
+            geometry = ActorGeometryCache(max(len(vehicles), 1))
+        return geometry.get_cords(vehicles)
 
-        bb_world_matrix = np.dot(vehicle_world_matrix, bb_vehicle_matrix)
+    @staticmethod
+    def _extents_to_cords(extents):
+        """
+        Returns (N, 8, 4) homogeneous box corners for (N, 3) extents, in the
+        corner order of radar_processing.box_corners.
+        """
 
-        world_cords = np.dot(bb_world_matrix, np.transpose(cords))
-        return world_cords
+        extents = np.asarray(extents, dtype=np.float64).reshape(-1, 3)
+        cords = np.ones((len(extents), 8, 4))
+        cords[:, :, :3] = box_corners(np.zeros_like(extents), extents)
+        return cords
 
     @staticmethod
-    def _world_to_sensor(cords, sensor):
+    def get_actor_matrices(actors, states=None):
         """
-        Transforms world coordinates to sensor.
+        Returns (N, 4, 4) actor-to-world matrices, from the ActorStateTable
+        if given and otherwise from one get_transform call per actor.
         """
 
-        sensor_world_matrix = ClientSideBoundingBoxes.get_matrix(sensor.get_transform())
-        world_sensor_matrix = np.linalg.inv(sensor_world_matrix)
-        sensor_cords = np.dot(world_sensor_matrix, cords)
-        return sensor_cords
+        if states is not None:
+            return states.matrices([actor.id for actor in actors])
+        return ClientSideBoundingBoxes.get_matrices([actor.get_transform() for actor in actors])
+
+    @staticmethod
+    def _location_list(transform):
+        location = transform.location
+        return [location.x, location.y, location.z]
 
     @staticmethod
     def get_matrix(transform):
         """
         Creates matrix from carla transform.
         """
-        box_arr = {}
-        rotation = transform.rotation
-        location = transform.location
-        box_array= [location.x, location.y, location.z]
-        box_arr["box"] = box_array
-        c_y = np.cos(np.radians(rotation.yaw))
-        s_y = np.sin(np.radians(rotation.yaw))
-        c_r = np.cos(np.radians(rotation.roll))
-        s_r = np.sin(np.radians(rotation.roll))
-        c_p = np.cos(np.radians(rotation.pitch))
-        s_p = np.sin(np.radians(rotation.pitch))
-        matrix = np.matrix(np.identity(4))
-        matrix[0, 3] = location.x
-        matrix[1, 3] = location.y
-        matrix[2, 3] = location.z
-        matrix[0, 0] = c_p * c_y
-        matrix[0, 1] = c_y * s_p * s_r - s_y * c_r
-        matrix[0, 2] = -c_y * s_p * c_r - s_y * s_r
-        matrix[1, 0] = s_y * c_p
-        matrix[1, 1] = s_y * s_p * s_r + c_y * c_r
-        matrix[1, 2] = -s_y * s_p * c_r + c_y * s_r
-        matrix[2, 0] = s_p
-        matrix[2, 1] = -c_p * s_r
-        matrix[2, 2] = c_p * c_r
-        return matrix
 
+        return ClientSideBoundingBoxes.get_matrices([transform])[0]
+
+    @staticmethod
+    def get_matrices(transforms):
+        """
+        Creates (N, 4, 4) matrix stack from a list of carla transforms.
+        """
+
+        locations = np.array([[t.location.x, t.location.y, t.location.z] for t in transforms]).reshape(-1, 3)
+        rotations = np.array([[t.rotation.pitch, t.rotation.yaw, t.rotation.roll] for t in transforms]).reshape(-1, 3)
+        return transform_matrices(locations, rotations)
+
+
+# ==============================================================================
+# -- SensorManager -------------------------------------------------------------
+# ==============================================================================
+
+
+class SensorManager(object):
+    """
+    Owns every sensor actor of the client. Each sensor is spawned once and
+    then only switched on and off with listen/stop, destroy() removes all of
+    them.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.sensors = {}
+        self._callbacks = {}
+        self._enabled = set()
+
+    def spawn(self, name, blueprint, transform, attach_to, callback, enabled=True):
+        """
+        Spawns a sensor under name and starts listening if enabled.
+        """
+
+        if name in self.sensors:
+            raise RuntimeError('sensor %r already spawned' % name)
+        sensor = self.world.spawn_actor(blueprint, transform, attach_to=attach_to)
+        self.sensors[name] = sensor
+        self._callbacks[name] = callback
+        if enabled:
+            self.enable(name)
+        return sensor
+
+    def enable(self, name):
+        if name not in self._enabled:
+            self.sensors[name].listen(self._callbacks[name])
+            self._enabled.add(name)
+
+    def disable(self, name):
+        if name in self._enabled:
+            self.sensors[name].stop()
+            self._enabled.discard(name)
+
+    def toggle(self, name):
+        """
+        Switches a sensor on or off, returns True if it is now enabled.
+        """
+
+        if name in self._enabled:
+            self.disable(name)
+        else:
+            self.enable(name)
+        return name in self._enabled
+
+    def is_enabled(self, name):
+        return name in self._enabled
+
+    def destroy(self):
+        """
+        Stops and destroys every spawned sensor.
+        """
+
+        for name, sensor in self.sensors.items():
+            if name in self._enabled:
+                sensor.stop()
+            sensor.destroy()
+        self.sensors.clear()
+        self._callbacks.clear()
+        self._enabled.clear()
+
+
+# ==============================================================================
+# -- SensorSynchronizer --------------------------------------------------------
+# ==============================================================================
+
+
+class SensorSynchronizer(object):
+    """
+    Collects sensor data from listen callbacks in bounded per-sensor queues
+    keyed by data.frame and releases one bundle per simulation frame.
+
+    Counters per sensor:
+        dropped  - data evicted because the queue was full
+        stale    - data that arrived for, or was left behind by, an already
+                   released frame
+        timeouts - bundles released without this sensor's data
+    """
+
+    def __init__(self, max_pending=8, timeout=2.0):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.released_frame = None
+        self.dropped = collections.Counter()
+        self.stale = collections.Counter()
+        self.timeouts = collections.Counter()
+        self._pending = {}
+        self._condition = threading.Condition()
+
+    def put(self, name, data):
+        """
+        Stores sensor data, called from the sensor callback thread.
+        """
+
+        with self._condition:
+            if self.released_frame is not None and data.frame <= self.released_frame:
+                self.stale[name] += 1
+                return
+            pending = self._pending.setdefault(name, collections.OrderedDict())
+            pending[data.frame] = data
+            while len(pending) > self.max_pending:
+                pending.popitem(last=False)
+                self.dropped[name] += 1
+            self._condition.notify_all()
+
+    def get(self, frame, names, timeout=None):
+        """
+        Waits until every sensor in names delivered data for frame, or until
+        timeout, and returns {name: data}. Missing data is None.
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        with self._condition:
+            while not all(frame in self._pending.get(name, ()) for name in names):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            bundle = {}
+            for name in names:
+                data = self._pending.get(name, {}).pop(frame, None)
+                if data is None:
+                    self.timeouts[name] += 1
+                bundle[name] = data
+            for name, pending in self._pending.items():
+                for old_frame in [f for f in pending if f <= frame]:
+                    del pending[old_frame]
+                    self.stale[name] += 1
+            self.released_frame = frame
+            return bundle
+
+    def stats(self):
+        with self._condition:
+            return {
+                'dropped': dict(self.dropped),
+                'stale': dict(self.stale),
+                'timeouts': dict(self.timeouts)}
 
 
 # ==============================================================================
@@ -269,16 +771,61 @@ class BasicSynchronousClient(object):
     Basic implementation of a synchronous client.
     """
 
-    def __init__(self):
+    def __init__(self, output_dir=OUTPUT_DIR, record_dir=None, tracker=None,
+                 host='127.0.0.1', port=2000, fps=60, frames=None, profiler=None, profile_output=None,
+                 headless=False, fixed_delta_seconds=0.05, workers=0, ring_slots=16, rig=None,
+                 box_range=BOX_RANGE, npc_vehicles=0, npc_walkers=0, npc_seed=None, tm_port=8000, prefilter=None,
+                 resolution=(VIEW_WIDTH, VIEW_HEIGHT)):
+        if not box_range > 0:
+            raise ValueError('box_range must be a positive distance, got %r' % box_range)
+        self.host = host
+        self.port = port
+        self.headless = headless
+        self.view_width, self.view_height = resolution
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.fps = 0 if headless else fps
+        self.frames = frames
+        self.profiler = profiler if profiler is not None else TickProfiler()
+        self.profile_output = profile_output
+        self.show_profile = False
+        self.profile_font = None
         self.client = None
         self.world = None
+        self.original_settings = None
         self.camera = None
         self.car = None
-        self.radar = None
+        self.npc_vehicles = npc_vehicles
+        self.npc_walkers = npc_walkers
+        self.npc_seed = npc_seed
+        self.tm_port = tm_port
+        self.traffic_manager = None
+        self.scenario = None
+        self.rig = rig if rig is not None else RadarRig()
+        self.radar_names = ['radar.%s' % name for name in self.rig.names()]
+        self.radars = []
+        self.sensors = None
+        self.states = None
+        self.output_dir = output_dir
+        self.sink = None
+        self.record_dir = record_dir
+        self.recorder = None
+        self.tracker = tracker if tracker is not None else ClusterTracker()
+        self.prefilter = prefilter if prefilter is not None else RadarPrefilter()
+        self.workers = workers
+        self.ring_slots = ring_slots
+        self.pipeline = None
+        self.ground_truth = collections.OrderedDict()
+        self.actor_grid = ActorGrid()
+        # static box geometry of every actor seen so far
+        self.geometry = ActorGeometryCache()
+        self.box_range = box_range
+        self.clusters = None
+        self.tracks = None
 
         self.display = None
         self.image = None
-        self.capture = True
+        self.image_surface = None
+        self.synchronizer = SensorSynchronizer()
         self.velocity_range = 7.5  # m/s
 
     def camera_blueprint(self):
@@ -287,24 +834,32 @@ class BasicSynchronousClient(object):
         """
 
         camera_bp = self.world.get_blueprint_library().find('sensor.camera.rgb')
-        camera_bp.set_attribute('image_size_x', str(VIEW_WIDTH))
-        camera_bp.set_attribute('image_size_y', str(VIEW_HEIGHT))
+        camera_bp.set_attribute('image_size_x', str(self.view_width))
+        camera_bp.set_attribute('image_size_y', str(self.view_height))
         camera_bp.set_attribute('fov', str(VIEW_FOV))
         return camera_bp
 
-    def radar_blueprint(self):
+    def radar_blueprint(self, mount):
         bp = self.world.get_blueprint_library().find('sensor.other.radar')
-        bp.set_attribute('horizontal_fov', str(35))
-        bp.set_attribute('vertical_fov', str(20))
+        bp.set_attribute('horizontal_fov', str(mount.horizontal_fov))
+        bp.set_attribute('vertical_fov', str(mount.vertical_fov))
+        bp.set_attribute('range', str(mount.range))
+        bp.set_attribute('points_per_second', str(int(mount.points_per_second)))
         return bp
 
-    def set_synchronous_mode(self, synchronous_mode):
+    def set_synchronous_mode(self, synchronous_mode, no_rendering_mode=None, fixed_delta_seconds=None):
         """
-        Sets synchronous mode.
+        Sets synchronous mode, and optionally no-rendering mode and a fixed
+        simulation step for headless runs. Settings not given are left as
+        the server has them.
         """
 
         settings = self.world.get_settings()
         settings.synchronous_mode = synchronous_mode
+        if no_rendering_mode is not None:
+            settings.no_rendering_mode = no_rendering_mode
+        if fixed_delta_seconds is not None:
+            settings.fixed_delta_seconds = fixed_delta_seconds
         self.world.apply_settings(settings)
 
     def setup_car(self):
@@ -317,111 +872,243 @@ class BasicSynchronousClient(object):
         location = random.choice(self.world.get_map().get_spawn_points())
         self.car = self.world.spawn_actor(car_bp, location)
 
-    def setup_camera(self,  vehicles):
+    def setup_camera(self):
         """
         Spawns actor-camera to be used to render view.
         Sets calibration for client-side boxes rendering.
         """
-        for vehicle in vehicles:
-            get_vehicle = vehicle.get_world()
-            world_snapshot = get_vehicle.get_snapshot()
-            timestamp = world_snapshot.timestamp
-
-            camera_transform = carla.Transform(carla.Location(x=-5.5, z=2.8), carla.Rotation(pitch=-15))
-            self.camera = self.world.spawn_actor(self.camera_blueprint(), camera_transform, attach_to=self.car)
-            weak_self = weakref.ref(self)
-            self.camera.listen(lambda image: weak_self().set_image(weak_self, image))
-
-            calibration = np.identity(3)
-            calibration[0, 2] = VIEW_WIDTH / 2.0
-            calibration[1, 2] = VIEW_HEIGHT / 2.0
-            calibration[0, 0] = calibration[1, 1] = VIEW_WIDTH / (2.0 * np.tan(VIEW_FOV * np.pi / 360.0))
-            self.camera.calibration = calibration
-
-
-    def setup_radar(self, world, display):
 
-        world_snapshot = world.get_snapshot()
-        timestamp = world_snapshot.timestamp
-        for actor_snapshot in world_snapshot:  # Get the actor and the snapshot information
-            actual_actor = world.get_actor(actor_snapshot.id)
+        camera_transform = carla.Transform(carla.Location(x=-5.5, z=2.8), carla.Rotation(pitch=-15))
+        weak_self = weakref.ref(self)
+        self.camera = self.sensors.spawn(
+            'camera', self.camera_blueprint(), camera_transform, self.car,
+            lambda image: BasicSynchronousClient.set_image(weak_self, image))
 
-            actor_snapshot.get_transform()
-            actor_snapshot.get_velocity()
-            actor_snapshot.get_angular_velocity()
-            actor_snapshot.get_acceleration()
+        calibration = np.identity(3)
+        calibration[0, 2] = self.view_width / 2.0
+        calibration[1, 2] = self.view_height / 2.0
+        calibration[0, 0] = calibration[1, 1] = self.view_width / (2.0 * np.tan(VIEW_FOV * np.pi / 360.0))
+        self.camera.calibration = calibration
 
+    def setup_radar(self):
+        """
+        Spawns the radars of the rig once, they are switched on and off with
+        toggle_radar.
+        """
 
-        self.radar = self.world.spawn_actor(
-            self.radar_blueprint(),
-            carla.Transform(
-                carla.Location(x=2.8, z=1.0),
-                carla.Rotation(pitch=5)),
-            attach_to=self.car)
         weak_self = weakref.ref(self)
-        self.radar.listen(
-            lambda radar_data: BasicSynchronousClient._Radar_callback(weak_self, radar_data, timestamp, world, display))
+        self.radars = [
+            self.sensors.spawn(
+                name,
+                self.radar_blueprint(mount),
+                carla.Transform(carla.Location(*mount.location), carla.Rotation(*mount.rotation)),
+                self.car,
+                lambda radar_data, sensor_id=sensor_id: BasicSynchronousClient._Radar_callback(
+                    weak_self, radar_data, sensor_id))
+            for sensor_id, (name, mount) in enumerate(zip(self.radar_names, self.rig.mounts))]
 
     @staticmethod
-    def _Radar_callback(weak_self, radar_data, timestamp, world, display):
+    def _Radar_callback(weak_self, radar_data, sensor_id=0):
         self = weak_self()
-        array_value = {}
         if not self:
             return
-        # To get a numpy [[vel, altitude, azimuth, depth],...[,,,]]:
-        points = np.frombuffer(radar_data.raw_data, dtype=np.dtype('f4'))
-        points = np.reshape(points, (len(radar_data), 4))
+        with self.profiler.stage('radar.callback'):
+            if self.pipeline is not None:
+                self.pipeline.put(radar_data, sensor_id, len(self.enabled_radars()), self.ego_velocity())
+            else:
+                self.synchronizer.put(self.radar_names[sensor_id], radar_data)
 
+    def ego_velocity(self):
+        """
+        Returns the (3,) world frame velocity of the car for the static gate
+        of the prefilter, None if the gate is off. It is read from the
+        snapshot of the tick, the car is only asked before the first one.
+        """
 
-        current_rot = radar_data.transform.rotation
-        current_loc = radar_data.transform.location
-        loc_arr = [current_loc.x, current_loc.y, current_loc.z]
+        if self.prefilter.static_threshold is None or self.car is None:
+            return None
+        states = self.states
+        if states is not None and states.has_actor(self.car.id):
+            return states.velocities[states.rows([self.car.id])[0]].copy()
+        velocity = self.car.get_velocity()
+        return np.array([velocity.x, velocity.y, velocity.z])
 
+    def enabled_radars(self):
+        """
+        Returns the sensor names of the radars currently listening.
+        """
 
+        if self.sensors is None:
+            return []
+        return [name for name in self.radar_names if name in self.sensors.sensors and self.sensors.is_enabled(name)]
 
+    def process_radar(self, measurements):
+        """
+        Fuses, clusters and records the radar measurements of a frame, a list
+        of (sensor_id, radar_data). Clustering runs once on the fused cloud.
+        """
+
+        profiler = self.profiler
+        with profiler.stage('radar.convert'):
+            # To get a numpy [[vel, altitude, azimuth, depth],...[,,,]]:
+            points = [RadarPoints.from_buffer(radar_data.raw_data) for _, radar_data in measurements]
+            transforms = [
+                BasicSynchronousClient._transform_tuple(radar_data.transform) for _, radar_data in measurements]
+            if self.prefilter.enabled:
+                with profiler.stage('radar.prefilter'):
+                    ego_velocity = self.ego_velocity()
+                    points = [self.prefilter.apply(p, ego_velocity, transform[3:])
+                              for p, transform in zip(points, transforms)]
+            offsets = np.cumsum([0] + [len(p) for p in points])
+            segments = [
+                (sensor_id, int(offset), len(p), transform)
+                for (sensor_id, _), offset, p, transform in zip(measurements, offsets, points, transforms)]
+            cloud = self.rig.fuse(
+                points, [segment[0] for segment in segments], [segment[3] for segment in segments])
+        frame = measurements[0][1].frame
+        with profiler.stage('radar.cluster'):
+            self.clusters, self.tracks = self.tracker.step(
+                cloud.points, cloud.world_xyz, measurements[0][1].timestamp)
+        self._finish_radar(frame, cloud, segments)
+
+    def process_radar_result(self, result):
+        """
+        Tracks and records a radar frame fused and clustered by the pipeline
+        workers, then hands its ring buffer slot back.
+        """
+
+        try:
+            if result.error is not None:
+                print('radar worker failed on frame %d:\n%s' % (result.frame, result.error))
+                return
+            cloud = self.pipeline.cloud(result)
+            with self.profiler.stage('radar.track'):
+                self.clusters = result.clusters
+                self.tracks = self.tracker.update(result.clusters, result.timestamp)
+            self._finish_radar(
+                result.frame, cloud, result.segments, result.point_text, self.pipeline.labels(result))
+        finally:
+            self.pipeline.release(result)
+
+    def _finish_radar(self, frame, cloud, segments, point_text=None, labels=None):
+        """
+        Labels, draws and records a clustered FusedCloud. labels are per
+        point actor ids and label ids if already known, see label_radar.
+        """
 
-        for detect in radar_data:
-            azi = math.degrees(detect.azimuth)
-            alt = math.degrees(detect.altitude)
-            # The 0.25 adjusts a bit the distance so the dots can
-            # be properly seen
-            fw_vec = carla.Vector3D(x=detect.depth - 0.25)
-            carla.Transform(
-                carla.Location(),
-                carla.Rotation(
-                    pitch=current_rot.pitch + alt,
-                    yaw=current_rot.yaw + azi,
-                    roll=current_rot.roll)).transform(fw_vec)
+        profiler = self.profiler
+        if labels is None:
+            with profiler.stage('radar.label'):
+                labels = self.label_radar(frame, cloud.world_xyz)
+        actor_ids, label_ids = labels
 
-            def clamp(min_v, max_v, value):
-                return max(min_v, min(value, max_v))
+        if not self.headless:
+            with profiler.stage('radar.draw'):
+                self._draw_radar(cloud)
 
-            norm_velocity = detect.velocity / self.velocity_range  # range [-1, 1]
-            r = int(clamp(0.0, 1.0, 1.0 - norm_velocity) * 255.0)
-            g = int(clamp(0.0, 1.0, 1.0 - abs(norm_velocity)) * 255.0)
-            b = int(abs(clamp(- 1.0, 0.0, - 1.0 - norm_velocity)) * 255.0)
+        with profiler.stage('radar.record'):
+            self._record_radar(frame, cloud, segments, point_text)
+            if self.sink is not None:
+                self.sink.put('labelled_cloud', labelled_cloud_records(
+                    frame, cloud.vehicle_matrix[:3, 3].tolist(), cloud.world_xyz, cloud.points[:, 0],
+                    cloud.sensor_ids, actor_ids, label_ids))
+
+    @staticmethod
+    def _transform_tuple(transform):
+        location = transform.location
+        rotation = transform.rotation
+        return (location.x, location.y, location.z, rotation.pitch, rotation.yaw, rotation.roll)
+
+    def store_ground_truth(self, frame, actors, states):
+        """
+        Keeps the actors of a frame, with the ActorStateTable of that frame,
+        for labelling radar measurements that are processed later.
+        """
+
+        self.ground_truth[frame] = (actors, states)
+        while len(self.ground_truth) > GROUND_TRUTH_FRAMES:
+            self.ground_truth.popitem(last=False)
+
+    def send_ground_truth(self, frame, actors, states):
+        """
+        Hands the boxes of the actors of a frame to the radar pipeline, whose
+        workers label the radar points of that frame.
+        """
+
+        self.pipeline.put_boxes(
+            frame, ClientSideBoundingBoxes.get_world_cords(actors, states, self.geometry),
+            [actor.id for actor in actors], ClientSideBoundingBoxes.get_label_ids(actors))
+
+    def label_radar(self, frame, world_xyz):
+        """
+        Returns per point actor ids and label ids of the ground-truth boxes
+        of frame that contain the (N, 3) world frame points, -1 for points
+        in no box or for frames without ground truth.
+        """
+
+        actor_ids = np.full(len(world_xyz), -1, dtype=np.int64)
+        label_ids = np.full(len(world_xyz), -1, dtype=np.int64)
+        # measurements arrive in frame order, older frames are not needed
+        while self.ground_truth and next(iter(self.ground_truth)) < frame:
+            self.ground_truth.popitem(last=False)
+        if frame not in self.ground_truth:
+            return actor_ids, label_ids
+        actors, states = self.ground_truth.pop(frame)
+        if not actors:
+            return actor_ids, label_ids
+        grid = BoxGrid(ClientSideBoundingBoxes.get_world_cords(actors, states, self.geometry))
+        boxes = grid.assign(world_xyz)
+        hit = boxes >= 0
+        actor_ids[hit] = np.array([actor.id for actor in actors], dtype=np.int64)[boxes[hit]]
+        label_ids[hit] = np.array(ClientSideBoundingBoxes.get_label_ids(actors), dtype=np.int64)[boxes[hit]]
+        return actor_ids, label_ids
+
+    def _draw_radar(self, cloud):
+        """
+        Draws radar detections into the simulator, coloured by velocity.
+        """
+
+        # The 0.25 adjusts a bit the distance so the dots can
+        # be properly seen
+        draw_xyz = self.rig.offset_depth(cloud, 0.25)
+        colors = RadarPoints.velocity_colors(cloud.points[:, 0], self.velocity_range)
+
+        for (x, y, z), (r, g, b) in zip(draw_xyz.tolist(), colors.tolist()):
             self.world.debug.draw_point(
-                radar_data.transform.location + fw_vec,
+                carla.Location(x=x, y=y, z=z),
                 size=0.075,
                 life_time=0.06,
                 persistent_lines=False,
                 color=carla.Color(r, g, b))
-            loc_arr = [radar_data.transform.location.x , radar_data.transform.location.y, radar_data.transform.location.z]
 
-            array_value["loc_arr"] = loc_arr
-            array_value["frame_id"] = timestamp.frame
-            print(loc_arr, timestamp.frame)
-            with open('C:\\Users\\NIU2KOR\\Desktop\\CARLA_0.9.8\\WindowsNoEditor\\PythonAPI\\examples\\point.json',
-                      'a+', newline='') as fp:
-                json.dump(array_value, fp)
-                fp.write('\n')
+    def _record_radar(self, frame, cloud, segments, point_text=None):
+        if self.recorder is not None:
+            for sensor_id, offset, count, transform in segments:
+                self.recorder.add_radar(frame, cloud.points[offset:offset + count], list(transform), sensor_id)
+
+        if self.sink is not None:
+            if point_text is not None:
+                self.sink.put_serialized('point', point_text, len(cloud.points))
+            else:
+                for _, offset, count, transform in segments:
+                    self.sink.put('point', point_records(
+                        frame, list(transform[:3]), cloud.world_xyz[offset:offset + count],
+                        cloud.points[offset:offset + count, 0]))
+            self.sink.put('cluster', cluster_records(frame, self.clusters, self.tracks.cluster_track_ids))
 
     def toggle_radar(self):
-        if self.radar is None:
-            self.radar = BasicSynchronousClient.setup_radar(self.vehicle)
-        """elif self.radar_sensor.sensor is not None:
-            self.radar_sensor.sensor.destroy()
-            self.radar_sensor = None"""
+        """
+        Switches the radars on or off without respawning them.
+        """
+
+        if not self.radars:
+            self.setup_radar()
+        elif self.enabled_radars():
+            for name in self.radar_names:
+                self.sensors.disable(name)
+        else:
+            for name in self.radar_names:
+                self.sensors.enable(name)
 
     @staticmethod
     def _is_quit_shortcut(key):
@@ -441,6 +1128,8 @@ class BasicSynchronousClient(object):
                     return True
                 if event.key == K_g:
                     self.toggle_radar()
+                if event.key == K_i:
+                    self.show_profile = not self.show_profile
 
         keys = pygame.key.get_pressed()
         if keys[K_ESCAPE]:
@@ -469,28 +1158,99 @@ class BasicSynchronousClient(object):
     @staticmethod
     def set_image(weak_self, img):
         """
-        Sets image coming from camera sensor.
-        The self.capture flag is a mean of synchronization - once the flag is
-        set, next coming image will be stored.
+        Passes image coming from camera sensor to the synchronizer, the image
+        of the current frame is picked up by game_loop.
         """
 
         self = weak_self()
-        if self.capture:
-            self.image = img
-            self.capture = False
+        if not self:
+            return
+        self.synchronizer.put('camera', img)
 
     def render(self, display):
         """
         Transforms image from camera sensor and blits it to main pygame display.
         """
 
-        if self.image is not None:
+        if self.image is None:
+            return
+        size = (self.image.width, self.image.height)
+        try:
+            # BGRA buffer wrapped without copying, the blit is the only copy
+            surface = pygame.image.frombuffer(memoryview(self.image.raw_data), size, 'BGRA')
+            # camera alpha carries no information, blit without blending
+            surface.set_alpha(None)
+        except ValueError:
+            # pygame without BGRA support: reuse one surface and swap channels into it
+            if self.image_surface is None or self.image_surface.get_size() != size:
+                self.image_surface = pygame.Surface(size, depth=24)
             array = np.frombuffer(self.image.raw_data, dtype=np.dtype("uint8"))
             array = np.reshape(array, (self.image.height, self.image.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-            display.blit(surface, (0, 0))
+            pygame.surfarray.blit_array(self.image_surface, array[:, :, 2::-1].swapaxes(0, 1))
+            surface = self.image_surface
+        display.blit(surface, (0, 0))
+
+    def display_frame(self, frame, vehicles, pedestrian, states=None):
+        """
+        Renders camera image and bounding boxes of a frame and handles input.
+        Returns True if the user asked to quit.
+        """
+
+        profiler = self.profiler
+        with profiler.stage('render'):
+            self.render(self.display)
+        frame_actors = list(vehicles) + list(pedestrian)
+        with profiler.stage('boxes'):
+            if self.sink is not None:
+                self.sink.put('box', ClientSideBoundingBoxes.get_bb_records(
+                    frame_actors, frame, states, self.geometry))
+            actors = frame_actors
+            if states is not None:
+                with profiler.stage('cull'):
+                    actors = ClientSideBoundingBoxes.cull(
+                        actors, self.camera, states, self.actor_grid, self.box_range, self.geometry)
+            bounding_boxes = ClientSideBoundingBoxes.get_bounding_boxes(
+                actors, self.camera, states=states, geometry=self.geometry)
+        with profiler.stage('draw'):
+            ClientSideBoundingBoxes.draw_bounding_boxes(self.display, bounding_boxes)
+        self._record_boxes(frame, frame_actors, states)
+        if self.show_profile:
+            self.render_profile(self.display)
+
+        with profiler.stage('flip'):
+            pygame.display.flip()
+
+        with profiler.stage('control'):
+            pygame.event.pump()
+            return self.control(self.car)
+
+    def _record_boxes(self, frame, actors, states=None):
+        """
+        Records the ground-truth boxes of the vehicles and walkers of a frame.
+        """
+
+        if self.recorder is not None:
+            with self.profiler.stage('record'):
+                self.recorder.add_boxes(
+                    frame,
+                    ClientSideBoundingBoxes.get_world_cords(actors, states, self.geometry),
+                    [actor.id for actor in actors],
+                    ClientSideBoundingBoxes.get_label_ids(actors))
+
+    def render_profile(self, display):
+        """
+        Draws the per-stage latency overlay of the profiler.
+        """
+
+        if self.profile_font is None:
+            self.profile_font = pygame.font.Font(pygame.font.get_default_font(), 14)
+        lines = self.profiler.overlay_lines()
+        width = max(self.profile_font.size(line)[0] for line in lines) + 16
+        panel = pygame.Surface((width, 18 * len(lines) + 8))
+        panel.set_alpha(180)
+        display.blit(panel, (0, 0))
+        for i, line in enumerate(lines):
+            display.blit(self.profile_font.render(line, True, (255, 255, 255)), (8, 4 + 18 * i))
 
     def game_loop(self):
         """
@@ -498,61 +1258,128 @@ class BasicSynchronousClient(object):
         """
 
         try:
-            pygame.init()
-
-            self.client = carla.Client('127.0.0.1', 2000)
+            if self.workers:
+                # workers are started before any other thread of the client
+                self.pipeline = RadarPipeline(
+                    self.tracker.clustering, self.rig, self.workers, self.ring_slots,
+                    prefilter=self.prefilter, ground_truth=True).start()
+            if not self.headless:
+                pygame.init()
+            self.sink = AnnotationSink(self.output_dir).start()
+            if self.record_dir is not None:
+                self.recorder = FrameRecorder(self.record_dir)
+
+            self.client = carla.Client(self.host, self.port)
             self.client.set_timeout(2.0)
             self.world = self.client.get_world()
-            world_snapshot = self.world.get_snapshot()
-            self.timestamp = world_snapshot.timestamp
-
-            timestamp = self.timestamp
-            self.set_up_car = self.client.get_world()
-            world_snapshot = self.set_up_car.get_snapshot()
-            self.timestamp = world_snapshot.timestamp
+            self.original_settings = self.world.get_settings()
             self.setup_car()
 
-
-            self.display = pygame.display.set_mode((VIEW_WIDTH, VIEW_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF)
-            pygame_clock = pygame.time.Clock()
-
-            self.set_synchronous_mode(True)
+            if self.headless:
+                self.set_synchronous_mode(True, no_rendering_mode=True, fixed_delta_seconds=self.fixed_delta_seconds)
+                self.traffic_manager = get_traffic_manager(self.client, self.tm_port)
+                self.car.set_autopilot(True, self.traffic_manager.get_port())
+            else:
+                self.display = pygame.display.set_mode(
+                    (self.view_width, self.view_height), pygame.HWSURFACE | pygame.DOUBLEBUF)
+                pygame_clock = pygame.time.Clock()
+                self.set_synchronous_mode(True)
+
+            if self.npc_vehicles or self.npc_walkers:
+                self.scenario = ScenarioSpawner(self.client, self.world, self.npc_seed, tm_port=self.tm_port)
+                self.scenario.spawn(self.npc_vehicles, self.npc_walkers, exclude=[self.car.get_location()])
+                print('scenario: %s' % self.scenario.stats())
 
             vehicles = self.world.get_actors().filter('vehicle.*')
             pedestrian = self.world.get_actors().filter('walker.pedestrian.*')
 
-            self.setup_camera(vehicles)
-
+            self.sensors = SensorManager(self.world)
+            if not self.headless:
+                self.setup_camera()
+            self.setup_radar()
 
+            profiler = self.profiler
+            ticks = 0
             while True:
-                self.world.tick()
-
-                self.capture = True
-                pygame_clock.tick_busy_loop(60)
-                timestamp = self.timestamp
-
-
-                self.render(self.display)
-                bounding_boxes = ClientSideBoundingBoxes.get_bounding_boxes(vehicles, self.camera, timestamp)
-                ClientSideBoundingBoxes.draw_bounding_boxes(self.display, bounding_boxes)
-
-
-                bounding_boxes_walker = ClientSideBoundingBoxes.get_bounding_boxes(pedestrian, self.camera)
-
-                ClientSideBoundingBoxes.draw_bounding_boxes(self.display, bounding_boxes_walker)
-                BasicSynchronousClient.setup_radar(self, self.world, self.display)
-                #BasicSynchronousClient.setup_radar(self, pedestrian)
-
-                pygame.display.flip()
-
-                pygame.event.pump()
-                if self.control(self.car):
+                profiler.begin_tick()
+                with profiler.stage('frame'):
+                    with profiler.stage('world.tick'):
+                        frame = self.world.tick()
+                    with profiler.stage('snapshot'):
+                        self.states = ActorStateTable.from_snapshot(self.world.get_snapshot())
+                        frame_vehicles = self.states.present(vehicles)
+                        frame_pedestrian = self.states.present(pedestrian)
+                        if not self.headless:
+                            self.actor_grid.update(self.states)
+                        if self.pipeline is not None:
+                            self.send_ground_truth(frame, frame_vehicles + frame_pedestrian, self.states)
+                        elif self.enabled_radars():
+                            self.store_ground_truth(frame, frame_vehicles + frame_pedestrian, self.states)
+                    self.geometry.evict_missing(self.states)
+                    with profiler.stage('sync'):
+                        bundle = self.synchronizer.get(frame, [
+                            name for name in self.sensors.sensors if self.sensors.is_enabled(name) and
+                            not (name in self.radar_names and self.pipeline is not None)])
+                    if bundle.get('camera') is not None:
+                        self.image = bundle['camera']
+                    measurements = [(sensor_id, bundle[name]) for sensor_id, name in enumerate(self.radar_names)
+                                    if bundle.get(name) is not None]
+                    if measurements:
+                        with profiler.stage('radar'):
+                            self.process_radar(measurements)
+                    if self.pipeline is not None:
+                        with profiler.stage('radar.results'):
+                            for result in self.pipeline.poll():
+                                self.process_radar_result(result)
+
+                    if self.fps:
+                        with profiler.stage('pacing'):
+                            pygame_clock.tick_busy_loop(self.fps)
+
+                    if self.headless:
+                        with profiler.stage('boxes'):
+                            self.sink.put('box', ClientSideBoundingBoxes.get_bb_records(
+                                frame_vehicles + frame_pedestrian, frame, self.states, self.geometry))
+                        self._record_boxes(frame, frame_vehicles + frame_pedestrian, self.states)
+                        quit = False
+                    else:
+                        quit = self.display_frame(frame, frame_vehicles, frame_pedestrian, self.states)
+                profiler.end_tick()
+                if quit:
+                    return
+                ticks += 1
+                if self.frames is not None and ticks >= self.frames:
                     return
 
         finally:
-            self.set_synchronous_mode(False)
-            self.camera.destroy()
-            self.car.destroy()
+            if self.original_settings is not None:
+                self.world.apply_settings(self.original_settings)
+            if self.sensors is not None:
+                self.sensors.destroy()
+            if self.car is not None:
+                self.car.destroy()
+            if self.traffic_manager is not None:
+                self.traffic_manager.set_synchronous_mode(False)
+            if self.scenario is not None:
+                self.scenario.destroy(synchronous=False)
+                print('scenario: %s' % self.scenario.stats())
+            if self.pipeline is not None:
+                for result in self.pipeline.drain():
+                    self.process_radar_result(result)
+                self.pipeline.close()
+                print('radar pipeline: %s' % self.pipeline.stats())
+            if self.sink is not None:
+                self.sink.close()
+                print('annotations: %(written)d written, %(dropped)d dropped, '
+                      '%(back_pressured)d back-pressured' % self.sink.stats())
+            if self.recorder is not None:
+                self.recorder.close()
+            print('sensor sync: %s' % self.synchronizer.stats())
+            if self.prefilter.enabled:
+                print('radar prefilter: %s' % self.prefilter.stats())
+            self.profiler.stop()
+            if self.profile_output:
+                self.profiler.export(self.profile_output)
             pygame.quit()
 
 
@@ -561,13 +1388,189 @@ class BasicSynchronousClient(object):
 # ==============================================================================
 
 
+def range_argument(text):
+    """
+    Parses a MIN,MAX command line range.
+    """
+
+    try:
+        low, high = (float(value) for value in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected MIN,MAX, got %r' % text)
+    if low > high:
+        raise argparse.ArgumentTypeError('MIN is greater than MAX in %r' % text)
+    return low, high
+
+
 def main():
     """
     Initializes the client-side bounding box demo.
     """
 
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP of the host server (default: %(default)s)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: %(default)s)')
+    argparser.add_argument(
+        '--frames',
+        type=int,
+        help='quit after this many simulation frames')
+    argparser.add_argument(
+        '--headless',
+        action='store_true',
+        help='no window, no drawing and no frame pacing; the server runs in no-rendering mode')
+    argparser.add_argument(
+        '--fixed-delta',
+        metavar='SECONDS',
+        default=0.05,
+        type=float,
+        help='fixed simulation step in headless mode (default: %(default)s)')
+    argparser.add_argument(
+        '--box-range',
+        metavar='METERS',
+        default=BOX_RANGE,
+        type=float,
+        help='draw bounding boxes of actors up to this distance from the camera (default: %(default)s)')
+    argparser.add_argument(
+        '--output-dir',
+        default=OUTPUT_DIR,
+        help='directory for box.json and point.json (default: %(default)s)')
+    argparser.add_argument(
+        '--record',
+        metavar='DIR',
+        help='also write a binary recording of radar frames and boxes to DIR')
+    argparser.add_argument(
+        '--radar-rig',
+        metavar='FILE',
+        help='JSON file with mount pose, FOV, range and points per second of every radar '
+             '(default: one front radar)')
+    argparser.add_argument(
+        '--npc-vehicles',
+        metavar='N',
+        default=0,
+        type=int,
+        help='spawn N NPC vehicles on autopilot in one batch (default: %(default)s)')
+    argparser.add_argument(
+        '--npc-walkers',
+        metavar='N',
+        default=0,
+        type=int,
+        help='spawn N walkers with AI controllers in one batch (default: %(default)s)')
+    argparser.add_argument(
+        '--npc-seed',
+        metavar='S',
+        type=int,
+        help='random seed for NPC blueprints and spawn points')
+    argparser.add_argument(
+        '--tm-port',
+        metavar='P',
+        default=8000,
+        type=int,
+        help='port of the Traffic Manager driving the NPC vehicles (default: %(default)s)')
+    argparser.add_argument(
+        '--eps',
+        default=1.5,
+        type=float,
+        help='radar clustering neighbourhood radius in meters (default: %(default)s)')
+    argparser.add_argument(
+        '--min-samples',
+        default=3,
+        type=int,
+        help='radar clustering minimum neighbours of a core point (default: %(default)s)')
+    argparser.add_argument(
+        '--velocity-weight',
+        default=0.5,
+        type=float,
+        help='meters per m/s of radial velocity difference in clustering distance (default: %(default)s)')
+    argparser.add_argument(
+        '--max-misses',
+        default=3,
+        type=int,
+        help='frames a cluster track may go unmatched before it is retired (default: %(default)s)')
+    argparser.add_argument(
+        '--roi-depth',
+        metavar='MIN,MAX',
+        type=range_argument,
+        help='keep radar detections within this depth range in meters')
+    argparser.add_argument(
+        '--roi-azimuth',
+        metavar='MIN,MAX',
+        type=range_argument,
+        help='keep radar detections within this azimuth range in degrees')
+    argparser.add_argument(
+        '--roi-altitude',
+        metavar='MIN,MAX',
+        type=range_argument,
+        help='keep radar detections within this altitude range in degrees, e.g. 0,15 drops ground returns')
+    argparser.add_argument(
+        '--static-threshold',
+        metavar='M/S',
+        type=float,
+        help='drop radar detections within this radial velocity of a static target, ego motion compensated')
+    argparser.add_argument(
+        '--voxel-size',
+        metavar='METERS',
+        type=float,
+        help='keep one radar detection per voxel of this size')
+    argparser.add_argument(
+        '--workers',
+        metavar='N',
+        default=0,
+        type=int,
+        help='convert, cluster and serialize radar frames in N worker processes (default: 0, in the client)')
+    argparser.add_argument(
+        '--ring-slots',
+        metavar='N',
+        default=16,
+        type=int,
+        help='radar frames in flight with --workers before frames are dropped (default: %(default)s)')
+    argparser.add_argument(
+        '--profile-summary',
+        metavar='N',
+        default=0,
+        type=int,
+        help='print per-stage p50/p95/p99 every N ticks (default: off)')
+    argparser.add_argument(
+        '--profile-output',
+        metavar='FILE',
+        help='write per-stage timing statistics on exit, CSV if FILE ends with .csv, JSON otherwise')
+    argparser.add_argument(
+        '--cprofile',
+        metavar='N',
+        default=0,
+        type=int,
+        help='run cProfile over N ticks after 10 warm-up ticks')
+    argparser.add_argument(
+        '--cprofile-output',
+        metavar='FILE',
+        help='pstats file for --cprofile (default: print top functions)')
+    args = argparser.parse_args()
+
     try:
-        client = BasicSynchronousClient()
+        clustering = RadarClustering(args.eps, args.min_samples, args.velocity_weight)
+        tracker = ClusterTracker(clustering, max_misses=args.max_misses)
+        client = BasicSynchronousClient(
+            output_dir=args.output_dir, record_dir=args.record, tracker=tracker,
+            host=args.host, port=args.port, frames=args.frames,
+            headless=args.headless, fixed_delta_seconds=args.fixed_delta,
+            workers=args.workers, ring_slots=args.ring_slots, box_range=args.box_range,
+            rig=RadarRig.load(args.radar_rig) if args.radar_rig else None,
+            npc_vehicles=args.npc_vehicles, npc_walkers=args.npc_walkers, npc_seed=args.npc_seed,
+            tm_port=args.tm_port,
+            prefilter=RadarPrefilter(
+                args.roi_depth, args.roi_azimuth, args.roi_altitude, args.static_threshold, args.voxel_size),
+            profiler=TickProfiler(
+                summary_every=args.profile_summary, cprofile_ticks=args.cprofile,
+                cprofile_output=args.cprofile_output),
+            profile_output=args.profile_output)
         client.game_loop()
     finally:
         print('EXIT')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Runs the radar_simulation.py pipeline headless against fake_carla.
+
+Without --recording a deterministic synthetic scenario is generated, with
+--recording DIR the frames of a binary recording (--record of
+radar_simulation.py) are replayed. The display uses SDL's dummy video driver
+and frames are not paced, so the run is limited only by our processing.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import fake_carla
+from radar_processing import RadarPrefilter
+
+
+def run(scenario, frames, output_dir=None, record_dir=None, headless=False, workers=0, rig_path=None,
+        npc_vehicles=0, npc_walkers=0, prefilter=None):
+    """
+    Runs game_loop for frames ticks against scenario and returns the client
+    and the wall-clock seconds it took.
+    """
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    fake_carla.install(scenario)
+    import radar_simulation
+
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='radar_replay_')
+    rig = radar_simulation.RadarRig.load(rig_path) if rig_path else None
+    client = radar_simulation.BasicSynchronousClient(
+        output_dir=output_dir, record_dir=record_dir, fps=0, frames=frames, headless=headless, workers=workers,
+        rig=rig, npc_vehicles=npc_vehicles, npc_walkers=npc_walkers, npc_seed=0, prefilter=prefilter)
+    start = time.time()
+    client.game_loop()
+    return client, time.time() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--recording', metavar='DIR', help='replay this binary recording')
+    argparser.add_argument('--frames', default=200, type=int, help='frames to run (default: %(default)s)')
+    argparser.add_argument('--vehicles', default=100, type=int, help='synthetic NPC vehicles (default: %(default)s)')
+    argparser.add_argument('--walkers', default=20, type=int, help='synthetic walkers (default: %(default)s)')
+    argparser.add_argument(
+        '--radar-points', default=1000, type=int, help='synthetic radar points per scan (default: %(default)s)')
+    argparser.add_argument('--seed', default=0, type=int, help='synthetic scenario seed (default: %(default)s)')
+    argparser.add_argument('--output-dir', help='annotation output directory (default: temporary)')
+    argparser.add_argument('--record', metavar='DIR', help='write a binary recording of the run to DIR')
+    argparser.add_argument('--headless', action='store_true', help='run the client in headless mode')
+    argparser.add_argument(
+        '--workers', default=0, type=int, help='radar pipeline worker processes (default: %(default)s)')
+    argparser.add_argument('--radar-rig', metavar='FILE', help='radar rig JSON file (default: one front radar)')
+    argparser.add_argument(
+        '--npc-vehicles', default=0, type=int,
+        help='vehicles spawned by the client in one batch (default: %(default)s)')
+    argparser.add_argument(
+        '--npc-walkers', default=0, type=int,
+        help='walkers spawned by the client in one batch (default: %(default)s)')
+    argparser.add_argument(
+        '--static-threshold', type=float, help='radar prefilter static gate in m/s (default: off)')
+    argparser.add_argument('--voxel-size', type=float, help='radar prefilter voxel size in meters (default: off)')
+    args = argparser.parse_args()
+
+    if args.recording:
+        scenario = fake_carla.RecordedScenario(args.recording)
+    else:
+        # one spawn point for the ego car and one per NPC vehicle
+        scenario = fake_carla.SyntheticScenario(
+            vehicles=args.vehicles, walkers=args.walkers, radar_points=args.radar_points, seed=args.seed,
+            spawn_points=max(20, args.npc_vehicles + 1))
+    client, seconds = run(
+        scenario, args.frames, args.output_dir, args.record, args.headless, args.workers, args.radar_rig,
+        args.npc_vehicles, args.npc_walkers,
+        RadarPrefilter(static_threshold=args.static_threshold, voxel_size=args.voxel_size))
+    print('%d frames in %.2f s, %.1f frames/s' % (args.frames, seconds, args.frames / max(seconds, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+Batch spawning of NPC vehicles and walkers for load tests.
+
+ScenarioSpawner spawns all vehicles in one client.apply_batch_sync call,
+all walkers in a second one and their AI controllers in a third, instead of
+one spawn_actor round-trip per actor. Vehicles get role_name 'autopilot' and
+walkers 'pedestrian', the labels 1 and 2 of ClientSideBoundingBoxes.get_id.
+destroy() stops the controllers and removes every spawned actor with one
+more batch; it is safe to call more than once. In synchronous mode the
+Traffic Manager driving the vehicles is switched to synchronous mode as
+well, as CARLA requires, and back on destroy().
+
+    spawner = ScenarioSpawner(client, world, seed=0)
+    spawner.spawn(vehicles=300, walkers=100)
+    try:
+        ...
+    finally:
+        spawner.destroy()
+
+Runs against fake_carla as well as a CARLA server.
+"""
+
+import random
+
+import carla
+
+VEHICLE_ROLE = 'autopilot'
+WALKER_ROLE = 'pedestrian'
+
+# spawn points closer than this to an excluded location are not used
+SPAWN_CLEARANCE = 5.0
+
+
+def get_traffic_manager(client, port, synchronous=True):
+    """
+    Returns the Traffic Manager on port. With synchronous it is switched to
+    synchronous mode, which CARLA requires for autopilot vehicles of a world
+    in synchronous mode; switch it back with set_synchronous_mode(False).
+    """
+
+    traffic_manager = client.get_trafficmanager(port)
+    if synchronous:
+        traffic_manager.set_synchronous_mode(True)
+    return traffic_manager
+
+
+# ==============================================================================
+# -- ScenarioSpawner -----------------------------------------------------------
+# ==============================================================================
+
+
+class ScenarioSpawner(object):
+    """
+    Spawns and tears down NPC vehicles and walkers with batch commands.
+    synchronous tells whether the world runs in synchronous mode, the batch
+    calls then tick the world so the new actors exist when they return.
+    """
+
+    def __init__(self, client, world, seed=None, synchronous=True, tm_port=8000):
+        self.client = client
+        self.world = world
+        self.synchronous = synchronous
+        self.tm_port = tm_port
+        self.traffic_manager = None
+        self.random = random.Random(seed)
+        self.vehicle_ids = []
+        self.walker_ids = []
+        self.controller_ids = []
+        self.failed = 0
+        self.destroyed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.destroy()
+
+    def actor_ids(self):
+        return self.controller_ids + self.walker_ids + self.vehicle_ids
+
+    def spawn(self, vehicles=0, walkers=0, exclude=()):
+        """
+        Spawns up to vehicles NPC vehicles on autopilot and walkers walkers
+        with AI controllers. Map spawn points within SPAWN_CLEARANCE meters
+        of an exclude location (e.g. the ego car) are skipped. Returns self.
+        """
+
+        if vehicles:
+            self.spawn_vehicles(vehicles, exclude)
+        if walkers:
+            self.spawn_walkers(walkers)
+        return self
+
+    def spawn_vehicles(self, count, exclude=()):
+        """
+        Spawns vehicles at shuffled map spawn points, with autopilot switched
+        on in the same batch. Returns the ids of the new vehicles.
+        """
+
+        spawn_points = [
+            point for point in self.world.get_map().get_spawn_points()
+            if all(point.location.distance(location) > SPAWN_CLEARANCE for location in exclude)]
+        if count > len(spawn_points):
+            print('scenario: %d vehicles requested, the map has %d free spawn points' % (count, len(spawn_points)))
+            count = len(spawn_points)
+        self.random.shuffle(spawn_points)
+        blueprints = self.world.get_blueprint_library().filter('vehicle.*')
+        if self.traffic_manager is None:
+            self.traffic_manager = get_traffic_manager(self.client, self.tm_port, self.synchronous)
+        tm_port = self.traffic_manager.get_port()
+
+        batch = []
+        for transform in spawn_points[:count]:
+            blueprint = self.random.choice(blueprints)
+            if blueprint.has_attribute('color'):
+                blueprint.set_attribute(
+                    'color', self.random.choice(blueprint.get_attribute('color').recommended_values))
+            blueprint.set_attribute('role_name', VEHICLE_ROLE)
+            batch.append(carla.command.SpawnActor(blueprint, transform).then(
+                carla.command.SetAutopilot(carla.command.FutureActor, True, tm_port)))
+        actor_ids = self._apply(batch)
+        self.vehicle_ids.extend(actor_ids)
+        return actor_ids
+
+    def spawn_walkers(self, count, max_speed=(1.0, 2.0)):
+        """
+        Spawns walkers at random navigation mesh locations, then one AI
+        controller per walker that walks it to another random location at a
+        speed drawn from max_speed. Returns the ids of the new walkers.
+        """
+
+        blueprints = self.world.get_blueprint_library().filter('walker.pedestrian.*')
+        batch = []
+        for _ in range(count):
+            location = self.world.get_random_location_from_navigation()
+            if location is None:
+                self.failed += 1
+                continue
+            blueprint = self.random.choice(blueprints)
+            if blueprint.has_attribute('is_invincible'):
+                blueprint.set_attribute('is_invincible', 'false')
+            blueprint.set_attribute('role_name', WALKER_ROLE)
+            batch.append(carla.command.SpawnActor(blueprint, carla.Transform(location)))
+        walker_ids = self._apply(batch)
+        self.walker_ids.extend(walker_ids)
+
+        controller_bp = self.world.get_blueprint_library().find('controller.ai.walker')
+        controller_ids = self._apply([
+            carla.command.SpawnActor(controller_bp, carla.Transform(), walker_id) for walker_id in walker_ids])
+        self.controller_ids.extend(controller_ids)
+        # controllers have no batch command, one call each
+        for controller in self.world.get_actors(controller_ids):
+            controller.start()
+            controller.go_to_location(self.world.get_random_location_from_navigation())
+            controller.set_max_speed(self.random.uniform(*max_speed))
+        return walker_ids
+
+    def destroy(self, synchronous=None):
+        """
+        Stops the walker controllers and destroys all spawned actors in one
+        batch, controllers first. If the batch call itself fails the actors
+        are destroyed one by one. The actors are forgotten either way, so a
+        second call does nothing. synchronous overrides the world mode given
+        at construction, for teardown after synchronous mode was switched
+        off. Returns the number of actors destroyed. The Traffic Manager is
+        switched back to asynchronous mode after the vehicles are gone.
+        """
+
+        actor_ids = self.actor_ids()
+        if not actor_ids:
+            self._release_traffic_manager()
+            return 0
+        controller_ids = self.controller_ids
+        self.vehicle_ids, self.walker_ids, self.controller_ids = [], [], []
+        try:
+            for controller in self.world.get_actors(controller_ids):
+                controller.stop()
+            responses = self.client.apply_batch_sync(
+                [carla.command.DestroyActor(actor_id) for actor_id in actor_ids],
+                self.synchronous if synchronous is None else synchronous)
+            errors = [response.error for response in responses if response.error]
+        except RuntimeError as error:
+            print('scenario: batch teardown failed (%s), destroying actors one by one' % error)
+            errors = []
+            for actor_id in actor_ids:
+                actor = self.world.get_actor(actor_id)
+                try:
+                    if actor is None or not actor.destroy():
+                        errors.append('actor %d not destroyed' % actor_id)
+                except RuntimeError as error:
+                    errors.append(str(error))
+        if errors:
+            print('scenario: %d of %d actors not destroyed: %s' % (len(errors), len(actor_ids), errors[0]))
+        destroyed = len(actor_ids) - len(errors)
+        self.destroyed += destroyed
+        self._release_traffic_manager()
+        return destroyed
+
+    def _release_traffic_manager(self):
+        if self.traffic_manager is not None and self.synchronous:
+            self.traffic_manager.set_synchronous_mode(False)
+        self.traffic_manager = None
+
+    def _apply(self, batch):
+        """
+        Runs a batch of spawn commands in one round-trip and returns the ids
+        of the actors spawned, failures are counted.
+        """
+
+        if not batch:
+            return []
+        actor_ids = []
+        for response in self.client.apply_batch_sync(batch, self.synchronous):
+            if response.error:
+                self.failed += 1
+            else:
+                actor_ids.append(response.actor_id)
+        return actor_ids
+
+    def stats(self):
+        return {
+            'vehicles': len(self.vehicle_ids),
+            'walkers': len(self.walker_ids),
+            'controllers': len(self.controller_ids),
+            'failed': self.failed,
+            'destroyed': self.destroyed}
@@ -0,0 +1,30 @@
+"""
+Test setup: the repository root on sys.path, SDL without a display and
+fake_carla registered as the carla module before anything imports it.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pytest
+
+import fake_carla
+
+fake_carla.install(fake_carla.SyntheticScenario())
+
+
+@pytest.fixture
+def world():
+    """
+    A fresh fake world of a small deterministic scenario.
+    """
+
+    fake_carla.load_scenario(fake_carla.SyntheticScenario(vehicles=30, walkers=10, seed=3))
+    return fake_carla.Client().get_world()
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from radar_simulation import ActorGrid
+from radar_simulation import ActorStateTable
+
+
+def table(ids, locations):
+    return ActorStateTable(0, ids, locations, np.zeros((len(ids), 3)), np.zeros((len(ids), 3)))
+
+
+def brute_force_query(states, cell_size, x, y, radius):
+    cells = np.floor(states.locations[:, :2] / cell_size)
+    low = np.floor((np.array([x, y]) - radius) / cell_size)
+    high = np.floor((np.array([x, y]) + radius) / cell_size)
+    inside = np.all((cells >= low) & (cells <= high), axis=1)
+    return set(states.ids[inside].tolist())
+
+
+def test_update_and_query_match_brute_force():
+    rng = np.random.RandomState(6)
+    grid = ActorGrid(cell_size=10.0)
+    ids = np.arange(100, 400)
+    locations = rng.uniform(-200.0, 200.0, (len(ids), 3))
+    for tick in range(6):
+        # some actors move a little, some jump, some leave and some join
+        locations += rng.normal(0.0, 2.0, locations.shape)
+        jump = rng.rand(len(ids)) < 0.05
+        locations[jump] = rng.uniform(-200.0, 200.0, (np.count_nonzero(jump), 3))
+        keep = rng.rand(len(ids)) > 0.05
+        ids, locations = ids[keep], locations[keep]
+        joined = np.arange(1000 * (tick + 1), 1000 * (tick + 1) + 20)
+        ids = np.concatenate([ids, joined])
+        locations = np.concatenate([locations, rng.uniform(-200.0, 200.0, (len(joined), 3))])
+        states = table(ids, locations)
+        grid.update(states)
+
+        fresh = ActorGrid(cell_size=10.0)
+        fresh.update(states)
+        assert grid.cells == fresh.cells and len(grid) == len(ids)
+        # small squares look cells up, large ones filter the occupied cells
+        for radius in (0.0, 5.0, 35.0, 1e12):
+            x, y = rng.uniform(-220.0, 220.0, 2)
+            assert grid.query(x, y, radius) == brute_force_query(states, 10.0, x, y, radius)
+
+
+def test_empty_grid_and_table():
+    grid = ActorGrid()
+    assert grid.query(0.0, 0.0, 100.0) == set()
+    grid.update(table([5, 7], [(1.0, 1.0, 0.0), (-30.0, 2.0, 0.0)]))
+    assert grid.query(0.0, 0.0, 1.0) == {5}
+    grid.update(table([], np.zeros((0, 3))))
+    assert len(grid) == 0 and grid.cells == {}
+
+
+@pytest.mark.parametrize('x, y', [(-1e15, 3.0), (3.0, 1e15)])
+def test_query_far_away_is_clipped(x, y):
+    grid = ActorGrid()
+    grid.update(table([1, 2], [(0.0, 0.0, 0.0), (1e14, 1e14, 0.0)]))
+    assert grid.query(x, y, 1.0) == set()
+    assert grid.query(0.0, 0.0, 1e16) == {1, 2}
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import carla
+from radar_processing import RadarPrefilter
+from radar_simulation import ActorGeometryCache
+from radar_simulation import ActorStateTable
+from radar_simulation import BasicSynchronousClient
+
+
+def test_from_snapshot_matches_actor_getters(world):
+    world.tick()
+    states = ActorStateTable.from_snapshot(world.get_snapshot())
+    actors = list(world.get_actors())
+    assert len(states) == len(actors) and np.all(np.diff(states.ids) > 0)
+    for actor in actors[::-1]:
+        row = states.rows([actor.id])[0]
+        transform, velocity = actor.get_transform(), actor.get_velocity()
+        np.testing.assert_allclose(states.locations[row], [transform.location.x, transform.location.y,
+                                                           transform.location.z])
+        np.testing.assert_allclose(states.rotations[row], [transform.rotation.pitch, transform.rotation.yaw,
+                                                           transform.rotation.roll])
+        np.testing.assert_allclose(states.velocities[row], [velocity.x, velocity.y, velocity.z])
+    with pytest.raises(KeyError):
+        states.rows([max(states.ids) + 1])
+
+
+def test_present_and_evict_missing(world):
+    actors = list(world.get_actors().filter('vehicle.*'))
+    geometry = ActorGeometryCache(capacity=4)
+    geometry.get_radii(actors)
+    gone = actors[3::4]
+    for actor in gone:
+        actor.destroy()
+    states = ActorStateTable.from_snapshot(world.get_snapshot())
+
+    assert states.present(actors) == [actor for actor in actors if actor not in gone]
+    assert states.present([]) == []
+    geometry.evict_missing(states)
+    assert len(geometry) == len(actors) - len(gone)
+    assert not any(actor.id in geometry for actor in gone)
+    # the freed rows are reused before the cache grows
+    capacity = len(geometry.radii)
+    geometry.get_radii(gone)
+    assert len(geometry.radii) == capacity
+    geometry.evict_missing(ActorStateTable(0, [], [], [], []))
+    assert len(geometry) == 0
+
+
+def test_ego_velocity_is_read_from_the_snapshot(world, monkeypatch):
+    client = BasicSynchronousClient(prefilter=RadarPrefilter(static_threshold=0.5))
+    client.car = world.spawn_actor(world.get_blueprint_library().find('vehicle.synthetic.car'),
+                                   carla.Transform(carla.Location(x=-30.0, y=30.0, z=0.5)))
+    velocity = client.car.get_velocity()
+    # before the first tick the car is asked
+    np.testing.assert_allclose(client.ego_velocity(), [velocity.x, velocity.y, velocity.z])
+
+    world.tick()
+    client.states = ActorStateTable.from_snapshot(world.get_snapshot())
+    monkeypatch.setattr(type(client.car), 'get_velocity', lambda actor: pytest.fail('car asked for velocity'))
+    row = client.states.rows([client.car.id])[0]
+    np.testing.assert_array_equal(client.ego_velocity(), client.states.velocities[row])
+
+    client.prefilter = RadarPrefilter()
+    assert client.ego_velocity() is None
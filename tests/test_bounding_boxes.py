@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+import carla
+import radar_simulation
+from radar_simulation import ActorGeometryCache
+from radar_simulation import ActorGrid
+from radar_simulation import ActorStateTable
+from radar_simulation import ClientSideBoundingBoxes
+
+
+def get_bounding_box(vehicle, camera):
+    """
+    The per-vehicle projection batched by project_bounding_boxes, kept here
+    as the reference.
+    """
+
+    extent = vehicle.bounding_box.extent
+    cords = ClientSideBoundingBoxes._extents_to_cords([[extent.x, extent.y, extent.z]])[0]
+    bb_world_matrix = np.dot(
+        ClientSideBoundingBoxes.get_matrix(vehicle.get_transform()),
+        ClientSideBoundingBoxes.get_matrix(carla.Transform(vehicle.bounding_box.location)))
+    world_cords = np.dot(bb_world_matrix, np.transpose(cords))
+    sensor_cords = np.dot(np.linalg.inv(ClientSideBoundingBoxes.get_matrix(camera.get_transform())), world_cords)
+    cords_y_minus_z_x = np.concatenate([sensor_cords[1, :], -sensor_cords[2, :], sensor_cords[0, :]])
+    bbox = np.transpose(np.dot(camera.calibration, cords_y_minus_z_x.reshape(3, 8)))
+    return np.concatenate([bbox[:, 0:1] / bbox[:, 2:3], bbox[:, 1:2] / bbox[:, 2:3], bbox[:, 2:3]], axis=1)
+
+
+@pytest.fixture
+def scene(world):
+    """
+    Scenario actors with box offsets, a tilted ego vehicle and a camera
+    behind it looking down.
+    """
+
+    library = world.get_blueprint_library()
+    ego = world.spawn_actor(
+        library.find('vehicle.synthetic.car'),
+        carla.Transform(carla.Location(x=-20.0, y=5.0, z=0.5), carla.Rotation(pitch=3.0, yaw=40.0, roll=-2.0)))
+    actors = list(world.get_actors().filter('vehicle.*')) + list(world.get_actors().filter('walker.*'))
+    for index, actor in enumerate(actors):
+        actor.bounding_box = carla.BoundingBox(
+            carla.Location(0.1 * (index % 3), -0.2, actor.bounding_box.extent.z), actor.bounding_box.extent)
+    camera_bp = library.find('sensor.camera.rgb')
+    camera = world.spawn_actor(
+        camera_bp, carla.Transform(carla.Location(x=-5.5, z=2.8), carla.Rotation(pitch=-15, yaw=10)), attach_to=ego)
+    calibration = np.identity(3)
+    calibration[0, 2] = radar_simulation.VIEW_WIDTH / 2.0
+    calibration[1, 2] = radar_simulation.VIEW_HEIGHT / 2.0
+    calibration[0, 0] = calibration[1, 1] = radar_simulation.VIEW_WIDTH / (
+        2.0 * np.tan(radar_simulation.VIEW_FOV * np.pi / 360.0))
+    camera.calibration = calibration
+    world.tick()
+    return actors, camera
+
+
+def test_project_bounding_boxes_matches_per_vehicle_projection(scene):
+    actors, camera = scene
+    expected = [get_bounding_box(actor, camera) for actor in actors]
+    expected = np.array([box for box in expected if np.all(box[:, 2] > 0)])
+    assert 0 < len(expected) < len(actors)
+
+    boxes = ClientSideBoundingBoxes.get_bounding_boxes(actors, camera)
+    np.testing.assert_allclose(boxes, expected, rtol=1e-9, atol=1e-6)
+
+    states = ActorStateTable.from_snapshot(camera.get_world().get_snapshot())
+    boxes = ClientSideBoundingBoxes.get_bounding_boxes(actors, camera, states=states)
+    np.testing.assert_allclose(boxes, expected, rtol=1e-9, atol=1e-6)
+
+    # a cache smaller than the scene grows, and serves the second call
+    geometry = ActorGeometryCache(capacity=4)
+    for _ in range(2):
+        boxes = ClientSideBoundingBoxes.get_bounding_boxes(actors, camera, states=states, geometry=geometry)
+        np.testing.assert_allclose(boxes, expected, rtol=1e-9, atol=1e-6)
+    assert len(geometry) == len(actors)
+
+
+def test_project_bounding_boxes_marks_boxes_behind_camera(scene):
+    actors, camera = scene
+    matrices = ClientSideBoundingBoxes.get_actor_matrices(actors)
+    cords = ClientSideBoundingBoxes._create_bb_cords(actors)
+    world_sensor = np.linalg.inv(ClientSideBoundingBoxes.get_matrix(camera.get_transform()))
+    boxes, in_front = ClientSideBoundingBoxes.project_bounding_boxes(
+        matrices, cords, world_sensor, camera.calibration)
+
+    assert boxes.shape == (len(actors), 8, 3)
+    for actor, box, front in zip(actors, boxes, in_front.tolist()):
+        expected = get_bounding_box(actor, camera)
+        assert front == bool(np.all(expected[:, 2] > 0))
+        np.testing.assert_allclose(box[:, 2], expected[:, 2], rtol=1e-9, atol=1e-9)
+
+
+def test_world_cords_are_box_corners_in_world_frame(scene):
+    actors, _ = scene
+    corners = ClientSideBoundingBoxes.get_world_cords(actors)
+    for actor, actor_corners in zip(actors, corners):
+        box = actor.bounding_box
+        center = np.dot(ClientSideBoundingBoxes.get_matrix(actor.get_transform()),
+                        [box.location.x, box.location.y, box.location.z, 1.0])[:3]
+        np.testing.assert_allclose(actor_corners.mean(axis=0), center, atol=1e-9)
+        np.testing.assert_allclose(
+            np.linalg.norm(actor_corners[0] - actor_corners[6]),
+            2.0 * np.linalg.norm([box.extent.x, box.extent.y, box.extent.z]), rtol=1e-9)
+
+
+def test_geometry_of_reused_actor_ids_is_not_shared(scene):
+    actors, _ = scene
+    first = ActorGeometryCache()
+    cords = ClientSideBoundingBoxes._create_bb_cords(actors, first)
+    # a new scenario reusing the actor ids with other boxes, as benchmarks.Bench installs
+    for actor in actors:
+        actor.bounding_box = carla.BoundingBox(actor.bounding_box.location, carla.Vector3D(3.0, 2.0, 1.0))
+    offsets = np.array([[a.bounding_box.location.x, a.bounding_box.location.y, a.bounding_box.location.z]
+                        for a in actors])
+
+    second = ClientSideBoundingBoxes._create_bb_cords(actors, ActorGeometryCache())
+    np.testing.assert_allclose(second[:, :, :3].max(axis=1) - offsets, np.tile([3.0, 2.0, 1.0], (len(actors), 1)))
+    np.testing.assert_array_equal(ClientSideBoundingBoxes._create_bb_cords(actors, first), cords)
+
+
+def in_view(box):
+    """
+    True if a corner of a projected box is in front of the camera and on
+    the image.
+    """
+
+    return bool(np.any((box[:, 2] > 0) & (box[:, 0] >= 0) & (box[:, 0] <= radar_simulation.VIEW_WIDTH) &
+                       (box[:, 1] >= 0) & (box[:, 1] <= radar_simulation.VIEW_HEIGHT)))
+
+
+@pytest.mark.parametrize('max_range', [None, 25.0])
+def test_cull_keeps_every_box_in_view(scene, max_range):
+    actors, camera = scene
+    states = ActorStateTable.from_snapshot(camera.get_world().get_snapshot())
+    camera_xyz = states.locations[states.rows([camera.id])[0]]
+    expected = []
+    for actor in actors:
+        corners = ClientSideBoundingBoxes.get_world_cords([actor])[0]
+        near = max_range is None or np.all(np.linalg.norm(corners - camera_xyz, axis=1) <= max_range)
+        if near and in_view(get_bounding_box(actor, camera)):
+            expected.append(actor)
+
+    geometry = ActorGeometryCache()
+    culled = ClientSideBoundingBoxes.cull(actors, camera, states, max_range=max_range, geometry=geometry)
+    assert set(expected) <= set(culled) and len(culled) < len(actors)
+    assert 0 < len(expected)
+    if max_range is not None:
+        radii = geometry.get_radii(culled)
+        distance = np.linalg.norm(states.locations[states.rows([a.id for a in culled])] - camera_xyz, axis=1)
+        assert np.all(distance <= max_range + radii)
+
+    grid = ActorGrid(cell_size=10.0)
+    grid.update(states)
+    assert ClientSideBoundingBoxes.cull(actors, camera, states, grid, max_range, geometry) == culled
@@ -0,0 +1,106 @@
+import collections
+
+import numpy as np
+import pytest
+
+from cluster_sweep import SweepSession
+from cluster_sweep import frame_quality
+from cluster_sweep import sweep
+from radar_clustering import NOISE
+from radar_clustering import RadarClustering
+from radar_processing import BoxGrid
+from radar_processing import box_corners
+from radar_recording import FrameReader
+from radar_recording import FrameRecorder
+
+
+def brute_force_quality(labels, point_box, boxes, min_box_points):
+    visible = {box for box, count in collections.Counter(point_box.tolist()).items()
+               if box >= 0 and count >= min_box_points}
+    clusters = sorted(set(labels.tolist()) - {NOISE})
+    majority = set()
+    for cluster in clusters:
+        counts = collections.Counter(point_box[labels == cluster].tolist())
+        # ties go to the lowest box, -1 for points in no box
+        majority.add(max(counts.items(), key=lambda item: (item[1], -item[0]))[0])
+    hits = majority - {-1}
+    return len(clusters), len(hits), len(visible), len(hits & visible)
+
+
+def test_frame_quality_example():
+    labels = np.array([0, 0, 0, 1, 1, 2, 2, 2, NOISE, NOISE])
+    point_box = np.array([0, 0, 1, 0, 0, -1, -1, 1, 1, 2])
+    # clusters 0 and 1 both take box 0, cluster 2 is mostly outside boxes
+    assert frame_quality(labels, point_box, 3, min_box_points=3) == (3, 1, 2, 1)
+    assert frame_quality(labels, point_box, 3, min_box_points=1) == (3, 1, 3, 1)
+    assert frame_quality(np.full(4, NOISE), np.array([0, 0, 0, -1]), 1) == (0, 0, 1, 0)
+    assert frame_quality(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0) == (0, 0, 0, 0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_frame_quality_matches_brute_force(seed):
+    rng = np.random.RandomState(seed)
+    boxes = rng.randint(1, 8)
+    count = rng.randint(1, 300)
+    labels = rng.randint(-1, rng.randint(1, 10), count)
+    point_box = rng.randint(-1, boxes, count)
+    for min_box_points in (1, 3, 10):
+        assert frame_quality(labels, point_box, boxes, min_box_points) == \
+            brute_force_quality(labels, point_box, boxes, min_box_points)
+
+
+def record_session(path, frames=8):
+    """
+    Records frames of one radar at the origin seeing points around a few
+    boxes plus clutter.
+    """
+
+    rng = np.random.RandomState(7)
+    recorder = FrameRecorder(path)
+    for frame in range(1, frames + 1):
+        count = rng.randint(1, 5)
+        centers = np.column_stack([rng.uniform(10.0, 40.0, count), rng.uniform(-15.0, 15.0, count),
+                                   np.ones(count)])
+        extents = np.tile([2.0, 1.0, 0.8], (count, 1))
+        xyz = np.concatenate(
+            [center + rng.uniform(-1.0, 1.0, (rng.randint(2, 30), 3)) * extents[0] for center in centers] +
+            [rng.uniform((5.0, -20.0, 0.0), (50.0, 20.0, 2.0), (rng.randint(0, 20), 3))])
+        depth = np.linalg.norm(xyz, axis=1)
+        points = np.column_stack([rng.uniform(-5.0, 5.0, len(xyz)), np.arcsin(xyz[:, 2] / depth),
+                                  np.arctan2(xyz[:, 1], xyz[:, 0]), depth]).astype(np.float32)
+        recorder.add_radar(frame, points, (0.0,) * 6)
+        recorder.add_boxes(frame, box_corners(centers, extents), np.arange(count) + 100, np.ones(count))
+    recorder.close()
+
+
+def test_sweep_matches_serial_scoring(tmp_path):
+    recording, cache = str(tmp_path / 'recording'), str(tmp_path / 'session')
+    record_session(recording)
+    session = SweepSession.from_recording(recording, cache)
+    assert len(session) == 8 and SweepSession.matches(cache, recording)
+    assert not SweepSession.matches(cache, recording, (2.5, 2.5, 1.0))
+    for entry, (frame_id, _, xyz, _, boxes) in zip(session.index, FrameReader(recording).world_frames()):
+        assert entry['frame_id'] == frame_id and entry['boxes'] == len(boxes)
+        np.testing.assert_allclose(session.frame(entry)[0], xyz, rtol=1e-6)
+        np.testing.assert_array_equal(session.frame(entry)[2], BoxGrid(boxes['corners']).assign(xyz))
+
+    configs = [(1.0, 2, 0.0), (2.5, 3, 0.5), (4.0, 2, 1.0)]
+    reported = []
+    results = sweep(cache, configs, processes=2, frame_step=2, min_box_points=2, progress=reported.append)
+    assert sorted(result['eps'] for result in reported) == [1.0, 2.5, 4.0]
+
+    for config, result in zip(configs, results):
+        clustering = RadarClustering(*config)
+        totals = np.zeros(4, dtype=np.int64)
+        points = 0
+        for entry in session.index[::2]:
+            xyz, velocity, point_box = session.frame(entry)
+            labels = clustering.fit(np.asarray(xyz, dtype=np.float64), np.asarray(velocity, dtype=np.float64))
+            totals += frame_quality(labels, point_box, int(entry['boxes']), 2)
+            points += len(xyz)
+        clusters, hits, visible, visible_hit = totals.tolist()
+        assert (result['eps'], result['min_samples'], result['velocity_weight']) == config
+        assert result['frames'] == 4 and result['points'] == points and result['clusters'] == clusters
+        assert result['precision'] == pytest.approx(hits / float(clusters))
+        assert result['recall'] == pytest.approx(visible_hit / float(visible))
+    assert max(result['f1'] for result in results) > 0.5
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import fake_carla
+from radar_simulation import BasicSynchronousClient
+
+
+@pytest.fixture
+def traffic_manager_modes(monkeypatch):
+    # (port, mode) of every set_synchronous_mode call
+    modes = []
+    set_synchronous_mode = fake_carla.TrafficManager.set_synchronous_mode
+
+    def record(self, mode=True):
+        modes.append((self.port, mode))
+        set_synchronous_mode(self, mode)
+
+    monkeypatch.setattr(fake_carla.TrafficManager, 'set_synchronous_mode', record)
+    return modes
+
+
+def run_headless(tmp_path, **kwargs):
+    """
+    Runs a headless client for five frames, returns it and the fake world.
+    """
+
+    fake_carla.load_scenario(fake_carla.SyntheticScenario(vehicles=20, walkers=5, radar_points=200, seed=4))
+    world = fake_carla.Client().get_world()
+    client = BasicSynchronousClient(output_dir=str(tmp_path), headless=True, frames=5, **kwargs)
+    client.game_loop()
+    return client, world
+
+
+def test_headless_ego_autopilot_runs_on_synchronous_traffic_manager(tmp_path, monkeypatch, traffic_manager_modes):
+    autopilot = []
+    monkeypatch.setattr(fake_carla.Vehicle, 'set_autopilot',
+                        lambda self, enabled=True, *args: autopilot.append((enabled,) + args))
+
+    _, world = run_headless(tmp_path, tm_port=8123)
+
+    assert autopilot == [(True, 8123)]
+    assert traffic_manager_modes == [(8123, True), (8123, False)]
+    assert not world.get_settings().synchronous_mode and not world.get_settings().no_rendering_mode
+
+
+def test_headless_run_writes_annotations(tmp_path, traffic_manager_modes):
+    run_headless(tmp_path)
+
+    with open(str(tmp_path / 'box.json')) as fp:
+        boxes = [json.loads(line) for line in fp]
+    # the ego car has role name hero, label 0
+    assert sorted(set(record['label_id'] for record in boxes)) == [0, 1, 2]
+    assert len(set(record['frame_id'] for record in boxes)) == 5
+    assert traffic_manager_modes[-1] == (8000, False)
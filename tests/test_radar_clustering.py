@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+
+from radar_clustering import NOISE
+from radar_clustering import ClusterTracker
+from radar_clustering import RadarClustering
+from radar_processing import ALTITUDE
+from radar_processing import AZIMUTH
+from radar_processing import DEPTH
+from radar_processing import VELOCITY
+
+
+def brute_force_dbscan(xyz, velocity, eps, min_samples, velocity_weight):
+    """
+    Returns core mask, (N, N) neighbour matrix and component labels of the
+    core points, NOISE elsewhere, from the full distance matrix.
+    """
+
+    features = np.column_stack([xyz, velocity_weight * velocity])
+    delta = features[:, np.newaxis, :] - features[np.newaxis, :, :]
+    neighbours = np.einsum('ijk,ijk->ij', delta, delta) <= eps * eps
+    core = neighbours.sum(axis=1) >= min_samples
+    labels = np.full(len(xyz), NOISE, dtype=np.int64)
+    cluster = 0
+    for seed in np.nonzero(core)[0].tolist():
+        if labels[seed] != NOISE:
+            continue
+        labels[seed] = cluster
+        stack = [seed]
+        while stack:
+            point = stack.pop()
+            for other in np.nonzero(neighbours[point] & core & (labels == NOISE))[0].tolist():
+                labels[other] = cluster
+                stack.append(other)
+        cluster += 1
+    return core, neighbours, labels
+
+
+def blobs(rng, centers, count, spread):
+    xyz = np.concatenate([center + rng.normal(0.0, spread, (count, 3)) for center in centers])
+    velocity = np.repeat(rng.uniform(-10.0, 10.0, len(centers)), count) + rng.normal(0.0, 0.3, len(xyz))
+    clutter = rng.uniform(-40.0, 40.0, (count, 3))
+    return np.concatenate([xyz, clutter]), np.concatenate([velocity, rng.uniform(-10.0, 10.0, count)])
+
+
+@pytest.mark.parametrize('eps, min_samples, velocity_weight', [(1.5, 3, 0.5), (2.5, 5, 0.0), (1.0, 2, 1.0)])
+def test_fit_matches_brute_force_dbscan(eps, min_samples, velocity_weight):
+    rng = np.random.RandomState(5)
+    centers = rng.uniform(-30.0, 30.0, (12, 3))
+    xyz, velocity = blobs(rng, centers, 40, 0.8)
+
+    labels = RadarClustering(eps, min_samples, velocity_weight).fit(xyz, velocity)
+
+    core, neighbours, expected = brute_force_dbscan(xyz, velocity, eps, min_samples, velocity_weight)
+    # core points: same partition, cluster numbering may differ
+    pairs = set(zip(labels[core].tolist(), expected[core].tolist()))
+    assert len(pairs) == len(set(labels[core].tolist())) == len(set(expected[core].tolist()))
+    assert np.all(labels[core] != NOISE)
+    # border points join the cluster of one of their core neighbours
+    border = ~core & np.any(neighbours & core[np.newaxis, :], axis=1)
+    for point in np.nonzero(border)[0].tolist():
+        assert labels[point] in set(labels[neighbours[point] & core].tolist())
+    assert np.all(labels[~core & ~border] == NOISE)
+    # labels are 0..K-1
+    clustered = labels[labels != NOISE]
+    assert set(clustered.tolist()) == set(range(len(set(clustered.tolist()))))
+
+
+def test_fit_empty_and_cluster_summary():
+    clustering = RadarClustering()
+    assert len(clustering.fit(np.zeros((0, 3)), np.zeros(0))) == 0
+
+    rng = np.random.RandomState(6)
+    xyz, velocity = blobs(rng, [(0.0, 0.0, 0.0), (20.0, 0.0, 0.0)], 30, 0.3)
+    points = np.zeros((len(xyz), 4), dtype=np.float32)
+    points[:, VELOCITY] = velocity
+    clusters = clustering.cluster(points, xyz)
+    assert len(clusters.centroids) == 2
+    for cluster in range(2):
+        members = clusters.labels == cluster
+        np.testing.assert_allclose(clusters.centroids[cluster], xyz[members].mean(axis=0))
+        assert clusters.counts[cluster] == np.count_nonzero(members)
+
+
+def moving_frame(rng, positions, count=25):
+    """
+    Radar points of targets at positions plus clutter, as (points, xyz).
+    """
+
+    xyz = np.concatenate([position + rng.normal(0.0, 0.3, (count, 3)) for position in positions] +
+                         [rng.uniform(-60.0, 60.0, (20, 3))])
+    points = np.zeros((len(xyz), 4), dtype=np.float32)
+    points[:, VELOCITY] = np.concatenate([np.full(count * len(positions), 5.0), rng.uniform(-10.0, 10.0, 20)])
+    points[:, DEPTH] = np.linalg.norm(xyz, axis=1)
+    points[:, AZIMUTH] = np.arctan2(xyz[:, 1], xyz[:, 0])
+    points[:, ALTITUDE] = np.arcsin(xyz[:, 2] / points[:, DEPTH])
+    return points, xyz
+
+
+def test_tracker_keeps_ids_of_moving_targets():
+    rng = np.random.RandomState(7)
+    starts = np.array([[0.0, 0.0, 0.0], [30.0, 10.0, 0.0], [-20.0, -25.0, 0.0]])
+    velocities = np.array([[5.0, 0.0, 0.0], [0.0, -4.0, 0.0], [3.0, 3.0, 0.0]])
+    tracker = ClusterTracker(full_every=3)
+
+    track_ids = []
+    for frame in range(20):
+        timestamp = 0.05 * frame
+        positions = starts + velocities * timestamp
+        points, xyz = moving_frame(rng, positions)
+        clusters, tracks = tracker.step(points, xyz, timestamp)
+        if frame == 0:
+            assert len(tracks.ids) == 0
+            continue
+        # track id of each target, from the cluster nearest to it
+        nearest = np.argmin(np.linalg.norm(
+            clusters.centroids[np.newaxis, :, :] - positions[:, np.newaxis, :], axis=2), axis=1)
+        track_ids.append(tracks.cluster_track_ids[nearest].tolist())
+
+    assert all(ids == track_ids[0] for ids in track_ids)
+    assert -1 not in track_ids[0] and len(set(track_ids[0])) == 3
+    rows = [np.nonzero(tracks.ids == track_id)[0][0] for track_id in track_ids[0]]
+    np.testing.assert_allclose(tracks.positions[rows], positions, atol=0.5)
+    np.testing.assert_allclose(tracks.velocities[rows], velocities, atol=1.5)
+
+
+def test_tracker_retires_lost_tracks_and_gives_new_ids():
+    rng = np.random.RandomState(8)
+    tracker = ClusterTracker(max_misses=2)
+    target = np.array([[10.0, 5.0, 0.0]])
+    for frame in range(3):
+        clusters, tracks = tracker.step(*moving_frame(rng, target), timestamp=0.05 * frame)
+    first_id = tracks.ids[np.argmin(np.linalg.norm(tracks.positions - target, axis=1))]
+
+    # the target disappears long enough to be retired
+    empty = np.zeros((0, 4), dtype=np.float32)
+    for frame in range(3, 7):
+        tracker.update(tracker.clustering.cluster(empty, np.zeros((0, 3))), 0.05 * frame)
+    assert first_id not in tracker.ids.tolist()
+
+    for frame in range(7, 10):
+        _, tracks = tracker.step(*moving_frame(rng, target), timestamp=0.05 * frame)
+    new_id = tracks.ids[np.argmin(np.linalg.norm(tracks.positions - target, axis=1))]
+    assert new_id > first_id
+
+
+@pytest.mark.parametrize('points, tracks', [(3000, 40), (500, 1), (1, 300)])
+def test_near_predictions_matches_brute_force(points, tracks):
+    rng = np.random.RandomState(points + tracks)
+    tracker = ClusterTracker(seed_radius=4.0)
+    tracker.ids = np.arange(tracks)
+    tracker.state = np.column_stack([rng.uniform(-80.0, 80.0, (tracks, 3)), rng.uniform(-10.0, 10.0, (tracks, 3))])
+    tracker.last_timestamp = 1.0
+    xyz = tracker.state[rng.randint(0, tracks, points), :3] + rng.uniform(-6.0, 6.0, (points, 3))
+
+    mask = tracker.near_predictions(xyz, 1.1)
+
+    predicted = tracker.state[:, :3] + 0.1 * tracker.state[:, 3:]
+    delta = xyz[:, np.newaxis, :] - predicted[np.newaxis, :, :]
+    np.testing.assert_array_equal(mask, np.any(np.einsum('ntk,ntk->nt', delta, delta) <= 16.0, axis=1))
+    assert len(tracker.near_predictions(np.zeros((0, 3)), 1.1)) == 0
+
+
+def test_neighbour_pairs_between_two_sets():
+    rng = np.random.RandomState(9)
+    xyz = rng.uniform(-20.0, 20.0, (400, 3))
+    others = rng.uniform(-20.0, 20.0, (30, 3))
+    first, second = RadarClustering.neighbour_pairs(xyz, 3.0, others)
+
+    cells = np.floor(xyz / 3.0)
+    other_cells = np.floor(others / 3.0)
+    adjacent = np.all(np.abs(cells[:, np.newaxis, :] - other_cells[np.newaxis, :, :]) <= 1, axis=2)
+    assert sorted(zip(first.tolist(), second.tolist())) == sorted(zip(*np.nonzero(adjacent)))
@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+import carla
+from radar_clustering import ClusterResult
+from radar_clustering import greedy_assignment
+from radar_evaluation import ClusterEvaluator
+from radar_evaluation import StreamingStats
+from radar_evaluation import annotation_updates
+from radar_processing import box_corners
+from radar_recording import AnnotationSink
+from radar_recording import box_json_corners
+from radar_recording import point_records
+from radar_simulation import ActorGeometryCache
+from radar_simulation import ClientSideBoundingBoxes
+
+
+def test_streaming_stats():
+    rng = np.random.RandomState(0)
+    values = rng.lognormal(0.0, 1.5, 20000)
+    stats = StreamingStats()
+    for chunk in np.array_split(values, 7):
+        stats.add(chunk)
+    stats.add([np.nan, np.inf])
+
+    summary = stats.summary()
+    assert summary['count'] == len(values)
+    assert summary['mean'] == pytest.approx(values.mean())
+    assert summary['rms'] == pytest.approx(np.sqrt(np.mean(values ** 2)))
+    assert summary['min'] == values.min() and summary['max'] == values.max()
+    # exact to one bin of about 6 %
+    for q in (50, 95, 99):
+        assert summary['p%d' % q] == pytest.approx(np.percentile(values, q), rel=0.07)
+    assert StreamingStats().summary() == {'count': 0}
+
+
+def test_streaming_stats_out_of_range():
+    stats = StreamingStats(low=1.0, high=10.0, bins=9)
+    stats.add([0.0, 0.5, 20.0, 30.0])
+    # the upper edge of the underflow bin, and the maximum past the last bin
+    assert stats.percentile(25) == 1.0
+    assert stats.percentile(100) == 30.0
+
+
+def test_greedy_assignment():
+    rows, cols = greedy_assignment([0, 0, 1, 2], [0, 1, 0, 1], [1.0, 0.5, 0.2, 0.1], 3, 2)
+    # (2, 1) and (1, 0) are cheapest, row 0 finds both cols taken
+    assert rows.tolist() == [2, 1] and cols.tolist() == [1, 0]
+    rows, cols = greedy_assignment([], [], [], 0, 0)
+    assert rows.dtype == np.int64 and len(rows) == len(cols) == 0
+
+
+def brute_force_match(evaluator, centroids, extents, box_centers, box_mins, box_maxs):
+    rows, cols, costs = [], [], []
+    for row, (centroid, extent) in enumerate(zip(centroids, extents)):
+        for col, (center, low, high) in enumerate(zip(box_centers, box_mins, box_maxs)):
+            distance = np.linalg.norm(centroid[:2] - center[:2])
+            overlap = np.clip(np.minimum(centroid[:2] + extent[:2], high[:2]) -
+                              np.maximum(centroid[:2] - extent[:2], low[:2]), 0.0, None)
+            intersection = np.prod(overlap)
+            union = np.prod(2.0 * extent[:2]) + np.prod(high[:2] - low[:2]) - intersection
+            iou = intersection / max(union, 1e-9)
+            if distance <= evaluator.max_distance or iou >= evaluator.min_iou:
+                rows.append(row)
+                cols.append(col)
+                costs.append(distance / evaluator.max_distance + 1.0 - iou)
+    return greedy_assignment(rows, cols, costs, len(centroids), len(box_centers))
+
+
+def test_match_matches_brute_force():
+    rng = np.random.RandomState(1)
+    box_centers = rng.uniform(-30.0, 30.0, (40, 3))
+    half = rng.uniform(0.5, 2.5, (40, 3))
+    centroids = box_centers[rng.randint(0, 40, 60)] + rng.normal(0.0, 1.0, (60, 3))
+    extents = rng.uniform(0.2, 2.0, (60, 3))
+    # small blocks and every box a candidate, so the blocked gating is exact
+    evaluator = ClusterEvaluator(max_candidates=40, max_cells=100)
+
+    matched = evaluator.match(centroids, extents, box_centers, box_centers - half, box_centers + half)
+    expected = brute_force_match(evaluator, centroids, extents, box_centers, box_centers - half, box_centers + half)
+    np.testing.assert_array_equal(matched[0], expected[0])
+    np.testing.assert_array_equal(matched[1], expected[1])
+    assert 10 < len(matched[0]) < 40
+
+
+def frame(rng, centers, extents):
+    """
+    Radar points inside the boxes, and a cluster per box at its center.
+    """
+
+    xyz = np.concatenate([center + rng.uniform(-0.9, 0.9, (10, 3)) * extent
+                          for center, extent in zip(centers, extents)])
+    return xyz, box_corners(centers, extents)
+
+
+def test_update_scores_matches_and_radial_velocity():
+    rng = np.random.RandomState(2)
+    evaluator = ClusterEvaluator(frame_period=0.1)
+    sensor = np.array([0.0, 0.0, 1.0])
+    centers = np.array([[20.0, 0.0, 1.0], [0.0, 15.0, 1.0], [-30.0, -30.0, 1.0]])
+    extents = np.tile([2.0, 1.0, 0.8], (3, 1))
+    # box 0 drives away from the sensor at 10 m/s, box 1 stands, box 2 has no cluster
+    for frame_id, shift, velocities in ((1, 0.0, [0.0, 0.0]), (2, 1.0, [10.5, 0.0])):
+        moved = centers + [[shift, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+        xyz, corners = frame(rng, moved, extents)
+        clusters = ClusterResult(None, moved[:2] + 0.3, extents[:2], np.array(velocities), np.array([10, 10]))
+        metrics = evaluator.update(frame_id, xyz, clusters, corners, [7, 8, 9], sensor, latency=0.002)
+
+    assert metrics.clusters == 2 and metrics.boxes == 3 and metrics.visible == 3
+    assert metrics.matches == 2 and metrics.visible_matches == 2
+    np.testing.assert_allclose(metrics.centroid_errors, np.sqrt(0.18))
+    np.testing.assert_allclose(metrics.velocity_errors, [0.5, 0.0], atol=1e-9)
+    summary = evaluator.summary()
+    assert summary['frames'] == 2 and summary['precision'] == 1.0 and summary['recall'] == pytest.approx(4 / 6.0)
+    # the first frame has no velocity ground truth
+    assert summary['velocity_error_mps']['count'] == 2
+    assert summary['latency_ms']['count'] == 2 and summary['latency_ms']['max'] == pytest.approx(2.0)
+
+
+def test_box_json_corners_of_new_and_old_records():
+    corners = box_corners([(4.0, 5.0, 1.0)], (2.0, 1.0, 0.7))[0]
+    records = [{'boxloc': [4.0, 5.0, 0.3], 'corners': corners.tolist()},
+               {'boxloc': [10.0, -2.0, 0.0]}]
+    boxes = box_json_corners(records, (2.5, 2.5, 1.0))
+    np.testing.assert_array_equal(boxes[0], corners)
+    np.testing.assert_array_equal(boxes[1], box_corners([(10.0, -2.0, 1.0)], (2.5, 2.5, 1.0))[0])
+    assert box_json_corners([]).shape == (0, 8, 3)
+
+
+def test_annotations_are_scored_against_actor_boxes(world, tmp_path):
+    # a walker gets its own small box, not a car-sized one around its location
+    actors = list(world.get_actors().filter('vehicle.*'))[:3] + list(world.get_actors().filter('walker.*'))[:2]
+    actors[1].bounding_box = carla.BoundingBox(carla.Location(0.5, 0.0, 0.7), actors[1].bounding_box.extent)
+    records = ClientSideBoundingBoxes.get_bb_records(actors, 5, geometry=ActorGeometryCache())
+    expected = ClientSideBoundingBoxes.get_world_cords(actors)
+    np.testing.assert_allclose(box_json_corners(records), expected)
+
+    sink = AnnotationSink(str(tmp_path)).start()
+    xyz = expected.mean(axis=1)
+    sink.put('point', point_records(5, [0.0, 0.0, 1.0], xyz, np.zeros(len(xyz))))
+    sink.put('box', records)
+    sink.close()
+    (frame_id, _, _, corners, actor_ids, _, _), = annotation_updates(str(tmp_path), None)
+    assert frame_id == 5 and actor_ids == [actor.id for actor in actors]
+    np.testing.assert_allclose(corners, expected)
@@ -0,0 +1,279 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import carla
+from radar_clustering import RadarClustering
+from radar_pipeline import RadarPipeline
+from radar_processing import BoxGrid
+from radar_processing import RadarPrefilter
+from radar_processing import box_corners
+from radar_rig import RadarMount
+from radar_rig import RadarRig
+
+RIG = RadarRig([
+    RadarMount('front', (2.8, 0.0, 1.0), (5.0, 0.0, 0.0), 35.0, 20.0, 100.0, 1500.0),
+    RadarMount('left', (2.3, -0.9, 0.8), (0.0, -45.0, 0.0), 90.0, 20.0, 80.0, 1000.0)])
+
+
+def measurement(rng, frame, sensor_id, count=60, vehicle=(10.0, -4.0, 0.0, 0.0, 30.0, 0.0)):
+    """
+    A radar measurement of the rig on a vehicle at vehicle (x, y, z, pitch,
+    yaw, roll), returns (radar_data, points).
+    """
+
+    points = np.column_stack([
+        rng.uniform(-10.0, 10.0, count), rng.uniform(-0.2, 0.2, count),
+        rng.uniform(-0.5, 0.5, count), rng.uniform(2.0, 40.0, count)]).astype(np.float32)
+    vehicle_matrix = carla.Transform(
+        carla.Location(*vehicle[:3]), carla.Rotation(*vehicle[3:])).get_matrix()
+    transform = carla.matrix_to_transform(np.dot(vehicle_matrix, RIG.mount_matrices[sensor_id]))
+    return carla.RadarMeasurement(frame, 0.05 * frame, transform, points), points
+
+
+@pytest.fixture
+def pipeline(request):
+    pipeline = RadarPipeline(RadarClustering(), RIG, **getattr(request, 'param', {}))
+    yield pipeline
+    pipeline.close()
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 3, 'slots': 16}], indirect=True)
+def test_results_come_in_frame_order(pipeline):
+    pipeline.start()
+    rng = np.random.RandomState(10)
+    put = {}
+    for frame in range(1, 13):
+        for sensor_id in (1, 0):
+            radar_data, points = measurement(rng, frame, sensor_id, count=rng.randint(10, 200))
+            assert pipeline.put(radar_data, sensor_id, len(RIG))
+            put.setdefault(frame, []).append((sensor_id, points, radar_data.transform))
+        if frame % 4 == 0:
+            for result in pipeline.poll(0.5):
+                assert result.frame in put
+                pipeline.release(result)
+                del put[result.frame]
+
+    results = pipeline.drain(10.0)
+    assert [result.frame for result in results] == sorted(put)
+    for result in results:
+        assert result.error is None
+        measurements = put[result.frame]
+        expected = RIG.fuse(
+            [points for _, points, _ in measurements], [sensor_id for sensor_id, _, _ in measurements],
+            [(t.location.x, t.location.y, t.location.z, t.rotation.pitch, t.rotation.yaw, t.rotation.roll)
+             for _, _, t in measurements])
+        cloud = pipeline.cloud(result)
+        np.testing.assert_array_equal(cloud.points, expected.points)
+        np.testing.assert_array_equal(cloud.sensor_ids, expected.sensor_ids)
+        np.testing.assert_allclose(cloud.world_xyz, expected.world_xyz, atol=1e-9)
+        np.testing.assert_allclose(cloud.vehicle_matrix, expected.vehicle_matrix, atol=1e-9)
+        assert result.count == len(expected.points)
+        np.testing.assert_array_equal(
+            result.clusters.labels, RadarClustering().cluster(expected.points, expected.world_xyz).labels)
+        assert result.point_text.count('\n') == result.count
+        pipeline.release(result)
+
+    stats = pipeline.stats()
+    assert stats['submitted'] == 24 and stats['processed'] == 12
+    assert stats['failed'] == stats['dropped'] == stats['lost_workers'] == stats['in_flight'] == 0
+    assert stats['free_slots'] == 16
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 1, 'ground_truth': True}], indirect=True)
+def test_points_are_labelled_with_ground_truth_boxes(pipeline):
+    pipeline.start()
+    rng = np.random.RandomState(11)
+    fused = {}
+    for frame in (1, 2):
+        measurements = [measurement(rng, frame, sensor_id, count=300) for sensor_id in range(len(RIG))]
+        segments = [(sensor_id, points, radar_data.transform) for sensor_id, (radar_data, points) in
+                    enumerate(measurements)]
+        fused[frame] = RIG.fuse(
+            [points for _, points, _ in segments], [sensor_id for sensor_id, _, _ in segments],
+            [(t.location.x, t.location.y, t.location.z, t.rotation.pitch, t.rotation.yaw, t.rotation.roll)
+             for _, _, t in segments]).world_xyz
+        # boxes around some of the points, before the measurements of frame 1 and after those of frame 2
+        corners = box_corners(fused[frame][::40], (1.0, 1.0, 1.0))
+        boxes = (corners, np.arange(len(corners)) + 100, np.arange(len(corners)) % 2 + 1)
+        if frame == 1:
+            pipeline.put_boxes(frame, *boxes)
+        for sensor_id, (radar_data, _) in enumerate(measurements):
+            pipeline.put(radar_data, sensor_id, len(RIG))
+        if frame == 2:
+            # complete, but waiting for its boxes
+            assert pipeline.stats()['in_flight'] == 1
+            pipeline.put_boxes(frame, *boxes)
+        fused[frame] = (fused[frame], boxes)
+
+    results = pipeline.drain(10.0)
+    assert [result.frame for result in results] == [1, 2]
+    for result in results:
+        xyz, (corners, actor_ids, label_ids) = fused[result.frame]
+        rows = BoxGrid(corners).assign(xyz)
+        expected_actors = np.where(rows >= 0, actor_ids[rows], -1)
+        expected_labels = np.where(rows >= 0, label_ids[rows], -1)
+        point_actors, point_labels = pipeline.labels(result)
+        np.testing.assert_array_equal(point_actors, expected_actors)
+        np.testing.assert_array_equal(point_labels, expected_labels)
+        assert 0 < np.count_nonzero(point_actors >= 0) < len(xyz)
+        pipeline.release(result)
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 1, 'slots': 1, 'max_points': 50}], indirect=True)
+def test_drop_and_truncation_counters(pipeline):
+    pipeline.start()
+    rng = np.random.RandomState(12)
+    assert pipeline.put(measurement(rng, 1, 0, count=20)[0], 0, 1)
+
+    # the only slot is held by frame 1 until it is released
+    assert not pipeline.put(measurement(rng, 2, 0)[0], 0, 2)
+    assert pipeline.stats()['back_pressured'] == 1 and pipeline.stats()['dropped'] == 1
+    # the rest of a dropped frame goes without asking for a slot again
+    assert not pipeline.put(measurement(rng, 2, 1)[0], 1, 2)
+    assert pipeline.stats()['back_pressured'] == 1 and pipeline.stats()['dropped'] == 2
+
+    results = pipeline.drain(10.0)
+    assert [result.frame for result in results] == [1]
+    pipeline.release(results[0])
+
+    assert pipeline.put(measurement(rng, 3, 0, count=80)[0], 0, 1)
+    results = pipeline.drain(10.0)
+    assert [result.frame for result in results] == [3] and results[0].count == 50
+    pipeline.release(results[0])
+
+    stats = pipeline.stats()
+    assert stats['submitted'] == 4 and stats['processed'] == 2
+    assert stats['dropped'] == 2 and stats['back_pressured'] == 1 and stats['truncated'] == 1
+    assert stats['free_slots'] == 1
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 1, 'slots': 4}], indirect=True)
+def test_lost_worker_fails_queued_frames(pipeline):
+    pipeline.start()
+    process = pipeline._processes[0]
+    process.terminate()
+    process.join(5.0)
+    rng = np.random.RandomState(13)
+    for frame in (1, 2):
+        pipeline.put(measurement(rng, frame, 0)[0], 0, 1)
+
+    results = pipeline.drain(5.0)
+    assert [result.frame for result in results] == [1, 2]
+    assert all(result.error is not None for result in results)
+    for result in results:
+        pipeline.release(result)
+    stats = pipeline.stats()
+    assert stats['lost_workers'] == 1 and stats['failed'] == 2 and stats['free_slots'] == 4
+
+
+def expected_cloud(radar_data, points, sensor_id):
+    transform = radar_data.transform
+    return RIG.fuse([points], [sensor_id], [(transform.location.x, transform.location.y, transform.location.z,
+                                             transform.rotation.pitch, transform.rotation.yaw,
+                                             transform.rotation.roll)])
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 2, 'slots': 8}], indirect=True)
+def test_lost_worker_fails_only_its_frames(pipeline):
+    pipeline.start()
+    process = pipeline._processes[0]
+    process.terminate()
+    process.join(5.0)
+    rng = np.random.RandomState(14)
+    put = {}
+    # not noticed yet, frames go to both workers in turn
+    for frame in range(1, 7):
+        radar_data, points = measurement(rng, frame, 0, count=rng.randint(50, 300))
+        assert pipeline.put(radar_data, 0, 1)
+        put[frame] = expected_cloud(radar_data, points, 0)
+
+    results = []
+    deadline = time.time() + 10.0
+    while len(results) < 6 and time.time() < deadline:
+        results.extend(pipeline.poll(0.5))
+    failed = [result.frame for result in results if result.error is not None]
+    assert failed == [1, 3, 5] and all('RadarWorker-0' in result.error for result in results if result.error)
+    # slots of failed frames are reused while the other worker still works
+    for result in results:
+        if result.error is not None:
+            pipeline.release(result)
+    for frame in range(7, 10):
+        radar_data, points = measurement(rng, frame, 0, count=rng.randint(50, 300))
+        assert pipeline.put(radar_data, 0, 1)
+        put[frame] = expected_cloud(radar_data, points, 0)
+
+    results = [result for result in results if result.error is None] + pipeline.drain(10.0)
+    assert [result.frame for result in results] == [2, 4, 6, 7, 8, 9]
+    for result in results:
+        assert result.error is None
+        np.testing.assert_allclose(pipeline.cloud(result).world_xyz, put[result.frame].world_xyz, atol=1e-9)
+        pipeline.release(result)
+    stats = pipeline.stats()
+    assert stats['lost_workers'] == 1 and stats['failed'] == 3 and stats['free_slots'] == 8
+
+
+@pytest.mark.parametrize('pipeline', [{'workers': 1, 'slots': 1, 'block_timeout': 10.0}], indirect=True)
+def test_put_waits_for_a_slot_without_blocking_poll(pipeline):
+    pipeline.start()
+    rng = np.random.RandomState(15)
+    assert pipeline.put(measurement(rng, 1, 0)[0], 0, 1)
+
+    waited = []
+    producer = threading.Thread(target=lambda: waited.append(pipeline.put(measurement(rng, 2, 0)[0], 0, 1)))
+    producer.start()
+    start = time.time()
+    results = pipeline.drain(5.0)
+    # the producer waiting for the slot does not hold up poll
+    assert [result.frame for result in results] == [1] and time.time() - start < 5.0
+    pipeline.release(results[0])
+    producer.join(5.0)
+    assert waited == [True]
+
+    results = pipeline.drain(5.0)
+    assert [result.frame for result in results] == [2] and results[0].error is None
+    pipeline.release(results[0])
+    stats = pipeline.stats()
+    assert stats['back_pressured'] == 1 and stats['dropped'] == 0 and stats['free_slots'] == 1
+
+
+def test_prefilter_runs_in_the_workers():
+    prefilter = RadarPrefilter(depth=(5.0, 30.0), static_threshold=0.5)
+    pipeline = RadarPipeline(RadarClustering(), RIG, workers=2, prefilter=prefilter).start()
+    try:
+        # the callback side only copies, the workers have their own copies
+        prefilter.apply = lambda *args: pytest.fail('prefilter applied in the callback')
+        rng = np.random.RandomState(16)
+        ego_velocity = np.array([6.0, -2.0, 0.0])
+        reference = RadarPrefilter(depth=(5.0, 30.0), static_threshold=0.5)
+        expected = {}
+        for frame in range(1, 5):
+            measurements = [measurement(rng, frame, sensor_id, count=200) for sensor_id in range(len(RIG))]
+            kept = []
+            for sensor_id, (radar_data, points) in enumerate(measurements):
+                transform = radar_data.transform
+                transform = (transform.location.x, transform.location.y, transform.location.z,
+                             transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll)
+                # one measurement of frame 4 comes without ego velocity
+                velocity = None if (frame, sensor_id) == (4, 1) else ego_velocity
+                kept.append((sensor_id, reference.apply(points, velocity, transform[3:]), transform))
+                assert pipeline.put(radar_data, sensor_id, len(RIG), velocity)
+            expected[frame] = RIG.fuse([points for _, points, _ in kept], [sensor_id for sensor_id, _, _ in kept],
+                                       [transform for _, _, transform in kept])
+
+        results = pipeline.drain(10.0)
+        assert [result.frame for result in results] == [1, 2, 3, 4]
+        for result in results:
+            assert result.error is None
+            cloud = pipeline.cloud(result)
+            np.testing.assert_array_equal(cloud.points, expected[result.frame].points)
+            np.testing.assert_array_equal(cloud.sensor_ids, expected[result.frame].sensor_ids)
+            np.testing.assert_allclose(cloud.world_xyz, expected[result.frame].world_xyz, atol=1e-9)
+            assert result.point_text.count('\n') == result.count
+            pipeline.release(result)
+        assert prefilter.stats() == reference.stats()
+        assert prefilter.stats()['points_in'] == 4 * 400 and prefilter.stats()['static_skipped'] == 1
+    finally:
+        pipeline.close()
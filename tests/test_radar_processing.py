@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from radar_processing import ALTITUDE
+from radar_processing import AZIMUTH
+from radar_processing import DEPTH
+from radar_processing import VELOCITY
+from radar_processing import BoxGrid
+from radar_processing import RadarPoints
+from radar_processing import RadarPrefilter
+from radar_processing import box_corners
+from radar_processing import transform_matrices
+
+
+def random_boxes(rng, count, area=30.0):
+    centers = np.column_stack([rng.uniform(-area, area, (count, 2)), rng.uniform(0.5, 1.0, count)])
+    extents = np.column_stack([rng.uniform(0.3, 2.5, count), rng.uniform(0.3, 1.2, count),
+                               rng.uniform(0.5, 1.0, count)])
+    rotations = np.column_stack([rng.uniform(-5, 5, count), rng.uniform(-180, 180, count), rng.uniform(-5, 5, count)])
+    corners = box_corners(np.zeros((count, 3)), extents)
+    matrices = transform_matrices(centers, rotations)
+    return np.einsum('nij,nkj->nki', matrices[:, :3, :3], corners) + centers[:, np.newaxis, :], \
+        centers, extents, matrices
+
+
+def test_box_corners_order():
+    corners = box_corners([(1.0, 2.0, 3.0)], (0.5, 1.0, 2.0))[0]
+    np.testing.assert_array_equal(corners[:4, 2], 1.0)
+    np.testing.assert_array_equal(corners[4:, 2], 5.0)
+    np.testing.assert_array_equal(corners[:4, :2], corners[4:, :2])
+    np.testing.assert_array_equal(corners[:4, :2], [(1.5, 3.0), (0.5, 3.0), (0.5, 1.0), (1.5, 1.0)])
+    # opposite corners 0 and 6 span the box
+    np.testing.assert_array_equal(corners[6] - corners[0], (-1.0, -2.0, 4.0))
+
+
+def brute_force_assign(xyz, centers, extents, matrices, margin):
+    local = np.einsum('bji,pbj->pbi', matrices[:, :3, :3], xyz[:, np.newaxis, :] - centers[np.newaxis])
+    inside = np.all(np.abs(local) <= extents[np.newaxis] + margin, axis=2)
+    distance = np.sum((xyz[:, np.newaxis, :] - centers[np.newaxis]) ** 2, axis=2)
+    distance[~inside] = np.inf
+    assigned = np.argmin(distance, axis=1)
+    assigned[~np.any(inside, axis=1)] = -1
+    return assigned
+
+
+@pytest.mark.parametrize('margin', [0.0, 0.25])
+def test_box_grid_assign_matches_brute_force(margin):
+    rng = np.random.RandomState(1)
+    corners, centers, extents, matrices = random_boxes(rng, 60)
+    # points near the boxes, so many are inside one or several of them
+    xyz = centers[rng.randint(0, len(centers), 5000)] + rng.uniform(-3.0, 3.0, (5000, 3))
+
+    assigned = BoxGrid(corners, cell_size=4.0, margin=margin).assign(xyz)
+
+    expected = brute_force_assign(xyz, centers, extents, matrices, margin)
+    np.testing.assert_array_equal(assigned, expected)
+    assert 0 < np.count_nonzero(assigned >= 0) < len(xyz)
+
+
+def test_box_grid_without_boxes_or_points():
+    assert np.array_equal(BoxGrid(np.zeros((0, 8, 3))).assign(np.ones((3, 3))), [-1, -1, -1])
+    corners = random_boxes(np.random.RandomState(0), 2)[0]
+    assert len(BoxGrid(corners).assign(np.zeros((0, 3)))) == 0
+
+
+def radar_points(rng, count):
+    points = np.empty((count, 4), dtype=np.float32)
+    points[:, VELOCITY] = rng.uniform(-20.0, 20.0, count)
+    points[:, ALTITUDE] = np.radians(rng.uniform(-10.0, 10.0, count))
+    points[:, AZIMUTH] = np.radians(rng.uniform(-40.0, 40.0, count))
+    points[:, DEPTH] = rng.uniform(1.0, 100.0, count)
+    return points
+
+
+def test_prefilter_region_of_interest():
+    points = radar_points(np.random.RandomState(0), 2000)
+    prefilter = RadarPrefilter(depth=(5.0, 50.0), azimuth=(-20.0, 10.0), altitude=(-5.0, 5.0))
+    kept = prefilter.apply(points)
+
+    keep = (points[:, DEPTH] >= 5.0) & (points[:, DEPTH] <= 50.0) & \
+        (points[:, AZIMUTH] >= np.radians(-20.0)) & (points[:, AZIMUTH] <= np.radians(10.0)) & \
+        (points[:, ALTITUDE] >= np.radians(-5.0)) & (points[:, ALTITUDE] <= np.radians(5.0))
+    np.testing.assert_array_equal(kept, points[keep])
+    assert prefilter.stats()['points_in'] == 2000
+    assert prefilter.stats()['points_out'] == np.count_nonzero(keep)
+
+
+def test_prefilter_static_gate():
+    rng = np.random.RandomState(2)
+    points = radar_points(rng, 1000)
+    ego_velocity = np.array([8.0, 6.0, 0.0])
+    rotation = (2.0, 30.0, 0.0)
+    # half the detections are static targets as seen from the moving radar
+    sensor_velocity = np.dot(transform_matrices([(0.0, 0.0, 0.0)], [rotation])[0, :3, :3].T, ego_velocity)
+    direction = RadarPoints.to_sensor(np.column_stack([points[:, :DEPTH], np.ones(len(points))]))
+    static = np.arange(len(points)) % 2 == 0
+    points[static, VELOCITY] = -np.dot(direction[static], sensor_velocity) + rng.uniform(-0.4, 0.4, 500)
+    points[~static, VELOCITY] = -np.dot(direction[~static], sensor_velocity) + \
+        rng.choice([-1.0, 1.0], 500) * rng.uniform(0.6, 10.0, 500)
+
+    prefilter = RadarPrefilter(static_threshold=0.5)
+    np.testing.assert_array_equal(prefilter.apply(points, ego_velocity, rotation), points[~static])
+    assert prefilter.stats()['static_skipped'] == 0
+
+    # without ego velocity the gate cannot run, the points pass and it is counted
+    np.testing.assert_array_equal(prefilter.apply(points), points)
+    np.testing.assert_array_equal(prefilter.apply(points, ego_velocity), points)
+    assert prefilter.stats()['static_skipped'] == 2
+
+
+def test_prefilter_voxel_keeps_first_point_per_voxel():
+    points = radar_points(np.random.RandomState(3), 3000)
+    points = np.concatenate([points, points[:500]])
+    kept = RadarPrefilter(voxel_size=2.0).apply(points)
+
+    voxels = np.floor(RadarPoints.to_sensor(points) / 2.0).astype(np.int64)
+    _, first = np.unique(voxels, axis=0, return_index=True)
+    np.testing.assert_array_equal(kept, points[np.sort(first)])
+    assert len(kept) <= 3000
+
+
+def test_prefilter_disabled_passes_points_through():
+    points = radar_points(np.random.RandomState(4), 10)
+    prefilter = RadarPrefilter()
+    assert not prefilter.enabled
+    assert prefilter.apply(points) is points
+    assert prefilter.stats()['points_in'] == 0
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from radar_processing import RadarPoints
+from radar_processing import transform_matrices
+from radar_recording import AnnotationSink
+from radar_recording import FrameReader
+from radar_recording import FrameRecorder
+from radar_recording import json_frames
+from radar_recording import serialize_records
+
+
+def record(path, frames=5, sensors=2):
+    """
+    Records frames of random measurements and boxes, returns what was put.
+    """
+
+    rng = np.random.RandomState(9)
+    radar, boxes = {}, {}
+    recorder = FrameRecorder(path)
+    for frame in range(10, 10 + frames):
+        for sensor_id in range(sensors):
+            points = rng.uniform(0.5, 50.0, (rng.randint(1, 40), 4)).astype(np.float32)
+            transform = tuple(rng.uniform(-10.0, 10.0, 6))
+            # raw_data buffers and arrays are both accepted
+            recorder.add_radar(frame, memoryview(points.reshape(-1)).cast('B') if sensor_id else points,
+                               transform, sensor_id)
+            radar.setdefault(frame, []).append((sensor_id, points, transform))
+        count = rng.randint(0, 4)
+        boxes[frame] = (rng.uniform(-50.0, 50.0, (count, 8, 3)).astype(np.float32),
+                        rng.randint(100, 200, count), rng.randint(0, 3, count))
+        recorder.add_boxes(frame, *boxes[frame])
+    recorder.close()
+    return radar, boxes
+
+
+def test_round_trip(tmp_path):
+    radar, boxes = record(str(tmp_path))
+    reader = FrameReader(str(tmp_path))
+
+    assert reader.frame_ids().tolist() == sorted(radar)
+    for frame, measurements in radar.items():
+        entries = reader.radar_entries(frame)
+        assert entries['sensor_id'].tolist() == [sensor_id for sensor_id, _, _ in measurements]
+        for entry, (_, points, transform) in zip(entries, measurements):
+            np.testing.assert_array_equal(reader.radar_points(entry), points)
+            np.testing.assert_allclose(entry['transform'], transform)
+        frame_boxes = reader.box_frames(frame)
+        np.testing.assert_array_equal(frame_boxes['corners'], boxes[frame][0])
+        np.testing.assert_array_equal(frame_boxes['actor_id'], boxes[frame][1])
+        np.testing.assert_array_equal(frame_boxes['label_id'], boxes[frame][2])
+
+    entries, points = reader.radar_frames(11, 13)
+    assert sorted(set(entries['frame_id'].tolist())) == [11, 12]
+    np.testing.assert_array_equal(points, np.concatenate([p for f in (11, 12) for _, p, _ in radar[f]]))
+
+
+def test_world_frames(tmp_path):
+    radar, boxes = record(str(tmp_path))
+    frames = list(FrameReader(str(tmp_path)).world_frames())
+
+    assert [frame for frame, _, _, _, _ in frames] == sorted(radar)
+    for frame, points, xyz, transforms, frame_boxes in frames:
+        measurements = radar[frame]
+        np.testing.assert_array_equal(points, np.concatenate([p for _, p, _ in measurements]))
+        expected = [RadarPoints.to_world(p, transform_matrices([t[:3]], [t[3:]])[0])[1]
+                    for _, p, t in measurements]
+        np.testing.assert_allclose(xyz, np.concatenate(expected))
+        assert len(transforms) == len(measurements)
+        assert len(frame_boxes) == len(boxes[frame][1])
+
+
+def test_append_continues_recording(tmp_path):
+    path = str(tmp_path)
+    record(path, frames=2)
+    recorder = FrameRecorder(path)
+    with pytest.raises(ValueError):
+        recorder.add_radar(10, np.zeros((1, 4), dtype=np.float32), (0.0,) * 6)
+    with pytest.raises(ValueError):
+        recorder.add_boxes(5, np.zeros((0, 8, 3)), [], [])
+    recorder.add_radar(20, np.ones((3, 4), dtype=np.float32), (0.0,) * 6)
+    recorder.close()
+
+    reader = FrameReader(path)
+    assert reader.frame_ids().tolist() == [10, 11, 20]
+    np.testing.assert_array_equal(reader.radar_points(reader.radar_entries(20)[0]), np.ones((3, 4)))
+
+
+def test_partly_written_files(tmp_path):
+    path = str(tmp_path)
+    record(path, frames=3)
+    complete = FrameReader(path)
+    rows, entries = len(complete.radar), len(complete.radar_index)
+    for name in ('radar.f4', 'radar_index.bin', 'boxes.bin'):
+        with open(os.path.join(path, name), 'ab') as fp:
+            fp.write(b'\x01\x02\x03')
+
+    reader = FrameReader(path)
+    assert len(reader.radar) == rows and len(reader.radar_index) == entries
+
+    # reopening cuts the partial records and appends after the whole ones
+    recorder = FrameRecorder(path)
+    recorder.add_radar(20, np.ones((2, 4), dtype=np.float32), (0.0,) * 6)
+    recorder.close()
+    reader = FrameReader(path)
+    assert len(reader.radar) == rows + 2
+    np.testing.assert_array_equal(reader.radar_points(reader.radar_entries(20)[0]), np.ones((2, 4)))
+
+
+def read_json(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_sink_writes_batches_in_order(tmp_path):
+    sink = AnnotationSink(str(tmp_path)).start()
+    for frame in range(5):
+        assert sink.put('box', [{'frame_id': frame, 'actor_id': actor} for actor in range(3)])
+        assert sink.put_serialized('point', serialize_records([{'frame_id': frame}]), 1)
+    assert sink.put('box', [])
+    sink.close()
+
+    boxes = read_json(str(tmp_path / 'box.json'))
+    assert [(record['frame_id'], record['actor_id']) for record in boxes] == \
+        [(frame, actor) for frame in range(5) for actor in range(3)]
+    assert [frame for frame, _ in json_frames(str(tmp_path / 'point.json'))] == list(range(5))
+    stats = sink.stats()
+    assert stats['submitted'] == stats['written'] == 20 and stats['dropped'] == 0
+
+
+def test_sink_drops_when_full(tmp_path):
+    # not started, so nothing drains the queue
+    sink = AnnotationSink(str(tmp_path), max_batches=1, block_timeout=0.01)
+    assert sink.put('box', [{'frame_id': 0}])
+    assert not sink.put('box', [{'frame_id': 1}, {'frame_id': 1}])
+    stats = sink.stats()
+    assert stats['submitted'] == 3 and stats['dropped'] == 2 and stats['back_pressured'] == 1
+    assert stats['queued_batches'] == 1
+
+
+def test_sink_close_waits_for_producers(tmp_path):
+    sink = AnnotationSink(str(tmp_path)).start()
+    entered, go = threading.Event(), threading.Event()
+    put_nowait = sink._queue.put_nowait
+
+    def slow_put_nowait(batch):
+        # the producer is past the closed check but has not queued yet
+        entered.set()
+        go.wait(5.0)
+        put_nowait(batch)
+
+    sink._queue.put_nowait = slow_put_nowait
+    producer = threading.Thread(target=sink.put, args=('box', [{'frame_id': 0}]))
+    producer.start()
+    entered.wait(5.0)
+    closer = threading.Thread(target=sink.close)
+    closer.start()
+    closer.join(0.05)
+    go.set()
+    producer.join()
+    closer.join()
+
+    assert read_json(str(tmp_path / 'box.json')) == [{'frame_id': 0}]
+    assert not sink.put('box', [{'frame_id': 1}])
+    stats = sink.stats()
+    assert stats['submitted'] == 2 and stats['written'] == 1 and stats['dropped'] == 1
@@ -0,0 +1,73 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from radar_processing import RadarPoints
+from radar_processing import transform_matrices
+from radar_rig import DEFAULT_MOUNTS
+from radar_rig import RadarRig
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_rig(tmp_path, radars):
+    path = str(tmp_path / 'rig.json')
+    with open(path, 'w') as fp:
+        json.dump({'radars': radars}, fp)
+    return path
+
+
+def test_load_example_rig():
+    rig = RadarRig.load(os.path.join(ROOT, 'radar_rig.json'))
+    assert rig.names() == ['front', 'front_left', 'front_right', 'rear_left', 'rear_right']
+    assert rig.mounts[1].location == (2.3, -0.9, 0.8) and rig.mounts[1].rotation == (0.0, -45.0, 0.0)
+    assert rig.mounts[0].range == 150.0 and isinstance(rig.mounts[0].horizontal_fov, float)
+    np.testing.assert_allclose(rig.mount_matrices, transform_matrices(
+        [mount.location for mount in rig.mounts], [mount.rotation for mount in rig.mounts]))
+
+
+def test_load_defaults(tmp_path):
+    rig = RadarRig.load(write_rig(tmp_path, [{}, {'name': 'rear', 'range': 50}]))
+    assert rig.names() == ['radar0', 'rear']
+    assert rig.mounts[0][1:] == ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0), 30.0, 30.0, 100.0, 1500.0)
+    assert rig.mounts[1].range == 50.0
+    assert RadarRig().mounts == DEFAULT_MOUNTS
+
+
+@pytest.mark.parametrize('radars, message', [
+    ([{'range': 'far'}], 'radar 0'),
+    ([{}, {'location': [1.0, 2.0]}], 'radar 1: location and rotation need three values'),
+    ([{'rotation': None}], 'radar 0'),
+    ([{'name': 'front'}, {'name': 'front'}], 'unique'),
+    ([], 'at least one radar'),
+])
+def test_load_rejects_bad_rigs(tmp_path, radars, message):
+    with pytest.raises(ValueError, match=message):
+        RadarRig.load(write_rig(tmp_path, radars))
+
+
+def test_fuse_matches_per_radar_conversion():
+    rig = RadarRig.load(os.path.join(ROOT, 'radar_rig.json'))
+    rng = np.random.RandomState(5)
+    vehicle = transform_matrices([(12.0, -3.0, 0.2)], [(1.0, 70.0, -2.0)])[0]
+    points, sensor_ids, transforms, expected = [], [3, 0, 4], [], []
+    for sensor_id in sensor_ids:
+        radar = rng.uniform([-1.0, -0.2, -0.6, 1.0], [1.0, 0.2, 0.6, 80.0], (rng.randint(1, 50), 4)).astype(np.float32)
+        sensor_matrix = np.dot(vehicle, rig.mount_matrices[sensor_id])
+        rotation = np.degrees([np.arcsin(sensor_matrix[2, 0]), np.arctan2(sensor_matrix[1, 0], sensor_matrix[0, 0]),
+                               np.arctan2(-sensor_matrix[2, 1], sensor_matrix[2, 2])])
+        points.append(radar)
+        transforms.append(tuple(sensor_matrix[:3, 3]) + tuple(rotation))
+        expected.append(RadarPoints.to_world(radar, sensor_matrix)[1])
+
+    cloud = rig.fuse(points, sensor_ids, transforms)
+    np.testing.assert_allclose(cloud.vehicle_matrix, vehicle, atol=1e-9)
+    np.testing.assert_allclose(cloud.world_xyz, np.concatenate(expected), atol=1e-9)
+    np.testing.assert_array_equal(cloud.sensor_ids, np.repeat(sensor_ids, [len(p) for p in points]))
+    segments, offset = [], 0
+    for sensor_id, radar, transform in zip(sensor_ids, points, transforms):
+        segments.append((sensor_id, offset, len(radar), transform))
+        offset += len(radar)
+    np.testing.assert_allclose(rig.fuse_segments(np.concatenate(points), segments).world_xyz, cloud.world_xyz)
@@ -0,0 +1,64 @@
+import carla
+import scenario_spawner
+from scenario_spawner import SPAWN_CLEARANCE
+from scenario_spawner import ScenarioSpawner
+
+
+def test_spawn_and_destroy(world):
+    client = carla.Client()
+    spawn_points = world.get_map().get_spawn_points()
+    ego = spawn_points[0].location
+    frame = world.get_snapshot().frame
+
+    spawner = ScenarioSpawner(client, world, seed=1, tm_port=8123).spawn(vehicles=50, walkers=6, exclude=[ego])
+    traffic_manager = client.get_trafficmanager(8123)
+    free = [point for point in spawn_points if point.location.distance(ego) > SPAWN_CLEARANCE]
+    assert spawner.stats() == {'vehicles': len(free), 'walkers': 6, 'controllers': 6, 'failed': 0, 'destroyed': 0}
+    # one tick per batch: vehicles, walkers, controllers
+    assert world.get_snapshot().frame == frame + 3
+    assert traffic_manager.synchronous_mode
+
+    vehicles = world.get_actors(spawner.vehicle_ids)
+    assert all(vehicle.attributes['role_name'] == scenario_spawner.VEHICLE_ROLE for vehicle in vehicles)
+    assert all(world._autopilot[vehicle.id] for vehicle in vehicles)
+    assert all(vehicle.get_location().distance(ego) > SPAWN_CLEARANCE for vehicle in vehicles)
+    walkers = world.get_actors(spawner.walker_ids)
+    assert all(walker.attributes['role_name'] == scenario_spawner.WALKER_ROLE for walker in walkers)
+    controllers = world.get_actors(spawner.controller_ids)
+    assert sorted(controller.parent.id for controller in controllers) == sorted(spawner.walker_ids)
+    assert all(world._autopilot[walker_id] for walker_id in spawner.walker_ids)
+
+    actor_ids = spawner.actor_ids()
+    assert spawner.destroy() == len(actor_ids)
+    assert len(world.get_actors(actor_ids)) == 0
+    assert not traffic_manager.synchronous_mode
+    assert spawner.destroy() == 0
+    assert spawner.stats()['destroyed'] == len(actor_ids) and spawner.stats()['vehicles'] == 0
+
+
+def test_failed_spawns_are_counted(world):
+    client = carla.Client()
+    with ScenarioSpawner(client, world, seed=2) as spawner:
+        first = spawner.spawn_vehicles(5)
+        # the same spawn points again collide with the vehicles standing there
+        spawner.random.seed(2)
+        second = spawner.spawn_vehicles(5)
+        assert len(first) == 5 and len(second) == 0 and spawner.failed == 5
+    assert len(world.get_actors(first)) == 0
+
+
+def test_destroy_falls_back_to_one_by_one(world, monkeypatch, capsys):
+    client = carla.Client()
+    spawner = ScenarioSpawner(client, world, seed=3).spawn(vehicles=4, walkers=2)
+    actor_ids = spawner.actor_ids()
+    world.get_actor(spawner.vehicle_ids[0]).destroy()
+
+    def fail(commands, do_tick=False):
+        raise RuntimeError('time-out of 10000ms while waiting for the simulator')
+
+    monkeypatch.setattr(client, 'apply_batch_sync', fail)
+    assert spawner.destroy() == len(actor_ids) - 1
+    assert len(world.get_actors(actor_ids)) == 0
+    out = capsys.readouterr().out
+    assert 'destroying actors one by one' in out and '1 of %d actors not destroyed' % len(actor_ids) in out
+    assert spawner.actor_ids() == []
@@ -0,0 +1,63 @@
+import threading
+
+import carla
+from radar_simulation import SensorSynchronizer
+
+
+def data(frame):
+    return carla.SensorData(frame, 0.05 * frame, carla.Transform())
+
+
+def test_bundle_of_one_frame():
+    sync = SensorSynchronizer()
+    for frame in (1, 2):
+        sync.put('camera', data(frame))
+        sync.put('radar', data(frame))
+
+    bundle = sync.get(1, ['camera', 'radar'], timeout=0.0)
+    assert sorted(bundle) == ['camera', 'radar']
+    assert bundle['camera'].frame == bundle['radar'].frame == 1
+    assert sync.get(2, ['camera', 'radar'], timeout=0.0)['radar'].frame == 2
+    assert sync.stats() == {'dropped': {}, 'stale': {}, 'timeouts': {}}
+
+
+def test_waits_for_late_sensor():
+    sync = SensorSynchronizer()
+    sync.put('camera', data(1))
+    timer = threading.Timer(0.05, sync.put, ('radar', data(1)))
+    timer.start()
+    try:
+        bundle = sync.get(1, ['camera', 'radar'], timeout=5.0)
+    finally:
+        timer.join()
+    assert bundle['radar'].frame == 1
+    assert sync.stats()['timeouts'] == {}
+
+
+def test_full_queue_drops_oldest():
+    sync = SensorSynchronizer(max_pending=3)
+    for frame in range(1, 6):
+        sync.put('radar', data(frame))
+    assert sync.stats()['dropped'] == {'radar': 2}
+
+    assert sync.get(1, ['radar'], timeout=0.0)['radar'] is None
+    assert sync.get(3, ['radar'], timeout=0.0)['radar'].frame == 3
+    assert sync.stats()['timeouts'] == {'radar': 1}
+
+
+def test_stale_data_is_counted_and_discarded():
+    sync = SensorSynchronizer()
+    sync.put('camera', data(3))
+    sync.put('radar', data(2))
+    sync.put('radar', data(3))
+
+    bundle = sync.get(3, ['camera', 'radar'], timeout=0.0)
+    assert bundle['radar'].frame == 3
+    # frame 2 was left behind by the release of frame 3
+    assert sync.stats()['stale'] == {'radar': 1}
+
+    # late data for released frames
+    sync.put('camera', data(3))
+    sync.put('radar', data(1))
+    assert sync.stats()['stale'] == {'radar': 2, 'camera': 1}
+    assert sync.get(4, ['camera'], timeout=0.0)['camera'] is None
@@ -0,0 +1,84 @@
+import csv
+import json
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from tick_profiler import TickProfiler
+
+
+def test_statistics_over_rolling_window():
+    profiler = TickProfiler(window=100)
+    for value in range(1, 251):
+        profiler.add('radar', value / 1000.0)
+    profiler.add('render', 0.002)
+
+    statistics = profiler.statistics()
+    assert list(statistics) == ['radar', 'render']
+    radar = statistics['radar']
+    # only the last 100 durations, 151..250 ms
+    assert radar['count'] == 250
+    assert radar['max_ms'] == pytest.approx(250.0)
+    assert radar['mean_ms'] == pytest.approx(200.5)
+    assert radar['p50_ms'] == pytest.approx(np.percentile(np.arange(151, 251), 50))
+    assert statistics['render']['p99_ms'] == pytest.approx(2.0)
+
+
+def test_stage_context_and_disabled_profiler():
+    profiler = TickProfiler()
+    with profiler.stage('world.tick'):
+        pass
+    assert profiler.statistics()['world.tick']['count'] == 1
+
+    disabled = TickProfiler(enabled=False)
+    with disabled.stage('world.tick'):
+        pass
+    assert disabled.statistics() == {}
+
+
+def test_add_from_many_threads():
+    profiler = TickProfiler(window=64)
+    barrier = threading.Barrier(8)
+
+    def callback(name):
+        barrier.wait()
+        for _ in range(5000):
+            profiler.add(name, 0.001)
+
+    threads = [threading.Thread(target=callback, args=('radar.callback' if index % 2 else 'radar.%d' % index,))
+               for index in range(8)]
+    # switch threads as often as possible to expose lost updates
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    statistics = profiler.statistics()
+    assert statistics['radar.callback']['count'] == 4 * 5000
+    assert statistics['radar.callback']['mean_ms'] == pytest.approx(1.0)
+    assert sum(s['count'] for s in statistics.values()) == 8 * 5000
+
+
+def test_export(tmp_path):
+    profiler = TickProfiler()
+    profiler.add('sync', 0.004)
+    profiler.begin_tick()
+    profiler.end_tick()
+
+    profiler.export(str(tmp_path / 'profile.json'))
+    with open(str(tmp_path / 'profile.json')) as fp:
+        exported = json.load(fp)
+    assert exported['ticks'] == 1 and exported['stages']['sync']['p50_ms'] == pytest.approx(4.0)
+
+    profiler.export(str(tmp_path / 'profile.csv'))
+    with open(str(tmp_path / 'profile.csv')) as fp:
+        rows = list(csv.DictReader(fp))
+    assert [row['stage'] for row in rows] == ['sync'] and float(rows[0]['max_ms']) == pytest.approx(4.0)
+    assert 'sync 4.00/4.00/4.00' in profiler.summary_line()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Per-stage timing of the simulation loop.
+
+TickProfiler keeps a rolling window of durations per named stage and
+reports p50/p95/p99 as a summary line, as overlay text or as CSV/JSON.
+Optionally a number of ticks is wrapped in cProfile.
+
+    profiler = TickProfiler(summary_every=100)
+    profiler.begin_tick()
+    with profiler.stage('world.tick'):
+        world.tick()
+    profiler.end_tick()
+"""
+
+import cProfile
+import csv
+import json
+import pstats
+import threading
+import time
+
+import numpy as np
+
+# ==============================================================================
+# -- TickProfiler --------------------------------------------------------------
+# ==============================================================================
+
+
+class _Stage(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class TickProfiler(object):
+    """
+    Rolling per-stage latency statistics of the tick loop.
+
+    Every stage keeps its last window durations in a ring buffer.
+    summary_every > 0 prints a summary line every that many ticks,
+    cprofile_ticks > 0 runs cProfile over that many ticks after
+    cprofile_skip warm-up ticks and dumps it to cprofile_output.
+    """
+
+    def __init__(self, enabled=True, window=1000, summary_every=0,
+                 cprofile_ticks=0, cprofile_skip=10, cprofile_output=None):
+        self.enabled = enabled
+        self.window = window
+        self.summary_every = summary_every
+        self.cprofile_ticks = cprofile_ticks
+        self.cprofile_skip = cprofile_skip
+        self.cprofile_output = cprofile_output
+        self.ticks = 0
+        self._samples = {}
+        self._counts = {}
+        self._order = []
+        self._lock = threading.Lock()
+        self._cprofile = None
+
+    def stage(self, name):
+        """
+        Returns a context manager timing one run of stage name.
+        """
+
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        """
+        Records one duration of stage name, safe to call from any thread.
+        """
+
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = np.zeros(self.window)
+                self._counts[name] = 0
+                self._order.append(name)
+            count = self._counts[name]
+            samples[count % self.window] = seconds
+            self._counts[name] = count + 1
+
+    def begin_tick(self):
+        if self.cprofile_ticks and self._cprofile is None and self.ticks == self.cprofile_skip:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def end_tick(self):
+        self.ticks += 1
+        if self._cprofile is not None and self.ticks == self.cprofile_skip + self.cprofile_ticks:
+            self._cprofile.disable()
+            self._dump_cprofile()
+            self.cprofile_ticks = 0
+        if self.summary_every and self.ticks % self.summary_every == 0:
+            print(self.summary_line())
+
+    def stop(self):
+        """
+        Finishes a cProfile run cut short by the end of the loop.
+        """
+
+        if self._cprofile is not None and self.cprofile_ticks:
+            self._cprofile.disable()
+            self._dump_cprofile()
+            self.cprofile_ticks = 0
+
+    def _dump_cprofile(self):
+        stats = pstats.Stats(self._cprofile)
+        if self.cprofile_output:
+            stats.dump_stats(self.cprofile_output)
+            print('cProfile of %d ticks written to %s' % (self.cprofile_ticks, self.cprofile_output))
+        else:
+            stats.sort_stats('cumulative').print_stats(25)
+
+    def statistics(self):
+        """
+        Returns {stage: {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}} over
+        the rolling window, in first-seen stage order.
+        """
+
+        with self._lock:
+            windows = [(name, self._counts[name], self._samples[name][:min(self._counts[name], self.window)] * 1000.0)
+                       for name in self._order]
+        result = {}
+        for name, count, samples in windows:
+            if len(samples) == 0:
+                continue
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            result[name] = {
+                'count': count,
+                'mean_ms': float(samples.mean()),
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+                'max_ms': float(samples.max())}
+        return result
+
+    def summary_line(self):
+        parts = ['%s %.2f/%.2f/%.2f' % (name, s['p50_ms'], s['p95_ms'], s['p99_ms'])
+                 for name, s in self.statistics().items()]
+        return 'tick %d p50/p95/p99 ms: %s' % (self.ticks, ' | '.join(parts))
+
+    def overlay_lines(self):
+        lines = ['%-16s %7s %7s %7s' % ('stage ms', 'p50', 'p95', 'p99')]
+        for name, s in self.statistics().items():
+            lines.append('%-16s %7.2f %7.2f %7.2f' % (name, s['p50_ms'], s['p95_ms'], s['p99_ms']))
+        return lines
+
+    def export(self, path):
+        """
+        Writes statistics to path, CSV if it ends with .csv and JSON otherwise.
+        """
+
+        statistics = self.statistics()
+        if path.lower().endswith('.csv'):
+            fields = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+            with open(path, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=fields)
+                writer.writeheader()
+                for name, s in statistics.items():
+                    row = {'stage': name}
+                    row.update(s)
+                    writer.writerow(row)
+        else:
+            with open(path, 'w') as fp:
+                json.dump({'ticks': self.ticks, 'window': self.window, 'stages': statistics}, fp, indent=2)